@@ -0,0 +1,327 @@
+""" Reproducible benchmarks of derivation, code generation and evaluation.
+
+Every case reports the best wall time over a number of repeats, the peak memory allocated by Python during a
+separate traced run and the number of moments involved. The results are written as JSON together with the
+commit they were measured at, and can be compared against a previous run:
+
+    python benchmark_suite.py --output before.json
+    (change something)
+    python benchmark_suite.py --output after.json --compare before.json
+"""
+from algebraic_moments.objects import (RandomVariable, RandomVector, DeterministicVariable, StateVariable,
+                                       PolyDynamicalSystem, Moment, ConcentrationInequalityType)
+from algebraic_moments.moment_expressions import generate_moment_expressions, generate_multi_index_moment_expressions
+from algebraic_moments.generate_inequality import generate_concentration_inequality
+from algebraic_moments.tree_ring import tree_ring
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import sympy as sp
+
+def dependent_random_vector(n):
+    """ Random vector of n pairwise dependent random variables.
+    """
+    variables = [RandomVariable("w" + "i" * (i + 1)) for i in range(n)]
+    return RandomVector(variables, list(itertools.combinations(variables, 2)))
+
+def quadratic_form(random_vector):
+    """ Collision random variable (w - e)^T Q (w - e) - 1 of fourth_order_example, for any number of variables.
+
+    Returns:
+        SymPy expression:
+        list of DeterministicVariable:
+    """
+    variables = random_vector.variables
+    n = len(variables)
+    offsets = [DeterministicVariable("e" + "i" * (i + 1)) for i in range(n)]
+    weights = {(i, j) : DeterministicVariable("q" + "i" * (i + 1) + "j" * (j + 1)) for i in range(n) for j in range(i, n)}
+    centered = [var - e for var, e in zip(variables, offsets)]
+    expression = sum(weights[min(i, j), max(i, j)] * centered[i] * centered[j] for i in range(n) for j in range(n)) - 1
+    return expression, offsets + list(weights.values())
+
+def treering_system():
+    """ The system of treering_example.
+    """
+    x, y, v, c, s = [StateVariable(name) for name in ["x", "y", "v", "c", "s"]]
+    cw, sw, wv = [RandomVariable(name) for name in ["cw", "sw", "wv"]]
+    disturbance_vector = RandomVector([cw, sw, wv], [(cw, sw)])
+    state_dynamics = {
+        x : x + v * c,
+        y : y + v * s,
+        v : v + wv,
+        c : c * cw - s * sw,
+        s : s * cw + c * sw
+    }
+    state_dependencies = [(x, y), (x, v), (x, c), (x, s), (y, v), (y, c), (y, s)]
+    pds = PolyDynamicalSystem(state_dynamics, [], disturbance_vector, state_dependencies)
+    return pds, [Moment({x : 1}), Moment({y : 1}), Moment({x : 2}), Moment({y : 2}), Moment({x : 1, y : 1})]
+
+def differential_robot_system():
+    """ The system of differential_robot.
+    """
+    x, y, c, s = [StateVariable(name) for name in ["x", "y", "c", "s"]]
+    sol, sor, col, cor, omegals, omegars = [RandomVariable(name) for name in ["sol", "sor", "col", "cor", "omegals", "omegars"]]
+    disturbance_vector = RandomVector([sol, col, sor, cor, omegals, omegars],
+                                      [(sol, col), (sor, cor), (sol, omegals), (col, omegals), (sor, omegars), (cor, omegars)])
+    sv, cv, vls, vrs = [DeterministicVariable(name) for name in ["sv", "cv", "vls", "vrs"]]
+    state_dynamics = {
+        x : x + (vls + vrs + omegals + omegars) * c,
+        y : y + (vls + vrs + omegals + omegars) * s,
+        c : ((-s*sv + c*cv)*sor + (s*cv + sv*c)*cor)*sol + ((-s*sv + c*cv)*cor - (s*cv + sv*c)*sor)*col,
+        s : ((-s*sv + c*cv)*sor + (s*cv + sv*c)*cor)*col - ((-s*sv + c*cv)*cor - (s*cv + sv*c)*sor)*sol
+    }
+    state_dependencies = [(x, y), (x, c), (x, s), (y, c), (y, s)]
+    pds = PolyDynamicalSystem(state_dynamics, [sv, cv, vls, vrs], disturbance_vector, state_dependencies)
+    return pds, [Moment({x : 1}), Moment({y : 1}), Moment({x : 2}), Moment({y : 2}), Moment({x : 1, y : 1})]
+
+SYSTEMS = {"treering" : treering_system, "differential_robot" : differential_robot_system}
+
+class Case(object):
+    def __init__(self, group, name, setup, run, counts):
+        """ A benchmark case.
+
+        Args:
+            group (str): what is being benchmarked, e.g. "tree_ring".
+            name (str): unique name of the case.
+            setup (function): builds the inputs of run, untimed.
+            run (function): the timed function, called with the output of setup.
+            counts (function): maps the output of run to a dict of counts, e.g. the number of moments.
+        """
+        self.group = group
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.counts = counts
+
+def moment_expression_counts(moment_expressions):
+    return {"moments" : len(moment_expressions.moments), "expressions" : len(moment_expressions.moment_expressions)}
+
+def msds_counts(msds):
+    return {"moments" : len(msds.moment_state), "disturbance_moments" : len(msds.disturbance_moments)}
+
+def printed(print_function):
+    """ Call a printer and return the number of characters it printed, which is discarded.
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        print_function()
+    return len(output.getvalue())
+
+def cases():
+    """ Every benchmark case, in the order they run.
+    """
+    cases = []
+
+    # Moment expressions of powers of a quadratic form, as the degree and the random vector grow.
+    for n, power in [(2, 2), (2, 4), (2, 6), (3, 2), (3, 4), (4, 2), (4, 3)]:
+        def setup(n=n, power=power):
+            random_vector = dependent_random_vector(n)
+            g, deterministic_variables = quadratic_form(random_vector)
+            return {"g" : g**power}, random_vector, deterministic_variables
+        cases.append(Case("generate_moment_expressions", "generate_moment_expressions[n=%d,power=%d]" % (n, power),
+                          setup, lambda args: generate_moment_expressions(*args), moment_expression_counts))
+
+    # Moments of a vector of polynomials up to order 4, from a dict of separately written products and expanded
+    # from lower order products.
+    def vector_setup():
+        random_vector = dependent_random_vector(3)
+        g, deterministic_variables = quadratic_form(random_vector)
+        x, y, z = random_vector.variables
+        a, b = DeterministicVariable("a"), DeterministicVariable("b")
+        return {"g1" : g, "g2" : a * x + b * y * z + 1, "g3" : z**2 - a * y}, random_vector, deterministic_variables + [a, b]
+    def separate(args):
+        polynomials, random_vector, deterministic_variables = args
+        expressions = dict()
+        for multi_index in itertools.product(range(5), repeat=len(polynomials)):
+            if 0 < sum(multi_index) <= 4:
+                name = "_".join(name + "Pow" + str(power) for name, power in zip(polynomials, multi_index) if power)
+                expressions[name] = sp.Mul(*[g**power for g, power in zip(polynomials.values(), multi_index)])
+        return generate_moment_expressions(expressions, random_vector, deterministic_variables)
+    cases.append(Case("generate_moment_expressions", "generate_moment_expressions[products,n=3,order=4]", vector_setup,
+                      separate, moment_expression_counts))
+    cases.append(Case("generate_moment_expressions", "generate_multi_index_moment_expressions[n=3,order=4]", vector_setup,
+                      lambda args: generate_multi_index_moment_expressions(*args, max_order=4), moment_expression_counts))
+
+    # A bundle of 20 constraints, derived serially and in a process pool.
+    for processes in [None, 4]:
+        def setup():
+            random_vector = dependent_random_vector(3)
+            g, deterministic_variables = quadratic_form(random_vector)
+            x = random_vector.variables
+            expressions = {"g%d" % k : (g + k * x[k % 3])**(2 + k % 3) for k in range(20)}
+            return expressions, random_vector, deterministic_variables
+        cases.append(Case("generate_moment_expressions", "generate_moment_expressions[bundle=20,processes=%s]" % processes,
+                          setup, lambda args, processes=processes: generate_moment_expressions(*args, processes=processes),
+                          moment_expression_counts))
+
+    # Adding the third power of a quadratic form to the moment expressions of the first two, vs deriving all three.
+    def add_setup():
+        random_vector = dependent_random_vector(3)
+        g, deterministic_variables = quadratic_form(random_vector)
+        return generate_moment_expressions({"first" : g, "second" : g**2}, random_vector, deterministic_variables), g
+    def add(args):
+        moment_expressions, g = args
+        moment_expressions.add_expressions({"third" : g**3})
+        return moment_expressions
+    cases.append(Case("generate_moment_expressions", "moment_expressions.add_expressions[n=3,power=3]", add_setup, add,
+                      moment_expression_counts))
+
+    for inequality_type in ConcentrationInequalityType:
+        def setup(inequality_type=inequality_type):
+            random_vector = dependent_random_vector(2)
+            g, deterministic_variables = quadratic_form(random_vector)
+            return g, random_vector, deterministic_variables, inequality_type.name.lower()
+        cases.append(Case("generate_concentration_inequality",
+                          "generate_concentration_inequality[%s]" % inequality_type.name.lower(),
+                          setup, lambda args: generate_concentration_inequality(*args),
+                          lambda inequality: moment_expression_counts(inequality._moment_expressions)))
+
+    for system, reduced in itertools.product(SYSTEMS, [True, False]):
+        cases.append(Case("tree_ring", "tree_ring[%s,reduced=%s]" % (system, reduced), SYSTEMS[system],
+                          lambda args, reduced=reduced: tree_ring(args[1], args[0], reduced=reduced), msds_counts))
+    for system in SYSTEMS:
+        cases.append(Case("tree_ring", "tree_ring[%s,reduced=True,processes=4]" % system, SYSTEMS[system],
+                          lambda args: tree_ring(args[1], args[0], processes=4), msds_counts))
+
+    # Printers, on derivations that are done in the untimed setup.
+    def moment_expressions_setup():
+        random_vector = dependent_random_vector(3)
+        g, deterministic_variables = quadratic_form(random_vector)
+        return generate_moment_expressions({"first" : g, "second" : g**2}, random_vector, deterministic_variables)
+    def inequality_setup():
+        random_vector = dependent_random_vector(3)
+        g, deterministic_variables = quadratic_form(random_vector)
+        return generate_concentration_inequality(g, random_vector, deterministic_variables, "cantelli")
+    def msds_setup():
+        pds, initial_moment_state = differential_robot_system()
+        return tree_ring(initial_moment_state, pds)
+    printers = [("moment_expressions", moment_expressions_setup, ["print_python", "print_octave", "print_matlab"]),
+                ("concentration_inequality", inequality_setup, ["print_python", "print_octave", "print_matlab"]),
+                ("msds", msds_setup, ["print_cpp", "print_python", "print_octave", "print_matlab"])]
+    for obj_name, setup, methods in printers:
+        for method, cse in itertools.product(methods, [False, True]):
+            cases.append(Case("printers", "%s.%s[cse=%s]" % (obj_name, method, cse), setup,
+                              lambda obj, method=method, cse=cse: printed(lambda: getattr(obj, method)(cse=cse)),
+                              lambda characters: {"characters" : characters}))
+
+    # Numerical evaluation of the derived expressions.
+    def evaluate_setup(batch=10000):
+        moment_expressions = moment_expressions_setup()
+        rng = np.random.default_rng(0)
+        input_moments = {str(m) : rng.normal(size=batch) for m in moment_expressions._moments}
+        input_deterministic = {str(var) : rng.normal(size=batch) for var in moment_expressions._deterministic_variables}
+        return moment_expressions, input_moments, input_deterministic
+    cases.append(Case("evaluation", "moment_expressions.evaluate_batch[batch=10000]", evaluate_setup,
+                      lambda args: args[0].evaluate_batch(args[1], args[2]), lambda outputs: {"outputs" : len(outputs)}))
+
+    # Generated code, with and without the expressions in Horner form in the deterministic variables.
+    for horner in [False, True]:
+        def ranked_setup(horner=horner, batch=10000):
+            moment_expressions = moment_expressions_setup()
+            evaluate = moment_expressions.compile_ranked(cse=True, horner=horner)
+            rng = np.random.default_rng(0)
+            moment_vector = rng.normal(size=(moment_expressions.moment_vector_size(), batch))
+            deterministic = rng.normal(size=(len(moment_expressions.deterministic_variables), batch))
+            return evaluate, moment_vector, deterministic, np.empty((len(moment_expressions.moment_expressions), batch))
+        cases.append(Case("evaluation", "moment_expressions.compile_ranked[cse=True,horner=%s,batch=10000]" % horner,
+                          ranked_setup, lambda args: args[0](*args[1:]), lambda out: {"outputs" : len(out)}))
+    return cases
+
+def measure(case, repeat):
+    """ Run a case repeat times for the wall time and once more under tracemalloc for the peak memory.
+
+    Returns:
+        dict: result of the case.
+    """
+    times = []
+    for _ in range(repeat):
+        args = case.setup()
+        gc.collect()
+        start = time.perf_counter()
+        output = case.run(args)
+        times.append(time.perf_counter() - start)
+
+    args = case.setup()
+    gc.collect()
+    tracemalloc.start()
+    case.run(args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {"group" : case.group, "name" : case.name, "wall_time_s" : min(times), "wall_times_s" : times,
+              "peak_memory_bytes" : peak}
+    result.update(case.counts(output))
+    return result
+
+def git_commit():
+    """ Commit of the working tree, with a "-dirty" suffix if it has uncommitted changes, or None outside of git.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=directory, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if status.strip() else "")
+
+def compare(results, baseline):
+    """ Print the ratio of the wall time and peak memory of each case to a baseline.
+    """
+    baseline_results = {result["name"] : result for result in baseline["results"]}
+    print("\nComparison against " + str(baseline.get("commit")) + " (ratio < 1 is an improvement):")
+    print("%-60s %10s %10s" % ("case", "time", "memory"))
+    for result in results["results"]:
+        old = baseline_results.get(result["name"])
+        if old is None:
+            print("%-60s %10s %10s" % (result["name"], "new", "new"))
+            continue
+        print("%-60s %10.2f %10.2f" % (result["name"], result["wall_time_s"] / old["wall_time_s"],
+                                       result["peak_memory_bytes"] / max(old["peak_memory_bytes"], 1)))
+
+def benchmark_suite(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark derivation, code generation and evaluation.")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare against")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each case (default: 3)")
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this string")
+    args = parser.parse_args(argv)
+
+    results = {"commit" : git_commit(),
+               "timestamp" : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+               "python" : platform.python_version(),
+               "sympy" : sp.__version__,
+               "numpy" : np.__version__,
+               "machine" : platform.machine(),
+               "repeat" : args.repeat,
+               "results" : []}
+    print("%-60s %10s %12s %8s" % ("case", "time_s", "peak_MiB", "moments"))
+    for case in cases():
+        if args.filter not in case.name:
+            continue
+        result = measure(case, args.repeat)
+        results["results"].append(result)
+        print("%-60s %10.4f %12.2f %8s" % (case.name, result["wall_time_s"], result["peak_memory_bytes"] / 2**20,
+                                           result.get("moments", "")))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+if __name__ == "__main__":
+    benchmark_suite()
@@ -0,0 +1,65 @@
+from algebraic_moments.objects import Moment, RandomVariable, RandomVector, DeterministicVariable
+from algebraic_moments.moment_expressions import moment_expression
+from algebraic_moments.objects import MomentRegistry
+import itertools
+import time
+
+class LinearScanRegistry(object):
+    """ Reference implementation of the moment lookup that MomentRegistry replaced: a linear
+        scan with Moment.same_vpm over every moment found so far.
+    """
+    def __init__(self):
+        self._moments = []
+        self.lookups = [] # Every vpm looked up, in order.
+
+    def intern(self, vpm):
+        self.lookups.append(vpm)
+        equivalent_moments = [m for m in self._moments if m.same_vpm(vpm)]
+        if equivalent_moments:
+            return equivalent_moments[0], False
+        moment = Moment(vpm)
+        self._moments.append(moment)
+        return moment, True
+
+    def __len__(self):
+        return len(self._moments)
+
+def derive(expressions, random_vector, moments):
+    start = time.perf_counter()
+    for exp in expressions:
+        moment_expression(exp, random_vector, moments)
+    return time.perf_counter() - start
+
+def replay(lookups, moments):
+    start = time.perf_counter()
+    for vpm in lookups:
+        moments.intern(vpm)
+    return time.perf_counter() - start
+
+def moment_registry_benchmark():
+    """ Time the derivation of E[(c + x1 + ... + xn)^k] for k = 1, ..., max_order with all of the
+        variables pairwise dependent, so every monomial is its own moment.
+    """
+    n = 3
+    variables = [RandomVariable("x" + "i" * (i + 1)) for i in range(n)]
+    random_vector = RandomVector(variables, list(itertools.combinations(variables, 2)))
+    c = DeterministicVariable("c")
+
+    # The derivation columns time moment_expression end to end, the lookup columns replay the
+    # recorded sequence of moment lookups on their own.
+    print("max_order  moments  lookups  derive_scan_s  derive_registry_s  lookup_scan_s  lookup_registry_s")
+    for max_order in [4, 8, 12, 16]:
+        expressions = [(c + sum(variables))**k for k in range(1, max_order + 1)]
+        linear_scan = LinearScanRegistry()
+        linear_scan_time = derive(expressions, random_vector, linear_scan)
+        registry = MomentRegistry(random_vector)
+        registry_time = derive(expressions, random_vector, registry)
+        assert len(registry) == len(linear_scan)
+
+        lookups = linear_scan.lookups
+        linear_scan_lookup_time = replay(lookups, LinearScanRegistry())
+        registry_lookup_time = replay(lookups, MomentRegistry(random_vector))
+        print("%9d  %7d  %7d  %13.3f  %17.3f  %13.4f  %17.4f" % (max_order, len(registry), len(lookups),
+              linear_scan_time, registry_time, linear_scan_lookup_time, registry_lookup_time))
+
+moment_registry_benchmark()
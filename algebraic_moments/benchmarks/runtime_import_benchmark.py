@@ -0,0 +1,65 @@
+from algebraic_moments.benchmarks.benchmark_suite import treering_system
+from algebraic_moments.tree_ring import tree_ring
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+# Worker that propagates a moment state with the runtime subpackage, from an exported artifact.
+RUNTIME_WORKER = """
+from algebraic_moments.runtime import load_artifact
+propagator = load_artifact(path)
+imported = time.perf_counter()
+propagator.propagate_horizon([0.5] * len(propagator.moment_state), [[0.1] * len(propagator.control_variables)] * 10,
+                             [0.5] * len(propagator.disturbance_moments))
+"""
+
+# Worker that propagates a moment state with the derivation objects, from a pickled MomentStateDynamicalSystem.
+DERIVATION_WORKER = """
+import pickle
+with open(path, "rb") as f:
+    msds = pickle.load(f)
+imported = time.perf_counter()
+msds.propagate_horizon([0.5] * len(msds.moment_state), [[0.1] * len(msds.control_variables)] * 10,
+                       [0.5] * len(msds.disturbance_moments))
+"""
+
+def measure(worker, path, repeat=5):
+    """ Run a worker in fresh interpreters.
+
+    Returns:
+        float: best time to import and load, in seconds.
+        float: best time until the propagation is done, in seconds.
+        float: largest resident memory, in MiB.
+    """
+    # The peak resident memory is read from VmHWM, because ru_maxrss carries over the peak of the parent process.
+    script = "import sys, time\nstart = time.perf_counter()\npath = sys.argv[1]\n" + worker + \
+             "peak = [line.split()[1] for line in open('/proc/self/status') if line.startswith('VmHWM')][0]\n" + \
+             "print(imported - start, time.perf_counter() - start, peak)\n"
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script, path], stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout
+        results.append([float(value) for value in output.split()])
+    return min(r[0] for r in results), min(r[1] for r in results), max(r[2] for r in results) / 1024
+
+def runtime_import_benchmark():
+    """ Cold start of a worker that propagates the tree ring moment state dynamics, with the runtime subpackage
+        and with the derivation objects.
+    """
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    with tempfile.TemporaryDirectory() as directory:
+        artifact_path = os.path.join(directory, "dynamics.json")
+        msds.export_artifact(artifact_path, c_source=False)
+        pickle_path = os.path.join(directory, "dynamics.pkl")
+        with open(pickle_path, "wb") as f:
+            pickle.dump(msds, f)
+
+        print("%-12s %10s %10s %10s" % ("worker", "load_s", "total_s", "rss_MiB"))
+        for name, worker, path in [("runtime", RUNTIME_WORKER, artifact_path),
+                                   ("derivation", DERIVATION_WORKER, pickle_path)]:
+            print("%-12s %10.3f %10.3f %10.1f" % ((name,) + measure(worker, path)))
+
+runtime_import_benchmark()
@@ -0,0 +1,204 @@
+""" A content-addressed on-disk cache of derived objects (MomentExpressions, ConcentrationInequality and
+MomentStateDynamicalSystem), so that fixed systems are only derived once.
+
+Entries are keyed by a hash of a canonical representation of the inputs of a derivation, the version of this
+package and CACHE_FORMAT, so changing any input (or upgrading) never returns a stale result.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import sympy as sp
+
+import algebraic_moments
+from algebraic_moments.native import cache_directory
+from algebraic_moments.objects import RandomVector, PolyDynamicalSystem, Moment, Distribution
+from algebraic_moments.profiling import phase
+
+# Version of the pickled layout of the cached classes. Bump it whenever the attributes of MomentExpressions,
+# ConcentrationInequality, MomentStateDynamicalSystem or the objects they hold change, so that older entries
+# are never loaded.
+CACHE_FORMAT = 2
+
+def canonical_repr(obj):
+    """ Representation of a derivation input that doesn't depend on hash seeds or on orders that are irrelevant
+        (variable power maps of moments, distribution annotations, dependence edges and sets). Dicts keep their insertion order, since the order
+        of expressions or dynamics decides the order of the derived outputs.
+
+    Args:
+        obj: SymPy expression, RandomVector, PolyDynamicalSystem, Moment, Distribution, or a dict, list, tuple or
+            set of them.
+
+    Raises:
+        Exception: obj has an unsupported type.
+
+    Returns:
+        str: canonical representation of obj.
+    """
+    if isinstance(obj, Moment):
+        # Equal moments may have been built from variable power maps in different orders.
+        return "Moment({" + ", ".join(sorted(canonical_repr(var) + ": " + canonical_repr(power)
+                                             for var, power in obj.vpm.items())) + "})"
+    elif isinstance(obj, sp.Basic):
+        return sp.srepr(obj)
+    elif isinstance(obj, RandomVector):
+        return "RandomVector(" + canonical_repr(obj.variables) + ", " + \
+               _canonical_edges(obj.dependence_graph.edges) + ", " + \
+               "{" + ", ".join(sorted(canonical_repr(var) + ": " + canonical_repr(distribution)
+                                      for var, distribution in obj.distributions.items())) + "})"
+    elif isinstance(obj, Distribution):
+        return repr(obj)
+    elif isinstance(obj, PolyDynamicalSystem):
+        return "PolyDynamicalSystem(" + canonical_repr(obj.dynamics) + ", " + \
+               canonical_repr(list(obj.control_variables)) + ", " + \
+               canonical_repr(obj.state_random_vector) + ", " + \
+               canonical_repr(obj.disturbance_vector) + ")"
+    elif isinstance(obj, dict):
+        return "{" + ", ".join(canonical_repr(key) + ": " + canonical_repr(value) for key, value in obj.items()) + "}"
+    elif isinstance(obj, (set, frozenset)):
+        return "{" + ", ".join(sorted(canonical_repr(item) for item in obj)) + "}"
+    elif isinstance(obj, (list, tuple)):
+        return "[" + ", ".join(canonical_repr(item) for item in obj) + "]"
+    elif obj is None or isinstance(obj, (bool, int, float, str)):
+        return repr(obj)
+    else:
+        raise Exception("Can't build a cache key from an instance of " + type(obj).__name__ + ".")
+
+def _canonical_edges(edges):
+    return "[" + ", ".join("(" + a + ", " + b + ")" for a, b in
+                           sorted(tuple(sorted(sp.srepr(var) for var in edge)) for edge in edges)) + "]"
+
+class DerivationCache(object):
+    def __init__(self, directory=None, max_size_bytes=256 * 2**20):
+        """ A directory of pickled derivations, evicted least recently used first once it exceeds a size.
+
+        Args:
+            directory (str, optional): cache directory. Defaults to cache_directory("derivations").
+            max_size_bytes (int, optional): the least recently used entries are removed when the entries
+                take more space than this. None disables eviction. Defaults to 256 MiB.
+        """
+        self._directory = directory or cache_directory("derivations")
+        os.makedirs(self._directory, exist_ok=True)
+        self._max_size_bytes = max_size_bytes
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def key(self, kind, *inputs):
+        """ Content address of a derivation.
+
+        Args:
+            kind (str): name of the derivation, e.g. "tree_ring".
+            inputs: inputs of the derivation, see canonical_repr.
+
+        Returns:
+            str: hex digest.
+        """
+        text = "\n".join([kind, algebraic_moments.__version__, str(CACHE_FORMAT)] +
+                         [canonical_repr(obj) for obj in inputs])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".pkl")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key, default=None):
+        """ Load an entry and mark it as recently used.
+
+        Returns:
+            The cached object, or default if there is no entry or it can't be loaded.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                obj = pickle.load(f)
+        except Exception:
+            # A truncated entry, or one that refers to a class or attribute that no longer exists.
+            return default
+        os.utime(path)
+        return obj
+
+    def put(self, key, obj):
+        """ Store an entry, then evict entries if the cache is too large.
+        """
+        # Write to a temporary file and rename it, so that concurrent readers never see a partial entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        """ Entries of the cache.
+
+        Returns:
+            list of tuples (str, int, float): key, size in bytes and last use time of each entry, least
+                recently used first.
+        """
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith(".pkl"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self._directory, name))
+            except OSError:
+                continue
+            entries.append((name[:-len(".pkl")], stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_size_bytes=None):
+        """ Remove the least recently used entries until the cache fits in max_size_bytes.
+
+        Args:
+            max_size_bytes (int, optional): Defaults to the limit of this cache.
+        """
+        max_size_bytes = self._max_size_bytes if max_size_bytes is None else max_size_bytes
+        if max_size_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= max_size_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+
+    def invalidate(self, key=None):
+        """ Remove an entry, or every entry if key is None.
+        """
+        keys = [key] if key is not None else [key for key, _, _ in self.entries()]
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+def cached(cache, kind, inputs, derive):
+    """ Look up a derivation in cache, deriving and storing it on a miss.
+
+    Args:
+        cache (DerivationCache or None): no caching if None.
+        kind (str): name of the derivation.
+        inputs (list): inputs of the derivation, see canonical_repr.
+        derive (function): computes the derivation.
+    """
+    if cache is None:
+        return derive()
+    with phase("cache_lookup"):
+        key = cache.key(kind, *inputs)
+        obj = cache.get(key)
+    if obj is None:
+        obj = derive()
+        with phase("cache_store"):
+            cache.put(key, obj)
+    return obj
@@ -0,0 +1,155 @@
+""" Transformations applied to expressions before they are printed.
+"""
+import sympy as sp
+from sympy.printing.pycode import NumPyPrinter
+
+def numpy_code(expr):
+    """ Print an expression as Python code that calls NumPy functions, e.g. numpy.sqrt instead of math.sqrt,
+        so that it evaluates on floats as well as on arrays. The code is executed with numpy in its namespace,
+        see algebraic_moments.runtime.compile_function.
+    """
+    return NumPyPrinter().doprint(expr)
+
+def count_flops(expressions):
+    """ Count the floating point operations needed to evaluate expressions naively. An n-ary sum or product
+        costs n - 1 operations, an integer power x**n costs |n| - 1 multiplications (plus a division if n
+        is negative) and every other power or function call costs one operation.
+
+    Args:
+        expressions (list of SymPy expressions):
+
+    Returns:
+        int: number of operations.
+    """
+    flops = 0
+    stack = list(expressions)
+    while stack:
+        expr = stack.pop()
+        if expr.is_Atom:
+            continue
+        if expr.is_Add or expr.is_Mul:
+            flops += len(expr.args) - 1
+            # A product with a coefficient of -1 is a negation, which is free in a sum.
+            if expr.is_Mul and expr.args[0] == -1:
+                flops -= 1
+        elif expr.is_Pow and expr.exp.is_Integer:
+            flops += abs(int(expr.exp)) - 1 + (1 if expr.exp < 0 else 0)
+        else:
+            flops += 1
+        stack.extend(expr.args)
+    return flops
+
+def taken_names(expressions):
+    """ Names that temporaries of expressions must not use: the names of the expressions and of their free symbols.
+
+    Args:
+        expressions (dict name -> SymPy expression):
+
+    Returns:
+        set of str:
+    """
+    return set(expressions) | {str(symbol) for expr in expressions.values() for symbol in expr.free_symbols}
+
+def common_subexpressions(expressions, prefix="cse"):
+    """ Jointly eliminate common subexpressions from a set of named expressions.
+
+    Args:
+        expressions (dict name -> SymPy expression): expressions to be emitted together.
+        prefix (str, optional): prefix of the temporaries, which are numbered and skip the names in
+            taken_names(expressions). Defaults to "cse".
+
+    Returns:
+        list of tuples (Symbol, SymPy expression): temporaries, in the order they must be assigned.
+        dict name -> SymPy expression: expressions in terms of the temporaries.
+    """
+    names = list(expressions.keys())
+    taken = taken_names(expressions)
+    symbols = (symbol for symbol in sp.numbered_symbols(prefix) if str(symbol) not in taken)
+    temporaries, reduced = sp.cse([expressions[name] for name in names], symbols=symbols)
+    return temporaries, dict(zip(names, reduced))
+
+def horner_form(expressions, variables):
+    """ Nest each expression in multivariate Horner form in variables, e.g. the deterministic variables or
+        control inputs, so that no power of a variable is computed and each term doesn't repeat the products
+        of variables it shares with other terms. Expressions that aren't polynomials, e.g. gradients of
+        probability bounds, are left as they are.
+
+    Args:
+        expressions (dict name -> SymPy expression):
+        variables (list of SymPy symbols): variables to factor out, outermost first.
+
+    Returns:
+        dict name -> SymPy expression: expressions in Horner form.
+    """
+    forms = dict()
+    for name, expr in expressions.items():
+        used = [var for var in variables if expr.has(var)]
+        forms[name] = sp.horner(expr, *used) if used and expr.is_polynomial() else expr
+    return forms
+
+def power_temporaries(expressions, variables):
+    """ Compute each integer power of variables that appears in expressions once, by repeated multiplication.
+
+    Args:
+        expressions (dict name -> SymPy expression):
+        variables (list of SymPy symbols):
+
+    Returns:
+        list of tuples (Symbol, SymPy expression): temporaries, where the temporary var_powk is var**k, with
+            trailing underscores if that name is in taken_names(expressions).
+        dict name -> SymPy expression: expressions in terms of the temporaries.
+    """
+    max_powers = dict()
+    for expr in expressions.values():
+        for power in expr.atoms(sp.Pow):
+            if power.base in variables and power.exp.is_Integer and power.exp >= 2:
+                max_powers[power.base] = max(max_powers.get(power.base, 1), int(power.exp))
+
+    taken = taken_names(expressions)
+    temporaries = []
+    substitutions = dict()
+    for var in variables:
+        previous = var
+        for k in range(2, max_powers.get(var, 1) + 1):
+            name = str(var) + "_pow" + str(k)
+            while name in taken:
+                name += "_"
+            taken.add(name)
+            temp = sp.Symbol(name)
+            # An unevaluated product, so that it isn't simplified back to a power.
+            temporaries.append((temp, sp.Mul(previous, var, evaluate=False)))
+            substitutions[var**k] = temp
+            previous = temp
+    return temporaries, {name : expr.xreplace(substitutions) for name, expr in expressions.items()}
+
+def prepare_expressions(expressions, cse=False, prefix="cse", horner=None):
+    """ Apply the optional transformations to expressions that are about to be printed.
+
+    Args:
+        expressions (dict name -> SymPy expression):
+        cse (bool, optional): jointly eliminate common subexpressions. Defaults to False.
+        prefix (str, optional): prefix of the temporaries. Defaults to "cse".
+        horner (list of SymPy symbols, optional): nest the expressions in Horner form in these variables
+            first, see horner_form, and compute the powers of the variables that remain once, see
+            power_temporaries. Defaults to None.
+
+    Returns:
+        list of tuples (Symbol, SymPy expression): temporaries to assign before the expressions.
+        dict name -> SymPy expression: expressions to assign.
+        str: summary of the flop counts before and after the transformations, or None.
+    """
+    reports = []
+    temporaries = []
+    flops = count_flops(list(expressions.values())) if cse or horner else None
+    if horner:
+        temporaries, expressions = power_temporaries(horner_form(expressions, horner), horner)
+        flops_after = count_flops([expr for _, expr in temporaries] + list(expressions.values()))
+        reports.append("Horner: " + str(flops) + " flops -> " + str(flops_after) + " flops.")
+        flops = flops_after
+    if not cse:
+        return temporaries, expressions, " ".join(reports) or None
+    cse_temporaries, reduced = common_subexpressions(expressions, prefix)
+    temporaries = temporaries + cse_temporaries
+    flops_after = count_flops([expr for _, expr in temporaries] + list(reduced.values()))
+    reports.append("CSE: " + str(len(cse_temporaries)) + " temporaries, " + str(flops) + " flops -> " + str(flops_after) + " flops.")
+    return temporaries, reduced, " ".join(reports)
@@ -0,0 +1,126 @@
+""" Symbolic derivatives of generated expressions, for gradient based optimizers.
+
+Jacobians are sparse: an entry is only derived when the variable appears in the expression, and entries
+that differentiate to zero are dropped. The sparsity pattern is exposed so that solvers can use it.
+"""
+import sympy as sp
+
+class SparseJacobian(object):
+    def __init__(self, outputs, variables, entries):
+        """ Jacobian of named expressions with respect to variables.
+
+        Args:
+            outputs (list): names of the differentiated expressions, one per row.
+            variables (list of SymPy symbols): variables, one per column.
+            entries (dict tuple (int, int) -> SymPy expression): structurally nonzero entries, keyed by (row, column)
+                in row major order.
+        """
+        self._outputs = list(outputs)
+        self._variables = list(variables)
+        self._entries = entries
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    @property
+    def variables(self):
+        return self._variables
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @property
+    def shape(self):
+        return (len(self._outputs), len(self._variables))
+
+    @property
+    def nnz(self):
+        return len(self._entries)
+
+    def pattern(self):
+        """ Sparsity pattern in row major order.
+
+        Returns:
+            list of int: row of each nonzero entry.
+            list of int: column of each nonzero entry.
+        """
+        return [row for row, _ in self._entries], [col for _, col in self._entries]
+
+    def csr_pattern(self):
+        """ Sparsity pattern in compressed sparse row format.
+
+        Returns:
+            list of int: indptr, entries indptr[i]:indptr[i + 1] are in row i.
+            list of int: column of each nonzero entry.
+        """
+        indptr = [0] * (len(self._outputs) + 1)
+        for row, _ in self._entries:
+            indptr[row + 1] += 1
+        for i in range(len(self._outputs)):
+            indptr[i + 1] += indptr[i]
+        return indptr, [col for _, col in self._entries]
+
+    def values(self):
+        """ Nonzero entries in the order of pattern.
+
+        Returns:
+            list of SymPy expressions:
+        """
+        return list(self._entries.values())
+
+    def named_entries(self):
+        """ Nonzero entries keyed by (output, variable).
+
+        Returns:
+            dict tuple -> SymPy expression:
+        """
+        return {(self._outputs[row], self._variables[col]) : expr for (row, col), expr in self._entries.items()}
+
+    def as_matrix(self):
+        """ Dense SymPy matrix of the Jacobian.
+        """
+        matrix = sp.zeros(*self.shape)
+        for (row, col), expr in self._entries.items():
+            matrix[row, col] = expr
+        return matrix
+
+def sparse_jacobian(expressions, variables):
+    """ Differentiate named expressions with respect to variables.
+
+    Args:
+        expressions (dict name -> SymPy expression): expressions to differentiate, one row each.
+        variables (list of SymPy symbols):
+
+    Returns:
+        SparseJacobian:
+    """
+    variables = list(variables)
+    column = {var : col for col, var in enumerate(variables)}
+    entries = dict()
+    for row, expr in enumerate(expressions.values()):
+        for col in sorted(column[var] for var in expr.free_symbols if var in column):
+            derivative = sp.diff(expr, variables[col])
+            if derivative != 0:
+                entries[(row, col)] = derivative
+    return SparseJacobian(list(expressions.keys()), variables, entries)
+
+def chain_gradients(outer, inner_jacobian):
+    """ Gradients of expressions of intermediate symbols, whose Jacobian with respect to the variables is known.
+
+    Args:
+        outer (dict name -> SymPy expression): functions of the outputs of inner_jacobian (as symbols).
+        inner_jacobian (SparseJacobian): Jacobian of the intermediate symbols, whose outputs are the symbols.
+
+    Returns:
+        SparseJacobian: Jacobian of outer with respect to inner_jacobian.variables.
+    """
+    partials = sparse_jacobian(outer, inner_jacobian.outputs)
+    entries = dict()
+    for (row, k), outer_derivative in partials.entries.items():
+        for (inner_row, col), inner_derivative in inner_jacobian.entries.items():
+            if inner_row == k:
+                entries[(row, col)] = entries.get((row, col), 0) + outer_derivative * inner_derivative
+    entries = {key : entries[key] for key in sorted(entries) if entries[key] != 0}
+    return SparseJacobian(list(outer.keys()), inner_jacobian.variables, entries)
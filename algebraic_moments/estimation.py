@@ -0,0 +1,289 @@
+""" Estimation of raw moments from samples, in the formats consumed by the evaluators:
+
+    values = estimate_moments(random_vector, moments, samples)
+    moment_expressions.evaluate_batch(input_moments(moments, values), input_deterministic)
+    moment_expressions.evaluate_ranked(moment_vector(random_vector, moments, values), deterministic)
+    propagate(prev_moment_state, values, control_inputs) # values of msds.disturbance_moments.
+
+Streams of samples are summarized by a StreamingMomentEstimator, whose snapshot has the same format:
+
+    estimator = StreamingMomentEstimator(random_vector, msds.disturbance_moments, forgetting=0.99)
+    for samples in stream:
+        estimator.update(samples)
+        propagate(prev_moment_state, estimator.snapshot(), control_inputs)
+"""
+from collections import deque
+import numpy as np
+
+class MomentKernel(object):
+    def __init__(self, random_vector, moments, variables=None):
+        """ Computes sums of the monomials of a list of moments over chunks of samples. Monomials are
+            evaluated in lexicographic order of their multi-indices, so that consecutive monomials share the
+            product of their common prefix, and powers of each variable are computed once per chunk.
+
+        Args:
+            random_vector (RandomVector):
+            moments (list of Moment): moments of variables of random_vector.
+            variables (list of RandomVariable, optional): variable of each column of the samples. Defaults to
+                random_vector.variables.
+
+        Raises:
+            Exception: a moment has a variable that is not a column of the samples.
+        """
+        self._moments = list(moments)
+        variables = list(variables) if variables is not None else list(random_vector.variables)
+        column = {var : i for i, var in enumerate(variables)}
+        for moment in self._moments:
+            if not all(var in column for var in moment.vpm):
+                raise Exception("The samples don't have a column for every variable of " + str(moment) + ".")
+
+        # Multi-indices relative to the columns, in lexicographic order.
+        multi_indices = [tuple(moment.vpm.get(var, 0) for var in variables) for moment in self._moments]
+        self._order = sorted(range(len(multi_indices)), key=lambda i: multi_indices[i], reverse=True)
+        self._multi_indices = [multi_indices[i] for i in self._order]
+        self._n_columns = len(variables)
+        self._max_powers = [max([multi_index[i] for multi_index in multi_indices], default=0) for i in range(len(variables))]
+
+    @property
+    def moments(self):
+        return self._moments
+
+    @property
+    def n_columns(self):
+        return self._n_columns
+
+    def sums(self, samples, weights=None):
+        """ Weighted sums of the monomial of each moment over a chunk of samples.
+
+        Args:
+            samples (array of shape (N, n_columns)):
+            weights (array of shape (N,), optional): weight of each sample. Defaults to ones.
+
+        Returns:
+            array of shape (len(moments),): sums in the order of moments.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim != 2 or samples.shape[1] != self._n_columns:
+            raise Exception("samples should have shape (N, " + str(self._n_columns) + "), but has shape " +
+                            str(samples.shape) + ".")
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            if weights.shape != (samples.shape[0],):
+                raise Exception("weights should have shape " + str((samples.shape[0],)) + ".")
+
+        # Table of the powers of each column, powers[i][k] = samples[:, i]**k.
+        powers = []
+        for i, max_power in enumerate(self._max_powers):
+            column = np.ascontiguousarray(samples[:, i])
+            column_powers = [None, column]
+            for _ in range(2, max_power + 1):
+                column_powers.append(column_powers[-1] * column)
+            powers.append(column_powers)
+
+        # prefix[i] is the product of the powers of columns 0, ..., i of the current multi-index, or None if
+        # they are all zero. Only the prefix that differs from the previous multi-index is recomputed.
+        sums = np.empty(len(self._multi_indices))
+        prefix = [None] * self._n_columns
+        previous = None
+        for k, multi_index in enumerate(self._multi_indices):
+            start = 0
+            if previous is not None:
+                while start < self._n_columns and multi_index[start] == previous[start]:
+                    start += 1
+            for i in range(start, self._n_columns):
+                product = prefix[i - 1] if i else None
+                if multi_index[i]:
+                    product = powers[i][multi_index[i]] if product is None else product * powers[i][multi_index[i]]
+                prefix[i] = product
+            previous = multi_index
+
+            monomial = prefix[-1] if self._n_columns else None
+            if monomial is None:
+                sums[k] = samples.shape[0] if weights is None else weights.sum()
+            elif weights is None:
+                sums[k] = monomial.sum()
+            else:
+                sums[k] = np.dot(monomial, weights)
+
+        ordered = np.empty(len(self._multi_indices))
+        ordered[self._order] = sums
+        return ordered
+
+def _chunks(samples, weights, chunk_size):
+    """ Iterate over (samples, weights) chunks of an array, or pass through an iterable of chunks.
+    """
+    if isinstance(samples, np.ndarray):
+        for start in range(0, max(samples.shape[0], 1), chunk_size):
+            yield samples[start:start + chunk_size], None if weights is None else weights[start:start + chunk_size]
+    else:
+        if weights is not None:
+            raise Exception("Pass weights as (samples, weights) chunks when samples is an iterable of chunks.")
+        for chunk in samples:
+            if isinstance(chunk, tuple):
+                yield chunk
+            else:
+                yield chunk, None
+
+def estimate_moments(random_vector, moments, samples, weights=None, variables=None, chunk_size=2**14):
+    """ Estimate raw moments from samples in a single pass.
+
+    Args:
+        random_vector (RandomVector):
+        moments (list of Moment): moments to estimate.
+        samples (array of shape (N, d), or iterable of such arrays or of (samples, weights) tuples): samples, one
+            row each, with a column per variable. Chunks are processed one at a time, so an iterable only needs
+            one chunk in memory.
+        weights (array of shape (N,), optional): weights of the samples, e.g. of particles. Defaults to ones.
+        variables (list of RandomVariable, optional): variable of each column. Defaults to random_vector.variables.
+        chunk_size (int, optional): number of rows of an array processed at once, which bounds the memory
+            used by temporaries. Defaults to 2**14.
+
+    Raises:
+        Exception: there are no samples.
+
+    Returns:
+        array of shape (len(moments),): estimated moments, in the order of moments.
+    """
+    kernel = MomentKernel(random_vector, moments, variables)
+    if isinstance(samples, np.ndarray):
+        weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+    sums = np.zeros(len(kernel.moments))
+    total = 0.0
+    for chunk, chunk_weights in _chunks(samples, weights, chunk_size):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.shape[0] == 0:
+            continue
+        sums += kernel.sums(chunk, chunk_weights)
+        total += chunk.shape[0] if chunk_weights is None else float(np.sum(chunk_weights))
+    if total == 0:
+        raise Exception("estimate_moments received no samples.")
+    return sums / total
+
+class StreamingMomentEstimator(object):
+    def __init__(self, random_vector, moments, forgetting=None, window=None, variables=None):
+        """ Incremental estimator of raw moments from a stream of samples. Only the weighted sums of the
+            monomials are stored, so an update costs O(len(moments)) per sample and the memory doesn't grow
+            with the length of the stream.
+
+        Args:
+            random_vector (RandomVector):
+            moments (list of Moment): moments to estimate.
+            forgetting (float, optional): exponential forgetting factor in (0, 1]. The weight of a sample is
+                multiplied by forgetting every time a newer sample arrives. Defaults to no forgetting.
+            window (int, optional): only the samples of the last window updates are used. Defaults to every
+                sample.
+            variables (list of RandomVariable, optional): variable of each column. Defaults to random_vector.variables.
+
+        Raises:
+            Exception: forgetting and window are both given, or are out of range.
+        """
+        if forgetting is not None and window is not None:
+            raise Exception("Use either exponential forgetting or a sliding window, not both.")
+        if forgetting is not None and not 0 < forgetting <= 1:
+            raise Exception("forgetting should be in (0, 1], but is " + str(forgetting) + ".")
+        if window is not None and window < 1:
+            raise Exception("window should be a positive number of updates, but is " + str(window) + ".")
+        self._kernel = MomentKernel(random_vector, moments, variables)
+        self._forgetting = forgetting
+        self._window = window
+        self.reset()
+
+    @property
+    def moments(self):
+        return self._kernel.moments
+
+    @property
+    def total_weight(self):
+        """ float: total (forgotten) weight of the samples the estimates are based on.
+        """
+        return self._weight
+
+    def reset(self):
+        """ Forget every sample.
+        """
+        self._sums = np.zeros(len(self._kernel.moments))
+        self._weight = 0.0
+        # Sums and weight of each update in the window, and number of updates since the sums were recomputed.
+        self._updates = deque()
+        self._since_resum = 0
+
+    def update(self, samples, weights=None):
+        """ Add a sample or a mini-batch of samples.
+
+        Args:
+            samples (array of shape (d,) or (N, d)): one sample, or N samples in the order they were observed.
+            weights (float or array of shape (N,), optional): weights of the samples. Defaults to ones.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim == 1:
+            samples = samples[None, :]
+        n = samples.shape[0]
+        weights = np.ones(n) if weights is None else np.broadcast_to(np.asarray(weights, dtype=np.float64), (n,))
+        if n == 0:
+            return
+
+        if self._forgetting is not None and self._forgetting != 1:
+            # The k-th of n new samples is followed by n - 1 - k newer ones.
+            weights = weights * self._forgetting ** np.arange(n - 1, -1, -1, dtype=np.float64)
+            decay = self._forgetting ** n
+            self._sums *= decay
+            self._weight *= decay
+        sums = self._kernel.sums(samples, weights)
+        weight = float(np.sum(weights))
+        self._sums += sums
+        self._weight += weight
+
+        if self._window is not None:
+            self._updates.append((sums, weight))
+            if len(self._updates) > self._window:
+                old_sums, old_weight = self._updates.popleft()
+                self._since_resum += 1
+                if self._since_resum >= self._window:
+                    # Recompute from the window every window updates, so that rounding errors of the
+                    # subtractions don't accumulate. The amortized cost per update is unchanged.
+                    self._sums = np.sum([update[0] for update in self._updates], axis=0)
+                    self._weight = sum(update[1] for update in self._updates)
+                    self._since_resum = 0
+                else:
+                    self._sums -= old_sums
+                    self._weight -= old_weight
+
+    def snapshot(self):
+        """ Current estimates, in the order of moments, e.g. the disturbance moments input of the propagators.
+
+        Raises:
+            Exception: no samples have been added.
+
+        Returns:
+            array of shape (len(moments),):
+        """
+        if self._weight <= 0:
+            raise Exception("StreamingMomentEstimator has no samples.")
+        return self._sums / self._weight
+
+def input_moments(moments, values):
+    """ Estimated moments as the input_moments dict of MomentExpressions.evaluate_batch and the printed code.
+
+    Returns:
+        dict str -> float or array:
+    """
+    return {str(moment) : value for moment, value in zip(moments, values)}
+
+def moment_vector(random_vector, moments, values, size=None):
+    """ Estimated moments as a vector indexed by rank, the input of MomentExpressions.evaluate_ranked.
+
+    Args:
+        random_vector (RandomVector): random vector the ranks are relative to.
+        moments (list of Moment):
+        values (array of shape (len(moments),) or (len(moments), N)):
+        size (int, optional): length of the vector. Defaults to the largest rank plus one.
+
+    Returns:
+        array of shape (size,) or (size, N): moments indexed by rank, with zeros for the moments that weren't given.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    ranks = [random_vector.rank(random_vector.multi_idx(moment.vpm)) for moment in moments]
+    size = size if size is not None else max(ranks, default=-1) + 1
+    vector = np.zeros((size,) + values.shape[1:])
+    vector[ranks] = values
+    return vector
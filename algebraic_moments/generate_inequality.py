@@ -2,7 +2,7 @@ from algebraic_moments.moment_expressions import generate_moment_expressions
 from algebraic_moments.objects import ConcentrationInequalityType, ConcentrationInequality
 
 def generate_concentration_inequality(constraint_rv_expression, random_vec,
-                                      deterministic_vars, inequality_type):
+                                      deterministic_vars, inequality_type, cache=None):
     """ Consider Prob(g(x, w) <= 0) where g is polynomial, x is a deterministic
         vector, and w is a random vector, this function generates code to upper
         bound the probability via a concentration inequality. It expresses
@@ -13,9 +13,11 @@ def generate_concentration_inequality(constraint_rv_expression, random_vec,
         random_vec (RandomVector): The random vector w
         deterministic_vars (list of DeterministicVariable): deterministic variables in the expression constraint_rv
         inequality_type (string) : Concentration inequality to generate
+        cache (DerivationCache, optional): reuse the moment expressions derived by a previous call with the
+            same inputs. Defaults to None.
     """
     expressions = {"first_moment" : constraint_rv_expression, "second_moment" : constraint_rv_expression**2}
-    moment_expressions = generate_moment_expressions(expressions, random_vec, deterministic_vars)
+    moment_expressions = generate_moment_expressions(expressions, random_vec, deterministic_vars, cache=cache)
     if inequality_type.lower() == "cantelli":
         return ConcentrationInequality(moment_expressions, ConcentrationInequalityType.CANTELLI)
     elif inequality_type.lower() == "vp":
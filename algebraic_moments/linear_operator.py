@@ -0,0 +1,177 @@
+""" Moment state dynamics as an affine map, moment_state = A(d, u) * prev_moment_state + b(d, u), where A is a
+sparse matrix whose entries, like b, depend only on the disturbance moments d and control inputs u. See
+MomentStateDynamicalSystem.compile_linear_operator. This module only depends on NumPy; SciPy is used by
+LinearMomentOperator.matrix if it is installed.
+"""
+import numpy as np
+
+class LinearMomentOperator(object):
+    def __init__(self, fill, indptr, indices, n_state, n_disturbance, n_control):
+        """ Affine form of a moment state dynamical system, with A in compressed sparse row format.
+
+        Args:
+            fill (function): fill(disturbance_moments, control_inputs, data, offset) writes the nonzero entries
+                of A to data and b to offset, see MomentStateDynamicalSystem.linear_operator_python_source.
+            indptr (list of int): entries indptr[i]:indptr[i + 1] of data are in row i of A.
+            indices (list of int): column of each nonzero entry of A.
+            n_state (int): number of rows and columns of A.
+            n_disturbance (int): number of disturbance moments.
+            n_control (int): number of control inputs.
+        """
+        self._fill = fill
+        self._indptr = np.asarray(indptr, dtype=np.intp)
+        self._indices = np.asarray(indices, dtype=np.intp)
+        self._n_state = n_state
+        self._n_disturbance = n_disturbance
+        self._n_control = n_control
+        # Row, slice of entries and columns of each nonempty row.
+        self._rows = [(i, slice(start, end), self._indices[start:end])
+                      for i, (start, end) in enumerate(zip(indptr[:-1], indptr[1:])) if end > start]
+
+    @property
+    def indptr(self):
+        return self._indptr
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def shape(self):
+        return (self._n_state, self._n_state)
+
+    @property
+    def nnz(self):
+        return len(self._indices)
+
+    def fill(self, disturbance_moments, control_inputs, data=None, offset=None):
+        """ Evaluate A and b.
+
+        Args:
+            disturbance_moments (array of shape (n_disturbance,) or (n_disturbance, N)):
+            control_inputs (array of shape (n_control,) or (n_control, N)):
+            data (array of shape (nnz,) or (nnz, N), optional): buffer for the nonzero entries of A.
+            offset (array of shape (n_state,) or (n_state, N), optional): buffer for b.
+
+        Returns:
+            array of shape (nnz,) or (nnz, N): nonzero entries of A in the order of indices, for each of the N
+                inputs.
+            array of shape (n_state,) or (n_state, N): b.
+        """
+        disturbance_moments = np.asarray(disturbance_moments, dtype=np.float64)
+        control_inputs = np.asarray(control_inputs, dtype=np.float64)
+        if disturbance_moments.shape[:1] != (self._n_disturbance,) or control_inputs.shape[:1] != (self._n_control,):
+            raise Exception("disturbance_moments and control_inputs should have " + str(self._n_disturbance) +
+                            " and " + str(self._n_control) + " rows.")
+        batch = np.broadcast_shapes(disturbance_moments.shape[1:], control_inputs.shape[1:])
+        data = np.empty((self.nnz,) + batch) if data is None else data
+        offset = np.empty((self._n_state,) + batch) if offset is None else offset
+        if data.shape != (self.nnz,) + batch or offset.shape != (self._n_state,) + batch:
+            raise Exception("data and offset should have shapes " + str((self.nnz,) + batch) + " and " +
+                            str((self._n_state,) + batch) + ".")
+        if not batch:
+            # Arithmetic on Python floats is much cheaper than on NumPy scalars.
+            values, constants = self._fill(disturbance_moments.tolist(), control_inputs.tolist(),
+                                           [0.0] * self.nnz, [0.0] * self._n_state)
+            data[:] = values
+            offset[:] = constants
+        else:
+            self._fill(disturbance_moments, control_inputs, data, offset)
+        return data, offset
+
+    def matvec(self, data, offset, moment_state):
+        """ A * moment_state + b for filled A and b.
+
+        Args:
+            data (array of shape (nnz,) or (nnz, N)): nonzero entries of A, shared by every moment state or one
+                column per moment state.
+            offset (array of shape (n_state,) or (n_state, N)): b.
+            moment_state (array of shape (n_state,) or (n_state, N)): one column per moment state.
+
+        Returns:
+            array of shape (n_state,) or (n_state, N):
+        """
+        data = np.asarray(data, dtype=np.float64)
+        moment_state = np.asarray(moment_state, dtype=np.float64)
+        offset = np.asarray(offset, dtype=np.float64)
+        batch = np.broadcast_shapes(data.shape[1:], moment_state.shape[1:], offset.shape[1:])
+        if offset.ndim < 1 + len(batch):
+            offset = offset[:, None]
+        result = np.array(np.broadcast_to(offset, (self._n_state,) + batch))
+        # Row by row, which avoids (nnz, N) temporaries and is several times faster than np.add.reduceat.
+        for i, entries, columns in self._rows:
+            if data.ndim == 1:
+                result[i] += data[entries] @ moment_state[columns]
+            elif moment_state.ndim == 1:
+                result[i] += moment_state[columns] @ data[entries]
+            else:
+                result[i] += np.einsum("kn,kn->n", data[entries], moment_state[columns])
+        return result
+
+    def propagate(self, prev_moment_state, disturbance_moments, control_inputs):
+        """ Propagate moment states over one step with a sparse matrix-vector (or matrix-matrix) product.
+
+        Args:
+            prev_moment_state (array of shape (n_state,) or (n_state, N)):
+            disturbance_moments (array of shape (n_disturbance,) or (n_disturbance, N)):
+            control_inputs (array of shape (n_control,) or (n_control, N)): inputs shared by every moment state,
+                or one column per moment state.
+
+        Returns:
+            array of shape (n_state,) or (n_state, N): propagated moment states.
+        """
+        data, offset = self.fill(disturbance_moments, control_inputs)
+        return self.matvec(data, offset, prev_moment_state)
+
+    def dense(self, disturbance_moments, control_inputs):
+        """ A and b as dense arrays, for a single input.
+
+        Returns:
+            array of shape (n_state, n_state): A.
+            array of shape (n_state,): b.
+        """
+        data, offset = self.fill(disturbance_moments, control_inputs)
+        if data.ndim != 1:
+            raise Exception("LinearMomentOperator.dense takes a single input.")
+        matrix = np.zeros(self.shape)
+        rows = np.repeat(np.arange(self._n_state), np.diff(self._indptr))
+        matrix[rows, self._indices] = data
+        return matrix, offset
+
+    def matrix(self, disturbance_moments, control_inputs):
+        """ A as a scipy.sparse.csr_matrix and b, for a single input.
+
+        Raises:
+            Exception: SciPy isn't installed.
+        """
+        try:
+            import scipy.sparse
+        except ImportError:
+            raise Exception("LinearMomentOperator.matrix requires SciPy, use dense or matvec instead.")
+        data, offset = self.fill(disturbance_moments, control_inputs)
+        if data.ndim != 1:
+            raise Exception("LinearMomentOperator.matrix takes a single input.")
+        return scipy.sparse.csr_matrix((data, self._indices, self._indptr), shape=self.shape), offset
+
+    def compose(self, steps, disturbance_moments, control_inputs):
+        """ Affine map of several steps with the same inputs, so that propagating over them is a single
+            product: A^steps and sum_k A^k b, k < steps, computed by repeated squaring.
+
+        Args:
+            steps (int): number of steps.
+            disturbance_moments (array of shape (n_disturbance,)):
+            control_inputs (array of shape (n_control,)):
+
+        Returns:
+            array of shape (n_state, n_state): the matrix of the composed map.
+            array of shape (n_state,): its offset.
+        """
+        matrix, offset = self.dense(disturbance_moments, control_inputs)
+        result_matrix, result_offset = np.eye(self._n_state), np.zeros(self._n_state)
+        while steps:
+            if steps & 1:
+                # Apply the current power after the steps composed so far.
+                result_matrix, result_offset = matrix @ result_matrix, matrix @ result_offset + offset
+            matrix, offset = matrix @ matrix, matrix @ offset + offset
+            steps >>= 1
+        return result_matrix, result_offset
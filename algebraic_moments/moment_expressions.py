@@ -1,91 +1,248 @@
+import copyreg
+import io
+import itertools
+import pickle
+import time
 import sympy as sp
-import numpy as np
-import networkx as nx
-from enum import Enum
 
-from algebraic_moments.objects import Moment, MomentExpressions
+from algebraic_moments.objects import MomentExpressions, MomentRegistry
+from algebraic_moments.sparse_poly import PolynomialRing, SparsePolynomial, product
+from algebraic_moments.cache import cached
+from algebraic_moments.profiling import phase, profiled
 
-def generate_moment_expressions(expressions, random_vector, deterministic_variables):
+def generate_moment_expressions(expressions, random_vector, deterministic_variables, cache=None, lazy=False,
+                                processes=None):
     """[summary]
 
     Args:
         expressions ([type]): [description]
         random_vector ([type]): [description]
         deterministic_variables ([type]): [description]
-        language ([type]): [description]
+        cache (DerivationCache, optional): reuse the result of a previous call with the same inputs. Defaults to None.
+        lazy (bool, optional): If true, each expression is only derived when it is first needed, see
+            MomentExpressions.add_expressions. Lazy results aren't cached. Defaults to False.
+        processes (int, optional): derive the expressions in a pool of this many processes. The result is the same
+            as a serial derivation, see MomentExpressions.derive. Defaults to None.
     """
-    moments = [] # List of generated moments.
-    moment_expressions = dict()
-    for name, exp in expressions.items():
-        moment_expressions[name], new_moments = moment_expression(exp, random_vector, moments)
-        moments += new_moments
-    moment_expressions = MomentExpressions(moment_expressions, moments, random_vector, deterministic_variables)
-    return moment_expressions
+    def derive():
+        moment_expressions = MomentExpressions(dict(), [], random_vector, deterministic_variables)
+        moment_expressions.add_expressions(expressions, lazy=lazy, processes=processes)
+        return moment_expressions
+    if lazy:
+        return derive()
+    return cached(cache, "generate_moment_expressions", [expressions, random_vector, deterministic_variables], derive)
 
+def generate_multi_index_moment_expressions(polynomials, random_vector, deterministic_variables, max_order=None,
+                                            multi_indices=None, cache=None):
+    """ Moment expressions of E[g^alpha] = E[prod_i g_i^alpha_i] for a vector of polynomials g and a set of
+        multi-indices alpha. Every product is expanded once, as the product of a lower order one and a single
+        polynomial, g^alpha = g^(alpha - e_i) * g_i.
+
+    Args:
+        polynomials (dict name -> SymPy expression): elements of g, in the order of the multi-indices.
+        random_vector (RandomVector):
+        deterministic_variables (list of DeterministicVariable):
+        max_order (int, optional): derive every multi-index of total order 1 to max_order.
+        multi_indices (list of tuple of int, optional): derive these multi-indices instead.
+        cache (DerivationCache, optional): reuse the result of a previous call with the same inputs. Defaults to None.
+
+    Raises:
+        Exception: neither or both of max_order and multi_indices are given, or a multi-index has the wrong length
+            or is zero.
+
+    Returns:
+        MomentExpressions: the expression of E[g^alpha] is named after alpha like a moment, e.g. "g1Pow2_g2Pow1",
+            in graded lexicographic order of the multi-indices.
+    """
+    names = list(polynomials)
+    if (max_order is None) == (multi_indices is None):
+        raise Exception("Give either max_order or multi_indices.")
+    if max_order is not None:
+        multi_indices = [multi_index for multi_index in itertools.product(range(max_order + 1), repeat=len(names))
+                         if 0 < sum(multi_index) <= max_order]
+    multi_indices = [tuple(multi_index) for multi_index in multi_indices]
+    if any(len(multi_index) != len(names) for multi_index in multi_indices):
+        raise Exception("Every multi-index should have one element per polynomial.")
+    if any(not any(multi_index) for multi_index in multi_indices):
+        raise Exception("The multi-indices should have a positive total order.")
+    # Graded lexicographic order, so that lower orders are expanded first.
+    multi_indices = sorted(set(multi_indices), key=lambda multi_index: (sum(multi_index), [-k for k in multi_index]))
+
+    def derive():
+        with phase("polynomial_expansion"):
+            ring = PolynomialRing.from_expressions(random_vector.variables, list(polynomials.values()))
+            factors = [ring.from_expr(polynomials[name]) for name in names]
+            expansions = {(0,) * len(names) : ring.constant(1)}
+            def expansion(multi_index):
+                if multi_index not in expansions:
+                    # Peel off a factor whose lower order product is known, or else the last one.
+                    lower = [(i, multi_index[:i] + (power - 1,) + multi_index[i + 1:])
+                             for i, power in enumerate(multi_index) if power]
+                    i, lower_index = next((pair for pair in lower if pair[1] in expansions), lower[-1])
+                    expansions[multi_index] = expansion(lower_index) * factors[i]
+                return expansions[multi_index]
+            expressions = {"_".join(name + "Pow" + str(power) for name, power in zip(names, multi_index) if power) :
+                           expansion(multi_index) for multi_index in multi_indices}
+        moment_expressions = MomentExpressions(dict(), [], random_vector, deterministic_variables)
+        moment_expressions.add_expressions(expressions)
+        return moment_expressions
+    # The order of the polynomials gives the multi-indices their meaning, so it is part of the key.
+    return cached(cache, "generate_multi_index_moment_expressions",
+                  [list(polynomials.items()), random_vector, deterministic_variables, multi_indices], derive)
+
+def polynomial_terms(expression, random_vector):
+    """ Express "expression" as a polynomial in the random vector.
+
+    Args:
+        expression (SymPy expression, SparsePolynomial or sympy.Poly): SymPy expressions are expanded with
+            SparsePolynomial. An instance of sympy.Poly must have the variables of random_vector as generators.
+        random_vector (RandomVector):
+
+    Returns:
+        list of tuples (tuple, SymPy expression): the multi-index and coefficient of each term, in
+            descending lexicographic order of the multi-indices.
+    """
+    if isinstance(expression, sp.Poly):
+        if expression.gens != tuple(random_vector.variables):
+            raise Exception("The generators of the Poly should be the variables of the random vector.")
+        return expression.terms()
+
+    if not isinstance(expression, SparsePolynomial):
+        ring = PolynomialRing.from_expressions(random_vector.variables, [expression])
+        expression = ring.from_expr(expression)
+    elif expression.ring.random_variables != tuple(random_vector.variables):
+        raise Exception("The random variables of the SparsePolynomial should be the variables of the random vector.")
+    ring = expression.ring
+    grouped = expression.random_terms()
+    return [(multi_index, ring.coefficient_expr(grouped[multi_index])) for multi_index in sorted(grouped, reverse=True)]
+
+def _from_args(cls, args):
+    return cls._from_args(args)
+
+def _reduce_from_args(expr):
+    return _from_args, (type(expr), expr.args)
+
+def dumps_expressions(obj):
+    """ Pickle an object that contains SymPy expressions, such that sums and products are rebuilt from their
+        arguments as they are when it is loaded with pickle.loads. By default, Add and Mul sort and combine their
+        arguments again, which makes loading large expressions about 50 times slower than deriving them.
+    """
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[sp.Add] = _reduce_from_args
+    pickler.dispatch_table[sp.Mul] = _reduce_from_args
+    pickler.dump(obj)
+    return buffer.getvalue()
+
+def derive_moment_expression(expression, random_vector):
+    """ Generate a moment expression with a new list of moments, in a worker process of MomentExpressions.derive.
+
+    Returns:
+        bytes: the following, pickled with dumps_expressions:
+            SymPy expression: the moment expression.
+            list of Moment: moments of the expression, in the order of their first use.
+            float: time of the derivation, in seconds.
+    """
+    start = time.perf_counter()
+    expression, moments = moment_expression(expression, random_vector, [])
+    return dumps_expressions((expression, moments, time.perf_counter() - start))
+
+@profiled("moment_expression")
 def moment_expression(expression, random_vector, moments, partial_reduction=None):
     """ Generate a moment expression and add new moments to "moments".
 
     Args:
-        expression ([type]): [description]
+        expression (SymPy expression, SparsePolynomial or sympy.Poly): polynomial in the random vector.
         random_vector ([type]): [description]
-        moments ([type]): [description]
+        moments (MomentRegistry or list of Moment): moments that are already known. A MomentRegistry is
+            updated in place with the new moments, a list is left unchanged.
         partial_reduction (set or None): set of variables that we want to reduce. If None, then reduce everything.
+            Known moments of variables annotated in random_vector.distributions are substituted, and terms in
+            which they vanish are dropped.
     Raises:
         Exception: [description]
 
     Returns:
         [type]: [description]
     """
+    if isinstance(moments, list):
+        moments = MomentRegistry(random_vector, moments)
+
     # Express "expression" as a polynomial in the random vector.
-    raw_polynomial = sp.poly(expression, random_vector.variables)
+    with phase("polynomial_expansion"):
+        raw_terms = polynomial_terms(expression, random_vector)
+
+    # Variables are factored as bitmasks: bit i of a mask is element i of a multi-index.
+    dependence_graph = random_vector.dependence_graph
+    if partial_reduction:
+        reduction_mask = dependence_graph.support_mask(partial_reduction)
 
     # List of terms.
     terms = []
 
     # New moments that are generated.
     new_moments = []
-    for multi_index, coeff in raw_polynomial.terms():
-        # Go through each term of the raw_polynomial to group coefficients and factor
-        # moments.
 
-        # Get the variable power map of this term
-        term_vpm = random_vector.vpm(multi_index)
+    def lookup(comp_multi_index):
+        # Find a moment for this component in moments. If one doesn't exist,
+        # create a new one.
+        with phase("moment_lookup"):
+            if moments.random_vector is random_vector:
+                moment, is_new = moments.intern_multi_idx(comp_multi_index)
+            else:
+                moment, is_new = moments.intern(random_vector.vpm(comp_multi_index))
+        if is_new:
+            new_moments.append(moment)
+        return moment
+
+    # Moments of annotated variables are substituted, see Distribution.
+    distributions = random_vector.distributions
+    def moment_of(var, power):
+        value = distributions[var].moment(var, power, moment_of) if var in distributions else None
+        return value if value is not None else lookup(random_vector.multi_idx({var : power}))
+
+    for multi_index, coeff in raw_terms:
+        # Go through each term of the raw polynomial to group coefficients and factor
+        # moments.
 
         # Factor everything based off independence.
-        components = random_vector.dependence_graph.subgraph_components(list(term_vpm.keys()))
+        with phase("factorization"):
+            support = random_vector.support_mask(multi_index)
+            components = dependence_graph.mask_components(support)
 
-        if partial_reduction:
-            # The components that are a subset of the partial reduction.
-            factored_components = [comp for comp in components if set(comp).issubset(partial_reduction)]
+            if partial_reduction:
+                # The components that are a subset of the partial reduction.
+                factored_components = [comp for comp in components if comp & ~reduction_mask == 0]
 
-            # The components that are not a subset of the partial reduction are grouped together.
-            leftover_component = [comp for comp in components if comp not in factored_components]
-            lumped_component = [{var for comp in leftover_component for var in comp}]
-            components = factored_components + lumped_component
-            components = [comp for comp in components if len(comp)>0]
+                # The components that are not a subset of the partial reduction are grouped together.
+                lumped_component = support
+                for comp in factored_components:
+                    lumped_component &= ~comp
+                components = factored_components + [lumped_component]
+                components = [comp for comp in components if comp]
 
-        # print("factored_components: " + str(factored_components))
-        # print("lumped_component: " + str(lumped_component))
-        # The idea is to express this term as ceoff * np.prod([term_moments])
-        term_moments = []
+        # The idea is to express this term as ceoff * prod(term_moments) * known, where known is the product
+        # of the substituted moments of annotated variables. They are substituted first, so that no moment
+        # is registered for a term that vanishes.
+        known = sp.S.One
+        unknown_components = []
         for comp in components:
-            # Construct the variable power mapping for this component.
-            comp_vpm = {var : term_vpm[var] for var in comp}
-            
-            # Find a moment for this component in moments. If one doesn't exist,
-            # create a new one.
-            all_moments = moments + new_moments
-            equivalent_moments = [m for m in all_moments if m.same_vpm(comp_vpm)]
-
-            if len(equivalent_moments)==0:
-                moment = Moment(comp_vpm)
-                new_moments.append(moment)
-            elif len(equivalent_moments)==1:
-                moment = equivalent_moments[0]
+            var = random_vector.variables[comp.bit_length() - 1]
+            if comp & (comp - 1) == 0 and var in distributions:
+                known *= moment_of(var, multi_index[comp.bit_length() - 1])
+                if known == 0:
+                    break
             else:
-                raise Exception("Found two instances of Moment in the set 'moments' that match comp_vpm.\
-                                 This is an issue because the elements in 'moments' should be unique.")
-            
-            term_moments.append(moment)
-        terms.append(coeff * np.prod(term_moments))
-    return sum(terms), new_moments
\ No newline at end of file
+                unknown_components.append(comp)
+        if known == 0:
+            continue
+
+        term_moments = []
+        for comp in unknown_components:
+            # Construct the multi-index for this component.
+            comp_multi_index = random_vector.restrict(multi_index, comp)
+            term_moments.append(lookup(comp_multi_index))
+        term = product(coeff, term_moments)
+        terms.append(term if known == 1 else sp.expand(known * term))
+    return sp.Add(*terms), new_moments
\ No newline at end of file
@@ -0,0 +1,232 @@
+""" Building and loading generated C code. This module only depends on NumPy and the standard library.
+"""
+import ctypes
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+
+def cache_directory(subdirectory):
+    """ Directory for cached artifacts. The root is $ALGEBRAIC_MOMENTS_CACHE_DIR if it is set, and
+        ~/.cache/algebraic_moments otherwise.
+
+    Args:
+        subdirectory (str): name of the subdirectory for a given type of artifact.
+
+    Returns:
+        str: path of the (created) directory.
+    """
+    root = os.environ.get("ALGEBRAIC_MOMENTS_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "algebraic_moments"))
+    directory = os.path.join(root, subdirectory)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def build_shared_library(source, build_directory=None, compiler=None, flags=("-O2",)):
+    """ Compile C source into a shared library. Libraries are named by a hash of the source, compiler and
+        flags, so a source that was already built is not rebuilt.
+
+    Args:
+        source (str): C source code.
+        build_directory (str, optional): where to put the library. Defaults to cache_directory("native").
+        compiler (str, optional): C compiler. Defaults to $CC, or "cc" if it isn't set.
+        flags (tuple of str, optional): extra compiler flags. Defaults to ("-O2",).
+
+    Raises:
+        Exception: the compiler could not be found or the compilation failed.
+
+    Returns:
+        str: path of the shared library.
+    """
+    compiler = compiler or os.environ.get("CC", "cc")
+    if shutil.which(compiler) is None:
+        raise Exception("Could not find the C compiler " + str(compiler) + ".")
+    build_directory = build_directory or cache_directory("native")
+    os.makedirs(build_directory, exist_ok=True)
+
+    digest = hashlib.sha256("\n".join([source, compiler] + list(flags)).encode()).hexdigest()[:24]
+    library_path = os.path.join(build_directory, "libmoments_" + digest + ".so")
+    if os.path.exists(library_path):
+        return library_path
+
+    with tempfile.TemporaryDirectory(dir=build_directory) as tmp:
+        source_path = os.path.join(tmp, "moments.c")
+        with open(source_path, "w") as f:
+            f.write(source)
+        tmp_library_path = os.path.join(tmp, "moments.so")
+        command = [compiler] + list(flags) + ["-shared", "-fPIC", "-o", tmp_library_path, source_path, "-lm"]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise Exception("Compilation of generated code failed:\n" + result.stderr)
+        # Rename into place so that concurrent builds never load a partially written library.
+        os.replace(tmp_library_path, library_path)
+    return library_path
+
+def _strided_rows(array, rows, n, name):
+    """ Broadcast array to shape (rows, n) and return it with its strides in elements.
+        One dimensional arrays of length rows are shared by all n columns.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    if array.ndim == 1:
+        array = array[:, None]
+    if array.ndim != 2 or array.shape[0] != rows:
+        raise Exception(name + " should have " + str(rows) + " rows, but has shape " + str(array.shape) + ".")
+    array = np.broadcast_to(array, (rows, n))
+    if any(stride % array.itemsize for stride in array.strides):
+        array = np.ascontiguousarray(array)
+    return array, array.strides[0] // array.itemsize, array.strides[1] // array.itemsize
+
+def horizon_arrays(initial_moment_state, control_inputs, disturbance_moments, n_state, n_control, n_disturbance, out=None):
+    """ Check and broadcast the inputs of a horizon propagation to arrays of shape (T, rows, N), where T
+        is the number of steps and N the number of trajectories.
+
+    Args:
+        initial_moment_state (array of shape (n_state,) or (n_state, N)):
+        control_inputs (array of shape (T, n_control) or (T, n_control, N)): control inputs of each step.
+        disturbance_moments (array of shape (n_disturbance,), (T, n_disturbance) or (T, n_disturbance, N)):
+            disturbance moments, constant or of each step.
+        out (array of shape (T, n_state) or (T, n_state, N), optional): trajectory buffer.
+
+    Returns:
+        tuple of arrays: initial moment state of shape (1, n_state, N), control inputs, disturbance moments and
+            trajectory of shape (T, n_state, N). The trajectory is a view of the returned buffer.
+        array: trajectory buffer of shape (T, n_state) or (T, n_state, N), which is out if it is given.
+    """
+    initial_moment_state = np.asarray(initial_moment_state, dtype=np.float64)
+    if initial_moment_state.ndim not in [1, 2] or initial_moment_state.shape[0] != n_state:
+        raise Exception("initial_moment_state should have " + str(n_state) + " rows, but has shape " +
+                        str(initial_moment_state.shape) + ".")
+    batch = initial_moment_state.shape[1:]
+    n = batch[0] if batch else 1
+    initial_moment_state = initial_moment_state.reshape((1, n_state, n))
+
+    control_inputs = np.asarray(control_inputs, dtype=np.float64)
+    if control_inputs.ndim == 2:
+        control_inputs = control_inputs[:, :, None]
+    if control_inputs.ndim != 3 or control_inputs.shape[1] != n_control:
+        raise Exception("control_inputs should have shape (T, " + str(n_control) + ") or (T, " + str(n_control) +
+                        ", N), but has shape " + str(control_inputs.shape) + ".")
+    horizon = control_inputs.shape[0]
+    control_inputs = np.broadcast_to(control_inputs, (horizon, n_control, n))
+
+    disturbance_moments = np.asarray(disturbance_moments, dtype=np.float64)
+    if disturbance_moments.ndim == 1:
+        disturbance_moments = disturbance_moments[None, :, None]
+    elif disturbance_moments.ndim == 2:
+        disturbance_moments = disturbance_moments[:, :, None]
+    if disturbance_moments.ndim != 3 or disturbance_moments.shape[1] != n_disturbance:
+        raise Exception("disturbance_moments should have " + str(n_disturbance) + " columns, but has shape " +
+                        str(disturbance_moments.shape) + ".")
+    disturbance_moments = np.broadcast_to(disturbance_moments, (horizon, n_disturbance, n))
+
+    shape = (horizon, n_state) + batch
+    if out is None:
+        out = np.empty(shape)
+    if out.dtype != np.float64 or out.shape != shape or not out.flags.writeable:
+        raise Exception("out should be a writeable float64 array of shape " + str(shape) + ".")
+    trajectory = out if batch else out[:, :, None]
+    return (initial_moment_state, control_inputs, disturbance_moments, trajectory), out
+
+def _strided_steps(array):
+    """ Return a (T, rows, N) array with its strides in elements, copying it if they aren't whole elements.
+    """
+    if any(stride % array.itemsize for stride in array.strides):
+        array = np.ascontiguousarray(array)
+    return (array,) + tuple(stride // array.itemsize for stride in array.strides)
+
+class NativePropagator(object):
+    """ Python callable for the PropagateMomentsBatch function generated by
+        MomentStateDynamicalSystem.batch_c_source.
+    """
+    _double_p = ctypes.POINTER(ctypes.c_double)
+
+    def __init__(self, library_path, n_state, n_disturbance, n_control, function_name="PropagateMomentsBatch"):
+        self._library = ctypes.CDLL(library_path)
+        self._function = getattr(self._library, function_name)
+        strided = [self._double_p, ctypes.c_long, ctypes.c_long]
+        self._function.argtypes = [ctypes.c_long] + strided * 4
+        self._function.restype = None
+        # Libraries built before the horizon function was generated only have the batch function.
+        self._horizon_function = getattr(self._library, "PropagateMomentsHorizon", None)
+        if self._horizon_function is not None:
+            self._horizon_function.argtypes = [ctypes.c_long, ctypes.c_long] + strided + \
+                                              ([self._double_p] + [ctypes.c_long] * 3) * 3
+            self._horizon_function.restype = None
+        self._n_state = n_state
+        self._n_disturbance = n_disturbance
+        self._n_control = n_control
+
+    @property
+    def library_path(self):
+        return self._library._name
+
+    def __call__(self, prev_moment_state, disturbance_moments, control_inputs, out=None):
+        """ Propagate a batch of moment states over one step.
+
+        Args:
+            prev_moment_state (array of shape (n_state, N)): one column per moment state, rows in the
+                order of MomentStateDynamicalSystem.moment_state.
+            disturbance_moments (array of shape (n_disturbance, N) or (n_disturbance,)): rows in the order of
+                MomentStateDynamicalSystem.disturbance_moments. A one dimensional array is shared by all states.
+            control_inputs (array of shape (n_control, N) or (n_control,)): rows in the order of
+                MomentStateDynamicalSystem.control_variables. A one dimensional array is shared by all states.
+            out (array of shape (n_state, N), optional): output buffer, which may be prev_moment_state itself.
+
+        Returns:
+            array of shape (n_state, N): propagated moment states.
+        """
+        prev_moment_state = np.asarray(prev_moment_state, dtype=np.float64)
+        if prev_moment_state.ndim != 2:
+            raise Exception("prev_moment_state should be a two dimensional array.")
+        n = prev_moment_state.shape[1]
+        prev, prev_row, prev_col = _strided_rows(prev_moment_state, self._n_state, n, "prev_moment_state")
+        dist, dist_row, dist_col = _strided_rows(disturbance_moments, self._n_disturbance, n, "disturbance_moments")
+        ctrl, ctrl_row, ctrl_col = _strided_rows(control_inputs, self._n_control, n, "control_inputs")
+
+        if out is None:
+            out = np.empty((self._n_state, n))
+        if out.dtype != np.float64 or out.shape != (self._n_state, n) or not out.flags.writeable \
+                or any(stride % out.itemsize for stride in out.strides):
+            raise Exception("out should be a writeable float64 array of shape " + str((self._n_state, n)) + ".")
+
+        self._function(n,
+                       prev.ctypes.data_as(self._double_p), prev_row, prev_col,
+                       dist.ctypes.data_as(self._double_p), dist_row, dist_col,
+                       ctrl.ctypes.data_as(self._double_p), ctrl_row, ctrl_col,
+                       out.ctypes.data_as(self._double_p), out.strides[0] // out.itemsize, out.strides[1] // out.itemsize)
+        return out
+
+    def horizon(self, initial_moment_state, control_inputs, disturbance_moments, out=None):
+        """ Propagate moment states over a horizon of T steps in a single call.
+
+        Args:
+            initial_moment_state (array of shape (n_state,) or (n_state, N)): moment state before the first step.
+            control_inputs (array of shape (T, n_control) or (T, n_control, N)): control inputs of each step.
+            disturbance_moments (array of shape (n_disturbance,), (T, n_disturbance) or (T, n_disturbance, N)):
+                disturbance moments, constant or of each step.
+            out (array of shape (T, n_state) or (T, n_state, N), optional): trajectory buffer, whose row t is
+                the moment state after step t.
+
+        Returns:
+            array of shape (T, n_state) or (T, n_state, N): the trajectory.
+        """
+        if self._horizon_function is None:
+            raise Exception("The library " + self.library_path + " doesn't have a horizon function.")
+        arrays, out = horizon_arrays(initial_moment_state, control_inputs, disturbance_moments, self._n_state,
+                                     self._n_control, self._n_disturbance, out)
+        initial, controls, disturbances, trajectory = arrays
+        initial, _, init_row, init_col = _strided_steps(initial)
+        ctrl, ctrl_step, ctrl_row, ctrl_col = _strided_steps(controls)
+        dist, dist_step, dist_row, dist_col = _strided_steps(disturbances)
+        if any(stride % trajectory.itemsize for stride in trajectory.strides):
+            raise Exception("out should have strides that are multiples of its item size.")
+        out_step, out_row, out_col = [stride // trajectory.itemsize for stride in trajectory.strides]
+
+        self._horizon_function(trajectory.shape[0], trajectory.shape[2],
+                               initial.ctypes.data_as(self._double_p), init_row, init_col,
+                               ctrl.ctypes.data_as(self._double_p), ctrl_step, ctrl_row, ctrl_col,
+                               dist.ctypes.data_as(self._double_p), dist_step, dist_row, dist_col,
+                               trajectory.ctypes.data_as(self._double_p), out_step, out_row, out_col)
+        return out
@@ -1,33 +1,69 @@
+import itertools
+import math
+import pickle
+import time
 import sympy as sp
+import numpy as np
 from sympy.printing import octave_code
 from sympy.printing.pycode import pycode
 from sympy.printing.ccode import ccode
-import networkx as nx
 from enum import Enum
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from algebraic_moments.native import build_shared_library, NativePropagator
+from algebraic_moments.linear_operator import LinearMomentOperator
+from algebraic_moments.runtime.artifacts import compile_function, evaluate_ranked, propagate_horizon, make_artifact, \
+    save_artifact
+from algebraic_moments.codegen import prepare_expressions, numpy_code
+from algebraic_moments.sparse_poly import PolynomialRing
+from algebraic_moments.profiling import ExpansionStats, active_stats, count_terms, profiled
+from algebraic_moments.derivatives import SparseJacobian, sparse_jacobian, chain_gradients
 
 class ConcentrationInequalityType(Enum):
     CANTELLI = 0
     VP = 1
     GAUSS = 2
 
+BoundEvaluation = namedtuple("BoundEvaluation", ["types", "probability_bounds", "necessary_conditions", "valid",
+                                                 "best_bound", "best_type"])
+
 class ConcentrationInequality(object):
     def __init__(self, moment_expressions, inequality_type):
         self._moment_expressions = moment_expressions
         self._type = inequality_type
 
+    @property
+    def moment_expressions(self):
+        return self._moment_expressions
+
+    @property
+    def inequality_type(self):
+        return self._type
+
     def build_expressions(self):
+        return self.type_expressions(self._type)
+
+    @staticmethod
+    def type_expressions(inequality_type):
+        """ Probability bound and necessary condition of a type of inequality, as expressions of the symbols
+            first_moment and variance.
+
+        Returns:
+            SymPy expression: probability_bound.
+            SymPy expression: necessary_condition, the bound only holds if it is <= 0.
+        """
         first_moment = sp.Symbol("first_moment")
         variance = sp.Symbol("variance")
 
-        if self._type == ConcentrationInequalityType.CANTELLI:
+        if inequality_type == ConcentrationInequalityType.CANTELLI:
             bound_expr = variance/(variance + first_moment**2)
             condition_expr = -first_moment
 
-        elif self._type == ConcentrationInequalityType.VP:
+        elif inequality_type == ConcentrationInequalityType.VP:
             bound_expr = (4.0/9.0) * variance/(variance + first_moment**2)
             condition_expr = -first_moment + (5.0*variance/3.0)**0.5
 
-        elif self._type == ConcentrationInequalityType.GAUSS:
+        elif inequality_type == ConcentrationInequalityType.GAUSS:
             bound_expr = (2.0/9.0) * (variance/first_moment**2)
             condition_expr = -first_moment + (2.0/3.0) * (variance)**0.5
         else:
@@ -35,70 +71,534 @@ class ConcentrationInequality(object):
             
         return bound_expr, condition_expr
 
-    def print_python(self):
+    def gradients(self):
+        """ Sparse gradients of probability_bound and necessary_condition with respect to the input moments and
+            the deterministic variables. The entries are expressions of first_moment and variance, which the
+            printers assign first, and of the inputs.
+
+        Returns:
+            SparseJacobian: one row for probability_bound and one for necessary_condition.
+        """
         bound_expr, condition_expr = self.build_expressions()
-        self._moment_expressions.print_python()
+        moments = self._moment_expressions.jacobian()
+        first_moment = sp.Symbol("first_moment")
+        variance = sp.Symbol("variance")
+
+        # Jacobian of (first_moment, variance), where variance = second_moment - first_moment**2.
+        rows = {name : row for row, name in enumerate(moments.outputs)}
+        entries = dict()
+        for (row, col), expr in moments.entries.items():
+            if row == rows["first_moment"]:
+                entries[(0, col)] = expr
+                entries[(1, col)] = entries.get((1, col), 0) - 2 * first_moment * expr
+            elif row == rows["second_moment"]:
+                entries[(1, col)] = entries.get((1, col), 0) + expr
+        entries = {key : entries[key] for key in sorted(entries) if entries[key] != 0}
+        inner = SparseJacobian([first_moment, variance], moments.variables, entries)
+        return chain_gradients({"probability_bound" : bound_expr, "necessary_condition" : condition_expr}, inner)
+
+    @staticmethod
+    def bounds_from_moments(first_moment, second_moment, types=None):
+        """ Evaluate several types of inequality from the same first and second moments of the constraint.
+
+        Args:
+            first_moment (float or array): E[g].
+            second_moment (float or array of the same shape): E[g^2].
+            types (list of ConcentrationInequalityType, optional): Defaults to every type.
+
+        Returns:
+            BoundEvaluation: probability_bounds, necessary_conditions and valid have a row per type, followed by
+                the shape of the moments. valid is false where the necessary condition fails or the bound isn't a
+                finite number, e.g. because the moments are inconsistent. best_bound is the tightest valid bound,
+                or the trivial bound 1 where none is valid, and best_type is the index in types of the tightest
+                valid bound, or -1.
+        """
+        types = list(types) if types is not None else list(ConcentrationInequalityType)
+        first_moment = np.asarray(first_moment, dtype=np.float64)
+        second_moment = np.asarray(second_moment, dtype=np.float64)
+        shape = np.broadcast_shapes(first_moment.shape, second_moment.shape)
+        variance = second_moment - first_moment**2
+
+        bounds = np.empty((len(types),) + shape)
+        conditions = np.empty((len(types),) + shape)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i, inequality_type in enumerate(types):
+                bounds[i], conditions[i] = _bound_function(inequality_type)(first_moment, variance)
+        valid = (conditions <= 0) & np.isfinite(bounds) & (variance >= 0)
+
+        candidates = np.where(valid, bounds, np.inf)
+        best_type = np.argmin(candidates, axis=0) if types else np.zeros(shape, dtype=np.intp)
+        best_bound = np.take_along_axis(candidates, best_type[None], axis=0)[0] if types else np.full(shape, np.inf)
+        none_valid = ~np.any(valid, axis=0)
+        best_type = np.where(none_valid, -1, best_type)
+        best_bound = np.where(none_valid, 1.0, np.minimum(best_bound, 1.0))
+        return BoundEvaluation(types, bounds, conditions, valid, best_bound, best_type)
+
+    def evaluate_bounds(self, input_moments, input_deterministic, types=None, multi_idx_keys=False):
+        """ Evaluate every type of inequality for a batch of inputs, computing the moments of the constraint
+            once. The inputs are the same as MomentExpressions.evaluate_batch.
+
+        Args:
+            types (list of ConcentrationInequalityType, optional): Defaults to every type.
+
+        Returns:
+            BoundEvaluation: see bounds_from_moments.
+        """
+        moments = self._moment_expressions.evaluate_batch(input_moments, input_deterministic, multi_idx_keys)
+        return self.bounds_from_moments(moments["first_moment"], moments["second_moment"], types)
+
+    def evaluate_bounds_ranked(self, moment_vector, deterministic, types=None):
+        """ Evaluate every type of inequality from flat arrays. The inputs are the same as
+            MomentExpressions.evaluate_ranked.
+
+        Returns:
+            BoundEvaluation: see bounds_from_moments.
+        """
+        names = list(self._moment_expressions.moment_expressions)
+        moments = self._moment_expressions.evaluate_ranked(moment_vector, deterministic)
+        return self.bounds_from_moments(moments[names.index("first_moment")], moments[names.index("second_moment")],
+                                        types)
+
+    def _prepare_gradients(self, cse, horner=False):
+        """ Apply prepare_expressions to the entries of the gradients, keyed by (output, variable).
+        """
+        gradients = self.gradients()
+        horner = self._moment_expressions.deterministic_variables if horner else None
+        return prepare_expressions(gradients.named_entries(), cse, prefix="dcse", horner=horner)
+
+    @profiled("printing")
+    def print_python(self, cse=False, gradients=False, horner=False):
+        """ Print python code.
+
+        Args:
+            cse (bool, optional): eliminate common subexpressions. Defaults to False.
+            gradients (bool, optional): also print the nonzero entries of the gradients of probability_bound and
+                necessary_condition as dicts keyed by the names of the inputs. Defaults to False.
+            horner (bool, optional): nest the expressions in Horner form in the deterministic variables.
+                Defaults to False.
+        """
+        bound_expr, condition_expr = self.build_expressions()
+        self._moment_expressions.print_python(cse=cse, horner=horner)
         print("\n# Establish the probability bound.")
         print("# We need necessary_condition<=0 for this bound to hold.")
         print("variance = second_moment - first_moment**2")
         print("probability_bound = " + str(bound_expr))
         print("necessary_condition = " + str(condition_expr))
+        if gradients:
+            temporaries, entries, report = self._prepare_gradients(cse, horner)
+            print("\n# Gradients, keyed by the names of the input moments and deterministic variables.")
+            if temporaries:
+                print("# Common subexpressions. " + report)
+                for temp, expr in temporaries:
+                    print(str(temp) + " = " + pycode(expr))
+            elif report:
+                print("# " + report)
+            print("probability_bound_gradient = dict()")
+            print("necessary_condition_gradient = dict()")
+            for (output, var), expr in entries.items():
+                print(output + "_gradient[\"" + str(var) + "\"] = " + pycode(expr))
     
-    def print_matlab(self):
-        return self.print_octave()
+    @profiled("printing")
+    def print_matlab(self, cse=False, gradients=False, horner=False):
+        return self.print_octave(cse=cse, gradients=gradients, horner=horner)
+
+    @profiled("printing")
+    def print_octave(self, cse=False, gradients=False, horner=False):
+        """ Print octave code.
 
-    def print_octave(self):
+        Args:
+            cse (bool, optional): eliminate common subexpressions. Defaults to False.
+            gradients (bool, optional): also print the nonzero entries of the gradients of probability_bound and
+                necessary_condition as structs with a field per input. Defaults to False.
+            horner (bool, optional): nest the expressions in Horner form in the deterministic variables.
+                Defaults to False.
+        """
         bound_expr, condition_expr = self.build_expressions()
-        self._moment_expressions.print_octave()
+        self._moment_expressions.print_octave(cse=cse, horner=horner)
         print("\n% Establish the probability bound.")
         print("% We need necessary_condition<=0 for this bound to hold.")
         print("variance = second_moment - first_moment.^2;")
         print(octave_code(bound_expr, assign_to="probability_bound"))
         print(octave_code(condition_expr, assign_to="necessary_condition"))
-
+        if gradients:
+            temporaries, entries, report = self._prepare_gradients(cse, horner)
+            print("\n% Gradients, with a field per input moment and deterministic variable.")
+            if temporaries:
+                print("% Common subexpressions. " + report)
+                for temp, expr in temporaries:
+                    print(octave_code(expr, assign_to=str(temp)))
+            elif report:
+                print("% " + report)
+            print("probability_bound_gradient = struct();")
+            print("necessary_condition_gradient = struct();")
+            for (output, var), expr in entries.items():
+                print(octave_code(expr, assign_to=output + "_gradient." + str(var)))
+
+
+_bound_functions = dict() # ConcentrationInequalityType -> NumPy function of (first_moment, variance).
+
+def _bound_function(inequality_type):
+    if inequality_type not in _bound_functions:
+        expressions = ConcentrationInequality.type_expressions(inequality_type)
+        _bound_functions[inequality_type] = sp.lambdify([sp.Symbol("first_moment"), sp.Symbol("variance")],
+                                                        list(expressions), modules="numpy")
+    return _bound_functions[inequality_type]
 
 class MomentExpressions(object):
     def __init__(self, moment_expressions, moments, random_vector, deterministic_variables):
-        self._moment_expressions = moment_expressions
-        self._moments = moments
+        """ Moment expressions and the input moments they require. More expressions can be added with
+            add_expressions, and are derived when they are first needed.
+
+        Args:
+            moment_expressions (dict name -> SymPy expression): derived expressions.
+            moments (list of Moment): required input moments, in the order of their first use.
+            random_vector (RandomVector):
+            deterministic_variables (list of DeterministicVariable):
+        """
+        self._moment_expressions = dict(moment_expressions)
+        self._moments = list(moments)
         self._random_vector = random_vector
         self._deterministic_variables = deterministic_variables
+        self._names = list(self._moment_expressions) # Names of every expression, in the order they were added.
+        self._pending = dict() # Name -> expression that was added but isn't derived yet.
+        self._introduced = dict() # Name -> new input moments introduced by the derivation of the expression.
+        self._registry = None # MomentRegistry of self._moments, built by the first derivation.
+        self._compiled = dict() # multi_idx_keys -> function returned by compile_numpy, "ranked" -> (compile_ranked, size).
+
+    def __getstate__(self):
+        # Compiled functions can't be pickled, they are rebuilt on demand, as is the registry.
+        state = self.__dict__.copy()
+        state["_compiled"] = dict()
+        state["_registry"] = None
+        return state
 
     @property
     def moment_expressions(self):
+        """ dict name -> SymPy expression: every expression, in the order they were added. Pending expressions
+            are derived first.
+        """
+        self.derive()
         return self._moment_expressions
 
-    def print_python(self, multi_idx_keys = False):
+    @property
+    def moments(self):
+        """ list of Moment: required input moments of every expression, in the order of their first use.
+            Pending expressions are derived first.
+        """
+        self.derive()
+        return self._moments
+
+    @property
+    def pending(self):
+        """ list of str: names of the expressions that were added lazily and aren't derived yet.
+        """
+        return list(self._pending)
+
+    @property
+    def introduced_moments(self):
+        """ dict name -> list of Moment: input moments that were first required by each expression added with
+            add_expressions, once it is derived.
+        """
+        return self._introduced
+
+    def add_expressions(self, expressions, lazy=False, processes=None):
+        """ Add named expressions without deriving the existing ones again. Their moments are looked up among the
+            required input moments, so only the moments that no previous expression requires are new.
+
+        Args:
+            expressions (dict name -> SymPy expression): polynomials in the random vector, with coefficients in
+                the deterministic variables.
+            lazy (bool, optional): If true, the expressions are only derived when they are first needed, e.g. by
+                moment_expressions, expression or an evaluator. Defaults to False.
+            processes (int, optional): derive the expressions in a pool of this many processes, see derive.
+                Defaults to None.
+
+        Raises:
+            Exception: a name is already used.
+
+        Returns:
+            list of Moment: input moments introduced by the expressions, in the order of their first use. Empty
+                if lazy, see derive and introduced_moments.
+        """
+        for name in expressions:
+            if name in self._moment_expressions or name in self._pending:
+                raise Exception("MomentExpressions already has an expression named " + str(name) + ".")
+        self._pending.update(expressions)
+        self._names += list(expressions)
+        return [] if lazy else self.derive(list(expressions), processes)
+
+    def derive(self, names=None, processes=None):
+        """ Derive pending expressions.
+
+        Args:
+            names (list of str, optional): expressions to derive. Those that are already derived are skipped.
+                Defaults to every pending expression.
+            processes (int, optional): derive the expressions in a pool of this many processes. Each process
+                derives an expression with its own list of moments, and the moments are then merged in the
+                order of the expressions, so the result is the same as a serial derivation. Defaults to None,
+                which derives the expressions one after another in this process.
+
+        Returns:
+            list of Moment: input moments introduced by the derivations, in the order of their first use.
+        """
+        names = list(self._pending) if names is None else [name for name in names if name in self._pending]
+        if not names:
+            return []
+        # moment_expressions imports this module.
+        from algebraic_moments.moment_expressions import moment_expression, derive_moment_expression
+        if self._registry is None:
+            self._registry = MomentRegistry(self._random_vector, self._moments)
+        results = None
+        if processes is not None and processes > 1 and len(names) > 1:
+            with ProcessPoolExecutor(min(processes, len(names))) as executor:
+                results = list(executor.map(derive_moment_expression, [self._pending[name] for name in names],
+                                            itertools.repeat(self._random_vector)))
+        stats = active_stats()
+        new_moments = []
+        for k, name in enumerate(names):
+            start = time.perf_counter()
+            if results is None:
+                expression, self._introduced[name] = moment_expression(self._pending.pop(name), self._random_vector,
+                                                                       self._registry)
+                seconds = time.perf_counter() - start
+            else:
+                # Moments are only new if no previous expression requires them. The moments of the
+                # expression are in the order of their first use, so the new ones are in the serial order.
+                del self._pending[name]
+                expression, moments, seconds = pickle.loads(results[k])
+                self._introduced[name] = [moment for moment in moments if moment not in self._registry]
+                for moment in self._introduced[name]:
+                    self._registry.add(moment)
+            self._moment_expressions[name] = expression
+            new_moments += self._introduced[name]
+            if stats is not None:
+                stats.record_expression(name, ExpansionStats(seconds, count_terms(expression),
+                                                             len(self._introduced[name]), 0))
+        self._moment_expressions = {name : self._moment_expressions[name] for name in self._names
+                                    if name in self._moment_expressions}
+        self._moments = self._moments + new_moments
+        # The compiled evaluators don't have the new expressions.
+        self._compiled = dict()
+        return new_moments
+
+    def expression(self, name):
+        """ The expression named name, which is derived if it is pending. Other pending expressions aren't.
+        """
+        self.derive([name])
+        return self._moment_expressions[name]
+
+    @property
+    def deterministic_variables(self):
+        return self._deterministic_variables
+
+    def _prepare_expressions(self, cse, horner):
+        """ Apply prepare_expressions to the moment expressions, in Horner form in the deterministic variables
+            if horner is true.
+        """
+        self.derive()
+        return prepare_expressions(self._moment_expressions, cse,
+                                   horner=self._deterministic_variables if horner else None)
+
+    def input_moment_key(self, moment, multi_idx_keys=False, rank_keys=False):
+        """ Key of a moment in input_moments.
+
+        Args:
+            moment (Moment): a required input moment.
+            multi_idx_keys (bool, optional): If true, the key is the multi-index of the moment. Defaults to False.
+            rank_keys (bool, optional): If true, the key is the graded lexicographic rank of the moment, see
+                RandomVector.rank. Defaults to False.
+        """
+        if rank_keys:
+            return self._random_vector.rank(self._random_vector.multi_idx(moment.vpm))
+        elif multi_idx_keys:
+            return self._random_vector.multi_idx(moment.vpm)
+        else:
+            return str(moment)
+
+    def moment_ranks(self):
+        """
+        Returns:
+            list of int: ranks of the required input moments, in the order of their first use.
+        """
+        self.derive()
+        return [self.input_moment_key(moment, rank_keys=True) for moment in self._moments]
+
+    def moment_vector_size(self):
+        """ Length of the smallest moment vector, indexed by rank, that contains every required input moment.
+        """
+        return max(self.moment_ranks(), default=-1) + 1
+
+    def ranked_python_source(self, cse=False, horner=False):
+        """ Generate Python code for evaluate(moment_vector, deterministic, out), which reads the input moments
+            from moment_vector[rank], the deterministic variables from deterministic[i] in the order of the
+            deterministic variables, and writes expression i, in the order of moment_expressions, to out[i].
+            The function runs on lists of floats as well as on NumPy arrays with trailing batch dimensions.
+        """
+        temporaries, expressions, _ = self._prepare_expressions(cse, horner)
+        code = "def evaluate(moment_vector, deterministic, out):\n"
+        for moment, rank in zip(self._moments, self.moment_ranks()):
+            code += "    " + str(moment) + " = moment_vector[" + str(rank) + "]\n"
+        for i, det_var in enumerate(self._deterministic_variables):
+            code += "    " + str(det_var) + " = deterministic[" + str(i) + "]\n"
+        for temp, expr in temporaries:
+            code += "    " + str(temp) + " = " + numpy_code(expr) + "\n"
+        for i, name in enumerate(self._moment_expressions):
+            code += "    out[" + str(i) + "] = " + numpy_code(expressions[name]) + "\n"
+        code += "    return out\n"
+        return code
+
+    def compile_ranked(self, cse=False, horner=False):
+        """ Compile ranked_python_source.
+
+        Returns:
+            function: evaluate(moment_vector, deterministic, out).
+        """
+        return compile_function(self.ranked_python_source(cse, horner), "evaluate", "<evaluate_ranked>")
+
+    def evaluate_ranked(self, moment_vector, deterministic, out=None):
+        """ Evaluate every moment expression from flat arrays, without building dicts of names.
+
+        Args:
+            moment_vector (array of shape (R,) or (R, N)): moments indexed by rank, with R at least
+                moment_vector_size(). Entries that aren't required are ignored.
+            deterministic (array of shape (n_deterministic,) or (n_deterministic, N)): deterministic variables
+                in the order they were given.
+            out (array of shape (n_expressions,) or (n_expressions, N), optional): output buffer.
+
+        Returns:
+            array of shape (n_expressions,) or (n_expressions, N): expressions in the order of moment_expressions.
+        """
+        self.derive()
+        if "ranked" not in self._compiled:
+            self._compiled["ranked"] = (self.compile_ranked(), self.moment_vector_size())
+        evaluate, size = self._compiled["ranked"]
+        return evaluate_ranked(evaluate, size, len(self._moment_expressions), moment_vector, deterministic, out)
+
+    def export_artifact(self, path=None, cse=True, horner=False):
+        """ Export the moment expressions as an artifact, which algebraic_moments.runtime evaluates with NumPy
+            only, see MomentEvaluator.
+
+        Args:
+            path (str, optional): write the artifact to this JSON file. Defaults to None.
+            cse (bool, optional): eliminate common subexpressions in the generated code. Defaults to True.
+            horner (bool, optional): nest the expressions in Horner form in the deterministic variables.
+                Defaults to False.
+
+        Returns:
+            dict: the artifact, see algebraic_moments.runtime.load_artifact.
+        """
+        artifact = make_artifact("moment_expressions", names=[str(name) for name in self.moment_expressions],
+                                 moments=[str(moment) for moment in self._moments], moment_ranks=self.moment_ranks(),
+                                 deterministic_variables=[str(var) for var in self._deterministic_variables],
+                                 python_source=self.ranked_python_source(cse, horner))
+        if path is not None:
+            save_artifact(path, artifact)
+        return artifact
+
+    def compile_numpy(self, multi_idx_keys=False):
+        """ Compile the moment expressions into a single vectorized NumPy function.
+
+        Args:
+            multi_idx_keys (bool, optional): If true, input_moments keys are multi-indices. Defaults to False.
+
+        Returns:
+            function: evaluate(input_moments, input_deterministic) where the inputs are dicts that map keys to
+                scalars or arrays. The arrays are broadcast against each other and the return value is a dict
+                that maps the name of each moment expression to an array of the broadcast shape.
+        """
+        self.derive()
+        moment_keys = [self.input_moment_key(moment, multi_idx_keys) for moment in self._moments]
+        deterministic_keys = [str(det_var) for det_var in self._deterministic_variables]
+        names = list(self._moment_expressions.keys())
+        func = sp.lambdify(list(self._moments) + list(self._deterministic_variables),
+                           [self._moment_expressions[name] for name in names], modules="numpy")
+
+        def evaluate(input_moments, input_deterministic):
+            args = [np.asarray(input_moments[key], dtype=float) for key in moment_keys]
+            args += [np.asarray(input_deterministic[key], dtype=float) for key in deterministic_keys]
+            shape = np.broadcast_shapes(*[arg.shape for arg in args])
+            values = func(*args)
+            outputs = dict()
+            for name, value in zip(names, values):
+                # Expressions that don't depend on every input are broadcast to the full shape.
+                value = np.asarray(value, dtype=float)
+                outputs[name] = value if value.shape == shape else np.full(shape, value)
+            return outputs
+        return evaluate
+
+    def jacobian(self):
+        """ Sparse Jacobian of the moment expressions with respect to the input moments and the deterministic
+            variables, in that order.
+
+        Returns:
+            SparseJacobian: one row per moment expression.
+        """
+        self.derive()
+        return sparse_jacobian(self._moment_expressions, list(self._moments) + list(self._deterministic_variables))
+
+    def evaluate_batch(self, input_moments, input_deterministic, multi_idx_keys=False):
+        """ Evaluate every moment expression for a batch of inputs. See compile_numpy.
+        """
+        self.derive()
+        if multi_idx_keys not in self._compiled:
+            self._compiled[multi_idx_keys] = self.compile_numpy(multi_idx_keys)
+        return self._compiled[multi_idx_keys](input_moments, input_deterministic)
+
+    @profiled("printing")
+    def print_python(self, multi_idx_keys = False, cse=False, rank_keys=False, horner=False):
         """Print python code.
 
         Args:
             multi_idx_keys (bool, optional): If true, input_moments keys are multi-indices. Defaults to False.
+            rank_keys (bool, optional): If true, input_moments is indexed by the rank of each moment and
+                input_deterministic by the position of each deterministic variable, so both can be flat arrays.
+                Defaults to False.
+            cse (bool, optional): If true, common subexpressions of all expressions are assigned to
+                temporaries first. Defaults to False.
+            horner (bool, optional): If true, the expressions are nested in Horner form in the deterministic
+                variables, so that their powers and shared products are only computed once. Defaults to False.
         """
+        temporaries, expressions, report = self._prepare_expressions(cse, horner)
+
         # Parse required inputs.
         print("# Parse required inputs.")
         for moment in self._moments:
-            if multi_idx_keys:
-                # Get the multi index of the moment relative to self._random_vector.
-                dict_input = str(self._random_vector.multi_idx(moment.vpm))
+            if multi_idx_keys or rank_keys:
+                # Get the multi index or rank of the moment relative to self._random_vector.
+                dict_input = str(self.input_moment_key(moment, multi_idx_keys, rank_keys))
             else:
-                dict_input = "\"" + str(moment) + "\""
+                dict_input = "\"" + self.input_moment_key(moment) + "\""
 
             print(str(moment) + " = input_moments[" + dict_input + "]")
 
-        for det_var in self._deterministic_variables:
-            print(str(det_var) +" = input_deterministic[\"" + str(det_var) + "\"]" )
+        for i, det_var in enumerate(self._deterministic_variables):
+            if rank_keys:
+                print(str(det_var) + " = input_deterministic[" + str(i) + "]")
+            else:
+                print(str(det_var) +" = input_deterministic[\"" + str(det_var) + "\"]" )
+
+        if temporaries:
+            print("\n# Common subexpressions. " + report)
+            for temp, expr in temporaries:
+                print(str(temp) + " = " + pycode(expr))
+        elif report:
+            print("\n# " + report)
 
         # Generate constraint expressions.
         print("\n# Moment expressions.")
-        for name, cons in self._moment_expressions.items():
+        for name, cons in expressions.items():
             print(str(name) + " = " + pycode(cons))
 
-    def print_matlab(self):
+    @profiled("printing")
+    def print_matlab(self, cse=False, horner=False):
         """The sympy function octave_code is designed to produce MATLAB compatible code.
         """
-        return self.print_octave()
+        return self.print_octave(cse=cse, horner=horner)
+
+    @profiled("printing")
+    def print_octave(self, cse=False, horner=False):
+        temporaries, expressions, report = self._prepare_expressions(cse, horner)
 
-    def print_octave(self):
         # Parse required inputs.
         print("% Parse required inputs.")
         for moment in self._moments:
@@ -107,24 +607,308 @@ class MomentExpressions(object):
         for det_var in self._deterministic_variables:
             print(str(det_var) + " = input_deterministic." + str(det_var) + ";")
 
+        if temporaries:
+            print("\n% Common subexpressions. " + report)
+            for temp, expr in temporaries:
+                print(octave_code(expr, assign_to=str(temp)))
+        elif report:
+            print("\n% " + report)
+
         # Generate constraint expressions
         print("\n% Moment expressions.")
-        for name, cons in self._moment_expressions.items():
+        for name, cons in expressions.items():
             print(octave_code(cons, assign_to=str(name)))
 
 class MomentStateDynamicalSystem(object):
-    def __init__(self, moment_state_dynamics, disturbance_moments, control_variables):
+    def __init__(self, moment_state_dynamics, disturbance_moments, control_variables, discovery_graph=None):
         """
 
         Args:
             moment_state_dynamics (dict Moment -> SymPy expression):
+            discovery_graph (networkx.DiGraph, optional): graph with an edge from each moment to the moments
+                its expansion introduced, as found by tree_ring. Defaults to None.
         """
         self._moment_state = list(moment_state_dynamics.keys())
         self._moment_state_dynamics = moment_state_dynamics
-        self._disturbance_moments = disturbance_moments
+        self._disturbance_moments = list(disturbance_moments)
         self._control_variables = control_variables
+        self._discovery_graph = discovery_graph
+        self._horizon = None # Function returned by compile_python.
+
+    def __getstate__(self):
+        # Compiled functions can't be pickled, they are rebuilt on demand.
+        state = self.__dict__.copy()
+        state["_horizon"] = None
+        return state
+
+    @property
+    def discovery_graph(self):
+        return self._discovery_graph
+
+    @property
+    def moment_state(self):
+        return self._moment_state
+
+    @property
+    def moment_state_dynamics(self):
+        """ dict Moment -> SymPy expression: dynamics of each state moment, in the order of moment_state.
+        """
+        return self._moment_state_dynamics
+
+    @property
+    def disturbance_moments(self):
+        return self._disturbance_moments
+
+    @property
+    def control_variables(self):
+        return self._control_variables
+
+    def batch_c_source(self, cse=False, horner=False):
+        """ Generate C code for PropagateMomentsBatch, which propagates N moment states over one step.
+            Every input is a strided (rows, N) array of doubles, where element (i, k) of an array is
+            array[i * row_stride + k * col_stride]. A column stride of zero shares a column across all states.
+
+            PropagateMomentsHorizon propagates N moment states over T steps. Its inputs are strided (T, rows, N)
+            arrays of the inputs of each step, where a step stride of zero shares them across all steps, and row t
+            of the trajectory is the moment state after step t.
+        """
+        temporaries, moment_state_dynamics, _ = self._prepare_dynamics(cse, horner)
+        code = "#include <math.h>\n\n"
+        code += "void PropagateMomentsBatch(long n,\n"
+        code += "    const double *prev_moment_state, long prev_row, long prev_col,\n"
+        code += "    const double *disturbance_moments, long dist_row, long dist_col,\n"
+        code += "    const double *control_inputs, long control_row, long control_col,\n"
+        code += "    double *moment_state, long out_row, long out_col){\n"
+        code += "for (long k = 0; k < n; k++) {\n"
+        for i, m in enumerate(self._moment_state):
+            code += "const double " + str(m) + " = prev_moment_state[" + str(i) + "*prev_row + k*prev_col];\n"
+        for i, dist_moment in enumerate(self._disturbance_moments):
+            code += "const double " + str(dist_moment) + " = disturbance_moments[" + str(i) + "*dist_row + k*dist_col];\n"
+        for i, control_var in enumerate(self._control_variables):
+            code += "const double " + str(control_var) + " = control_inputs[" + str(i) + "*control_row + k*control_col];\n"
+        for temp, expr in temporaries:
+            code += "const double " + str(temp) + " = " + ccode(expr) + ";\n"
+        # All inputs of state k are read before any output is written, so moment_state may alias prev_moment_state.
+        for i, m in enumerate(self._moment_state):
+            code += "moment_state[" + str(i) + "*out_row + k*out_col] = " + ccode(moment_state_dynamics[m]) + ";\n"
+        code += "}\n}\n\n"
+
+        code += "void PropagateMomentsHorizon(long horizon, long n,\n"
+        code += "    const double *initial_moment_state, long init_row, long init_col,\n"
+        code += "    const double *control_inputs, long control_step, long control_row, long control_col,\n"
+        code += "    const double *disturbance_moments, long dist_step, long dist_row, long dist_col,\n"
+        code += "    double *trajectory, long out_step, long out_row, long out_col){\n"
+        code += "for (long t = 0; t < horizon; t++) {\n"
+        code += "const double *prev = t ? trajectory + (t - 1)*out_step : initial_moment_state;\n"
+        code += "PropagateMomentsBatch(n, prev, t ? out_row : init_row, t ? out_col : init_col,\n"
+        code += "    disturbance_moments + t*dist_step, dist_row, dist_col,\n"
+        code += "    control_inputs + t*control_step, control_row, control_col,\n"
+        code += "    trajectory + t*out_step, out_row, out_col);\n"
+        code += "}\n}\n"
+        return code
+
+    def compile(self, build_directory=None, compiler=None, cse=True, horner=False):
+        """ Build batch_c_source with the system C compiler and load it.
+
+        Args:
+            build_directory (str, optional): where to build the shared library. Defaults to a cache directory.
+            compiler (str, optional): C compiler. Defaults to $CC, or "cc" if it isn't set.
+            cse (bool, optional): eliminate common subexpressions in the generated code. Defaults to True.
+            horner (bool, optional): nest the dynamics in Horner form in the control variables. Defaults to False.
+
+        Returns:
+            NativePropagator: propagate(prev_moment_state, disturbance_moments, control_inputs, out=None).
+        """
+        library_path = build_shared_library(self.batch_c_source(cse, horner), build_directory, compiler)
+        return NativePropagator(library_path, len(self._moment_state), len(self._disturbance_moments),
+                                len(self._control_variables))
+
+    def horizon_python_source(self, cse=True, horner=False):
+        """ Generate Python code for propagate_horizon(initial_moment_state, control_inputs, disturbance_moments,
+            trajectory), which propagates a moment state over len(trajectory) steps. Inputs are indexed as
+            initial_moment_state[i], control_inputs[t][i], disturbance_moments[t][i] and trajectory[t][i], so the
+            function runs on nested lists of floats as well as on NumPy arrays with trailing batch dimensions.
+        """
+        temporaries, moment_state_dynamics, _ = self._prepare_dynamics(cse, horner)
+        code = "def propagate_horizon(initial_moment_state, control_inputs, disturbance_moments, trajectory):\n"
+        code += "    for _t in range(len(trajectory)):\n"
+        code += "        _prev = trajectory[_t - 1] if _t else initial_moment_state\n"
+        code += "        _dist = disturbance_moments[_t]\n"
+        code += "        _ctrl = control_inputs[_t]\n"
+        code += "        _out = trajectory[_t]\n"
+        for i, m in enumerate(self._moment_state):
+            code += "        " + str(m) + " = _prev[" + str(i) + "]\n"
+        for i, dist_moment in enumerate(self._disturbance_moments):
+            code += "        " + str(dist_moment) + " = _dist[" + str(i) + "]\n"
+        for i, control_var in enumerate(self._control_variables):
+            code += "        " + str(control_var) + " = _ctrl[" + str(i) + "]\n"
+        for temp, expr in temporaries:
+            code += "        " + str(temp) + " = " + numpy_code(expr) + "\n"
+        for i, m in enumerate(self._moment_state):
+            code += "        _out[" + str(i) + "] = " + numpy_code(moment_state_dynamics[m]) + "\n"
+        return code
+
+    def compile_python(self, cse=True, horner=False):
+        """ Compile horizon_python_source.
+
+        Returns:
+            function: propagate_horizon(initial_moment_state, control_inputs, disturbance_moments, trajectory).
+        """
+        return compile_function(self.horizon_python_source(cse, horner), "propagate_horizon", "<propagate_horizon>")
+
+    def propagate_horizon(self, initial_moment_state, control_inputs, disturbance_moments, out=None):
+        """ Propagate moment states over a horizon of T steps with the Python backend. For the C backend,
+            see compile and NativePropagator.horizon, which take the same arguments.
+
+        Args:
+            initial_moment_state (array of shape (n_state,) or (n_state, N)): moment state before the first
+                step, rows in the order of moment_state.
+            control_inputs (array of shape (T, n_control) or (T, n_control, N)): control inputs of each step,
+                columns in the order of control_variables.
+            disturbance_moments (array of shape (n_disturbance,), (T, n_disturbance) or (T, n_disturbance, N)):
+                disturbance moments, constant or of each step, in the order of disturbance_moments.
+            out (array of shape (T, n_state) or (T, n_state, N), optional): trajectory buffer, whose row t is
+                the moment state after step t.
+
+        Returns:
+            array of shape (T, n_state) or (T, n_state, N): the trajectory.
+        """
+        if self._horizon is None:
+            self._horizon = self.compile_python()
+        return propagate_horizon(self._horizon, len(self._moment_state), len(self._control_variables),
+                                 len(self._disturbance_moments), initial_moment_state, control_inputs,
+                                 disturbance_moments, out)
+
+    def export_artifact(self, path=None, cse=True, horner=False, c_source=True):
+        """ Export the dynamics as an artifact, which algebraic_moments.runtime propagates with NumPy only (or
+            with the generated C code), see MomentPropagator.
+
+        Args:
+            path (str, optional): write the artifact to this JSON file. Defaults to None.
+            cse (bool, optional): eliminate common subexpressions in the generated code. Defaults to True.
+            horner (bool, optional): nest the dynamics in Horner form in the control variables. Defaults to False.
+            c_source (bool, optional): include batch_c_source, see MomentPropagator.compile. Defaults to True.
+
+        Returns:
+            dict: the artifact, see algebraic_moments.runtime.load_artifact.
+        """
+        artifact = make_artifact("moment_state_dynamics", moment_state=[str(m) for m in self._moment_state],
+                                 disturbance_moments=[str(m) for m in self._disturbance_moments],
+                                 control_variables=[str(var) for var in self._control_variables],
+                                 python_source=self.horizon_python_source(cse, horner),
+                                 c_source=self.batch_c_source(cse, horner) if c_source else None)
+        if path is not None:
+            save_artifact(path, artifact)
+        return artifact
+
+    def jacobians(self):
+        """ Sparse Jacobians of the dynamics with respect to the previous moment state and the control inputs.
+
+        Returns:
+            OrderedDict str -> SparseJacobian: "moment_state" and "control_inputs" Jacobians, with one row per
+                moment of moment_state.
+        """
+        dynamics = OrderedDict((m, self._moment_state_dynamics[m]) for m in self._moment_state)
+        return OrderedDict([("moment_state", sparse_jacobian(dynamics, self._moment_state)),
+                            ("control_inputs", sparse_jacobian(dynamics, self._control_variables))])
+
+    def linear_form(self):
+        """ Split the dynamics into moment_state = A * prev_moment_state + b, where the entries of A and b only
+            depend on the disturbance moments and control variables. Systems found by tree_ring with
+            reduced=False always have this form. With reduced=True, products of moments of independent parts of
+            the state make the dynamics nonlinear.
+
+        Raises:
+            Exception: the dynamics aren't affine in the previous moment state.
+
+        Returns:
+            SparseJacobian: A, with rows and columns in the order of moment_state.
+            list of SymPy expressions: b, in the order of moment_state.
+        """
+        dynamics = OrderedDict((m, self._moment_state_dynamics[m]) for m in self._moment_state)
+        matrix = sparse_jacobian(dynamics, self._moment_state)
+        state = set(self._moment_state)
+        if any(entry.free_symbols & state for entry in matrix.values()):
+            raise Exception("The moment state dynamics aren't affine in the moment state.")
+        zeros = {m : 0 for m in self._moment_state}
+        return matrix, [expr.xreplace(zeros) for expr in dynamics.values()]
+
+    def linear_operator_python_source(self, cse=True, horner=False):
+        """ Generate Python code for fill(disturbance_moments, control_inputs, data, offset), which writes the
+            nonzero entries of A, in compressed sparse row order, to data[k] and b to offset[i]. See linear_form.
+            The function runs on lists of floats as well as on NumPy arrays with trailing batch dimensions.
+        """
+        matrix, offset = self.linear_form()
+        expressions = OrderedDict((("data", k), value) for k, value in enumerate(matrix.values()))
+        expressions.update((("offset", i), value) for i, value in enumerate(offset))
+        temporaries, expressions, _ = prepare_expressions(expressions, cse,
+                                                          horner=self._control_variables if horner else None)
+        code = "def fill(disturbance_moments, control_inputs, data, offset):\n"
+        for i, dist_moment in enumerate(self._disturbance_moments):
+            code += "    " + str(dist_moment) + " = disturbance_moments[" + str(i) + "]\n"
+        for i, control_var in enumerate(self._control_variables):
+            code += "    " + str(control_var) + " = control_inputs[" + str(i) + "]\n"
+        for temp, expr in temporaries:
+            code += "    " + str(temp) + " = " + numpy_code(expr) + "\n"
+        for (name, k), expr in expressions.items():
+            code += "    " + name + "[" + str(k) + "] = " + numpy_code(expr) + "\n"
+        code += "    return data, offset\n"
+        return code
+
+    def compile_linear_operator(self, cse=True, horner=False):
+        """ Compile linear_operator_python_source.
+
+        Returns:
+            LinearMomentOperator:
+        """
+        matrix, _ = self.linear_form()
+        indptr, indices = matrix.csr_pattern()
+        fill = compile_function(self.linear_operator_python_source(cse, horner), "fill", "<linear_operator>")
+        return LinearMomentOperator(fill, indptr, indices, len(self._moment_state),
+                                    len(self._disturbance_moments), len(self._control_variables))
+
+    def _prepare_dynamics(self, cse, horner=False):
+        """ Apply prepare_expressions to the dynamics, keyed by moment, in Horner form in the control variables
+            if horner is true.
+        """
+        return prepare_expressions(self._moment_state_dynamics, cse,
+                                   horner=self._control_variables if horner else None)
+
+    def _prepare_dynamics_and_jacobians(self, cse, horner=False):
+        """ Apply prepare_expressions jointly to the dynamics and the nonzero entries of the Jacobians, so
+            that they share common subexpressions.
+
+        Returns:
+            list of tuples (Symbol, SymPy expression): temporaries.
+            dict Moment -> SymPy expression: dynamics.
+            OrderedDict str -> tuple (SparseJacobian, list of SymPy expressions): each Jacobian and its entries
+                in the order of its sparsity pattern.
+            str: report of prepare_expressions.
+        """
+        jacobians = self.jacobians()
+        expressions = dict(self._moment_state_dynamics)
+        for name, jacobian in jacobians.items():
+            for k, value in enumerate(jacobian.values()):
+                expressions[(name, k)] = value
+        temporaries, expressions, report = prepare_expressions(expressions, cse,
+                                                               horner=self._control_variables if horner else None)
+        dynamics = {m : expressions[m] for m in self._moment_state_dynamics}
+        entries = OrderedDict((name, (jacobian, [expressions[(name, k)] for k in range(jacobian.nnz)]))
+                              for name, jacobian in jacobians.items())
+        return temporaries, dynamics, entries, report
+
+    @profiled("printing")
+    def print_cpp(self, cse=False, jacobians=False, horner=False):
+        """ Print C++ code.
+
+        Args:
+            cse (bool, optional): eliminate common subexpressions. Defaults to False.
+            jacobians (bool, optional): also print PropagateMomentsWithJacobians, which additionally writes the
+                nonzero entries of the Jacobians in the order of the printed sparsity patterns. Defaults to False.
+            horner (bool, optional): nest the dynamics in Horner form in the control variables. Defaults to False.
+        """
+        temporaries, moment_state_dynamics, report = self._prepare_dynamics(cse, horner)
 
-    def print_cpp(self):
         # Print imports necessary.
         print("#include <cmath> \nusing namespace std;\n")
 
@@ -160,11 +944,62 @@ class MomentStateDynamicalSystem(object):
             print("\n")
             for control_var in self._control_variables:
                 print("const double &" + str(control_var) + " = control_inputs->" + str(control_var) + ";")
+        if temporaries:
+            print("\n// Common subexpressions. " + report)
+            for temp, expr in temporaries:
+                print("const double " + str(temp) + " = " + str(ccode(expr)) + ";")
+        elif report:
+            print("\n// " + report)
         print("\n// Dynamics updates.")
-        for m, dynamics in self._moment_state_dynamics.items():
+        for m, dynamics in moment_state_dynamics.items():
             print("moment_state->" + str(m) + " = " + str(ccode(dynamics)) + ";\n")
         print("return; \n }")
+
+        # Generate code for propagating a whole horizon. trajectory[t] is the moment state after step t, and
+        # disturbance_stride is 1 for time-varying disturbance moments or 0 for constant ones.
+        print("\nvoid PropagateMomentsHorizon(long horizon, const MomentState *initial_moment_state, const DisturbanceMoments *disturbance_moments, long disturbance_stride, const Controls *control_inputs, MomentState *trajectory){")
+        print("for (long t = 0; t < horizon; t++) {")
+        print("PropagateMoments(t == 0 ? initial_moment_state : &trajectory[t - 1], &disturbance_moments[t * disturbance_stride], &control_inputs[t], &trajectory[t]);")
+        print("}\n}")
+        if jacobians:
+            self._print_cpp_jacobians(cse, horner)
+
+    def _print_cpp_jacobians(self, cse, horner):
+        temporaries, moment_state_dynamics, jacobians, report = self._prepare_dynamics_and_jacobians(cse, horner)
+
+        # Sparsity patterns, as zero based (row, column) pairs in the order the entries are written.
+        for name, (jacobian, _) in jacobians.items():
+            rows, cols = jacobian.pattern()
+            print("\nconst long jacobian_" + name + "_nnz = " + str(jacobian.nnz) + ";")
+            if jacobian.nnz:
+                print("const long jacobian_" + name + "_rows[] = {" + ", ".join(map(str, rows)) + "};")
+                print("const long jacobian_" + name + "_cols[] = {" + ", ".join(map(str, cols)) + "};")
+
+        arguments = ", ".join("double *jacobian_" + name for name in jacobians)
+        print("\nvoid PropagateMomentsWithJacobians(const MomentState *prev_moment_state, const DisturbanceMoments *disturbance_moments, const Controls *control_inputs, MomentState *moment_state, " + arguments + "){")
+        print("// Copies of the required inputs, so that moment_state may alias prev_moment_state.")
+        for m in self._moment_state:
+            print("const double " + str(m) + " = prev_moment_state->" + str(m) + ";")
+        for dist_moment in self._disturbance_moments:
+            print("const double " + str(dist_moment) + " = disturbance_moments->" + str(dist_moment) + ";")
+        for control_var in self._control_variables:
+            print("const double " + str(control_var) + " = control_inputs->" + str(control_var) + ";")
+        if temporaries:
+            print("\n// Common subexpressions. " + report)
+            for temp, expr in temporaries:
+                print("const double " + str(temp) + " = " + str(ccode(expr)) + ";")
+        elif report:
+            print("\n// " + report)
+        print("\n// Dynamics updates.")
+        for m, dynamics in moment_state_dynamics.items():
+            print("moment_state->" + str(m) + " = " + str(ccode(dynamics)) + ";")
+        for name, (jacobian, values) in jacobians.items():
+            print("\n// Nonzero entries of the Jacobian with respect to " + name.replace("_", " ") + ".")
+            for k, value in enumerate(values):
+                print("jacobian_" + name + "[" + str(k) + "] = " + str(ccode(value)) + ";")
+        print("}")
     
+    @profiled("printing")
     def print_cpp_python_structures(self):
         # Generate code for Python bindings to input structures vis ctypes.
         def structure_python_binding_generator(structure_name, variable_names):
@@ -185,7 +1020,21 @@ class MomentStateDynamicalSystem(object):
         print(disturbance_moment_struct)
         print(control_struct)
 
-    def print_python(self):
+    @profiled("printing")
+    def print_python(self, cse=False, jacobians=False, horner=False):
+        """ Print python code.
+
+        Args:
+            cse (bool, optional): eliminate common subexpressions. Defaults to False.
+            jacobians (bool, optional): also print the nonzero entries of the Jacobians as dicts keyed by
+                (moment, input). Defaults to False.
+            horner (bool, optional): nest the dynamics in Horner form in the control variables. Defaults to False.
+        """
+        if jacobians:
+            temporaries, moment_state_dynamics, jacobian_entries, report = self._prepare_dynamics_and_jacobians(cse, horner)
+        else:
+            temporaries, moment_state_dynamics, report = self._prepare_dynamics(cse, horner)
+
         print("# Parse required inputs.")
         for m, dynamics in self._moment_state_dynamics.items():
             print(str(m) + " = prev_moment_state[\"" + str(m) + "\"]")
@@ -196,15 +1045,43 @@ class MomentStateDynamicalSystem(object):
             print("\n")
             for control_var in self._control_variables:
                 print(str(control_var) + " = control_inputs[\"" + str(control_var) + "\"]")
+        if temporaries:
+            print("\n# Common subexpressions. " + report)
+            for temp, expr in temporaries:
+                print(str(temp) + " = " + str(expr))
+        elif report:
+            print("\n# " + report)
         print("\n#Dynamics updates.")
         print("moment_state = dict()")
-        for m, dynamics in self._moment_state_dynamics.items():
+        for m, dynamics in moment_state_dynamics.items():
             print("moment_state[\"" + str(m) + "\"] = " + str(dynamics))
+        if jacobians:
+            for name, (jacobian, values) in jacobian_entries.items():
+                print("\n# Nonzero entries of the Jacobian with respect to " + name.replace("_", " ") + ".")
+                print("jacobian_" + name + " = dict()")
+                for (row, col), value in zip(jacobian.entries, values):
+                    print("jacobian_" + name + "[(\"" + str(jacobian.outputs[row]) + "\", \"" + str(jacobian.variables[col]) +
+                          "\")] = " + str(value))
+
+    @profiled("printing")
+    def print_matlab(self, cse=False, jacobians=False, horner=False):
+        return self.print_octave(cse=cse, jacobians=jacobians, horner=horner)
+
+    @profiled("printing")
+    def print_octave(self, cse=False, jacobians=False, horner=False):
+        """ Print octave code.
 
-    def print_matlab(self):
-        return self.print_octave()
+        Args:
+            cse (bool, optional): eliminate common subexpressions. Defaults to False.
+            jacobians (bool, optional): also print the Jacobians as sparse matrices, with rows in the order of
+                moment_state and columns in the order of moment_state or control_variables. Defaults to False.
+            horner (bool, optional): nest the dynamics in Horner form in the control variables. Defaults to False.
+        """
+        if jacobians:
+            temporaries, moment_state_dynamics, jacobian_entries, report = self._prepare_dynamics_and_jacobians(cse, horner)
+        else:
+            temporaries, moment_state_dynamics, report = self._prepare_dynamics(cse, horner)
 
-    def print_octave(self):
         print("% Parse required inputs.")
         for m, dynamics in self._moment_state_dynamics.items():
             print(str(m) + " = prev_moment_state." + str(m) + ";")
@@ -215,9 +1092,25 @@ class MomentStateDynamicalSystem(object):
             print("\n")
             for control_var in self._control_variables:
                 print(str(control_var) + " = control_inputs." + str(control_var) + ";")
+        if temporaries:
+            print("\n% Common subexpressions. " + report)
+            for temp, expr in temporaries:
+                print(str(temp) + " = " + str(expr) + ";")
+        elif report:
+            print("\n% " + report)
         print("\n%Dynamics updates.")
-        for m, dynamics in self._moment_state_dynamics.items():
+        for m, dynamics in moment_state_dynamics.items():
             print("moment_state." + str(m) + " = " + str(dynamics) + ";")
+        if jacobians:
+            for name, (jacobian, values) in jacobian_entries.items():
+                rows, cols = jacobian.pattern()
+                print("\n% Jacobian with respect to " + name.replace("_", " ") + ".")
+                print("jacobian_" + name + "_values = zeros(" + str(jacobian.nnz) + ", 1);")
+                for k, value in enumerate(values):
+                    print("jacobian_" + name + "_values(" + str(k + 1) + ") = " + str(value) + ";")
+                print("jacobian_" + name + " = sparse([" + " ".join(str(row + 1) for row in rows) + "], [" +
+                      " ".join(str(col + 1) for col in cols) + "], jacobian_" + name + "_values, " +
+                      str(jacobian.shape[0]) + ", " + str(jacobian.shape[1]) + ");")
 
 class DeterministicVariable(sp.Symbol):
     def __init__(self, string_rep):
@@ -234,8 +1127,103 @@ class RandomVariable(sp.Symbol):
 class StateVariable(RandomVariable):
     pass
 
+class Distribution(object):
+    """ Annotation of what is known about the distribution of a random variable. Moments of annotated
+        variables that are known are substituted during derivations, see RandomVector, so they never become
+        inputs and terms with vanishing moments are dropped.
+
+        Annotations only apply to moments of a variable on its own, i.e. to the factors of a term in which
+        the variable is independent of the other variables of the term.
+    """
+    def moment(self, var, power, moment_of):
+        """ Raw moment E[var**power] of the annotated variable.
+
+        Args:
+            var (RandomVariable): the annotated variable.
+            power (int): positive power.
+            moment_of (function): moment_of(var, power) is E[var**power] of a variable of the random vector, a
+                Moment if it is unknown.
+
+        Returns:
+            SymPy expression or None: the moment, or None if it is unknown.
+        """
+        return None
+
+    def __repr__(self):
+        return type(self).__name__ + "()"
+
+class ZeroMean(Distribution):
+    """ E[var] = 0.
+    """
+    def moment(self, var, power, moment_of):
+        return sp.S.Zero if power == 1 else None
+
+class Symmetric(Distribution):
+    """ The distribution is symmetric about its mean, so every odd central moment vanishes and the odd raw
+        moments of degree three and higher are expressions of the lower ones. The mean isn't assumed to be
+        zero, see ZeroMean.
+    """
+    def moment(self, var, power, moment_of):
+        if power == 1 or power % 2 == 0:
+            return None
+        mean = moment_of(var, 1)
+        # E[var**n] = sum_k C(n, k) mean**(n - k) E[(var - mean)**k], where only the even central moments
+        # E[(var - mean)**k] = sum_j C(k, j) (-mean)**(k - j) E[var**j] remain.
+        value = sum(math.comb(power, k) * mean**(power - k) *
+                    sum(math.comb(k, j) * (-mean)**(k - j) * (moment_of(var, j) if j else 1) for j in range(k + 1))
+                    for k in range(0, power, 2))
+        return sp.expand(value)
+
+class Gaussian(Distribution):
+    def __init__(self, mean=None, variance=None):
+        """ Gaussian distribution, whose moments of degree three and higher are determined by the mean and
+            variance.
+
+        Args:
+            mean (number or SymPy expression, optional): Defaults to None, i.e. the unknown moment E[var].
+            variance (number or SymPy expression, optional): Defaults to None, i.e. E[var**2] - E[var]**2 with
+                the unknown moment E[var**2].
+        """
+        self._mean = sp.sympify(mean) if mean is not None else None
+        self._variance = sp.sympify(variance) if variance is not None else None
+
+    def moment(self, var, power, moment_of):
+        if power == 1 or (power == 2 and self._variance is None):
+            return self._mean if power == 1 else None
+        mean = self._mean if self._mean is not None else moment_of(var, 1)
+        variance = self._variance if self._variance is not None else moment_of(var, 2) - mean**2
+        # E[var**n] = sum_j C(n, 2j) (2j - 1)!! variance**j mean**(n - 2j).
+        value = sum(math.comb(power, 2 * j) * sp.factorial2(2 * j - 1) * variance**j * mean**(power - 2 * j)
+                    for j in range(power // 2 + 1))
+        return sp.expand(value)
+
+    def __repr__(self):
+        return "Gaussian(mean=" + sp.srepr(self._mean) + ", variance=" + sp.srepr(self._variance) + ")"
+
+class IdenticallyDistributed(Distribution):
+    def __init__(self, variable):
+        """ The annotated variable has the same distribution as variable, e.g. i.i.d. copies of a disturbance
+            are annotated with IdenticallyDistributed(first_copy) and are independent in the random vector.
+
+        Args:
+            variable (RandomVariable): a variable of the same random vector.
+        """
+        self._variable = variable
+
+    @property
+    def variable(self):
+        return self._variable
+
+    def moment(self, var, power, moment_of):
+        return moment_of(self._variable, power)
+
+    def __repr__(self):
+        return "IdenticallyDistributed(" + sp.srepr(self._variable) + ")"
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
 class PolyDynamicalSystem(object):
-    def __init__(self, state_dynamics, control_variables, disturbance_vector, state_dependencies):
+    def __init__(self, state_dynamics, control_variables, disturbance_vector, state_dependencies, product_cache_size=1024):
         """ A discrete time polynomial stochastic system.
 
         Args:
@@ -243,6 +1231,8 @@ class PolyDynamicalSystem(object):
             control_variables (list of DeterministicVariable): control variables of the system.
             disturbance_vector (RandomVector): random vector of disturbances of the system.
             state_dependencies (list of tuples of StateVariable): pairwise dependence between instances of StateVariable.
+            product_cache_size (int, optional): maximum number of expanded products of the dynamics kept by
+                monomial_dynamics. Defaults to 1024.
 
         Raises:
             Exception: [description]
@@ -259,7 +1249,63 @@ class PolyDynamicalSystem(object):
         # Create an instance of RandomVector that encapsulates the state and disturbance variables.
         self._disturbance_vector = disturbance_vector
         self._system_random_vector = RandomVector(self._state_variables + disturbance_vector.variables,
-                                                  self._state_dependence_graph.edges + disturbance_vector.dependence_graph.edges)
+                                                  self._state_dependence_graph.edges + disturbance_vector.dependence_graph.edges,
+                                                  disturbance_vector.distributions)
+
+        # Least recently used cache of the expanded products of the dynamics, keyed by multi-index
+        # relative to the state random vector.
+        self._ring = PolynomialRing.from_expressions(self._system_random_vector.variables, state_dynamics.values())
+        self._product_cache = OrderedDict()
+        self._product_cache_size = product_cache_size
+        self._product_cache_hits = 0
+        self._product_cache_misses = 0
+
+    @profiled("dynamics_expansion")
+    def monomial_dynamics(self, vpm):
+        """ Expand the dynamics of a monomial of the state, prod(dynamics[var]**power), as a polynomial in
+            system_random_vector. Products are built by multiplying the cached products of lower degree
+            monomials, e.g. the dynamics of x**2*y are the cached dynamics of x*y times those of x.
+
+        Args:
+            vpm (dict StateVariable -> int): variable power map of the monomial. Variables that aren't
+                state variables are ignored.
+
+        Returns:
+            SparsePolynomial: expanded dynamics with system_random_vector.variables as random variables.
+        """
+        return self._monomial_dynamics(self._state_random_vector.multi_idx(vpm))
+
+    def _monomial_dynamics(self, multi_index):
+        poly = self._product_cache.get(multi_index)
+        if poly is not None:
+            self._product_cache_hits += 1
+            self._product_cache.move_to_end(multi_index)
+            return poly
+        self._product_cache_misses += 1
+
+        support = [i for i, power in enumerate(multi_index) if power > 0]
+        if not support:
+            poly = self._ring.constant(1)
+        elif len(support) == 1 and multi_index[support[0]] == 1:
+            poly = self._ring.from_expr(self._dynamics[self._state_random_vector.variables[support[0]]])
+        else:
+            # Peel off one power of the first variable.
+            unit = tuple(1 if i == support[0] else 0 for i in range(len(multi_index)))
+            lower = tuple(power - unit[i] for i, power in enumerate(multi_index))
+            poly = self._monomial_dynamics(lower) * self._monomial_dynamics(unit)
+
+        self._product_cache[multi_index] = poly
+        if len(self._product_cache) > self._product_cache_size:
+            self._product_cache.popitem(last=False)
+        return poly
+
+    def product_cache_info(self):
+        """
+        Returns:
+            CacheInfo: hits, misses, maximum size and current size of the cache used by monomial_dynamics.
+        """
+        return CacheInfo(self._product_cache_hits, self._product_cache_misses, self._product_cache_size,
+                         len(self._product_cache))
     
     @property
     def dynamics(self):
@@ -289,10 +1335,28 @@ class PolyDynamicalSystem(object):
     def disturbance_variables(self):
         return self._disturbance_vector.variables
 
+    @property
+    def disturbance_vector(self):
+        return self._disturbance_vector
+
 class DependenceGraph(object):
     def __init__(self, nx_graph):
         self._nx_graph = nx_graph
-    
+        self._build(list(nx_graph.nodes), list(nx_graph.edges))
+
+    def _build(self, variables, edges):
+        # Bitmask representation of the graph: the i-th node is bit i and the adjacency of a node is
+        # the bitmask of its neighbors. Connected components of induced subgraphs are memoized by the
+        # bitmask of the subgraph's nodes.
+        self._variables = variables
+        self._edges = edges
+        self._bits = {var : i for i, var in enumerate(self._variables)}
+        self._adjacency = [0] * len(self._variables)
+        for u, v in edges:
+            self._adjacency[self._bits[u]] |= 1 << self._bits[v]
+            self._adjacency[self._bits[v]] |= 1 << self._bits[u]
+        self._component_cache = dict()
+
     def subgraph_components(self, random_variables):
         """ Find the connected components of the subgraph induced by random_variables.
 
@@ -302,16 +1366,75 @@ class DependenceGraph(object):
         Returns:
             list of sets of RandomVariable: [description]
         """
-        subgraph = self._nx_graph.subgraph(random_variables)
+        components = self.mask_components(self.support_mask(random_variables))
+        return [set(self.mask_variables(comp)) for comp in components]
+
+    def nx_subgraph_components(self, random_variables):
+        """ Reference implementation of subgraph_components that uses networkx.
+        """
+        import networkx as nx
+        subgraph = self.nx_graph.subgraph(random_variables)
         connected_components = list(nx.connected_components(subgraph))
         return connected_components
 
+    def support_mask(self, random_variables):
+        """ Bitmask of a collection of variables. Variables that are not nodes of the graph are ignored.
+        """
+        mask = 0
+        for var in random_variables:
+            if var in self._bits:
+                mask |= 1 << self._bits[var]
+        return mask
+
+    def mask_variables(self, mask):
+        """ Variables of a bitmask, in node order.
+        """
+        return [var for i, var in enumerate(self._variables) if mask >> i & 1]
+
+    def mask_components(self, mask):
+        """ Find the connected components of the subgraph induced by a bitmask of nodes.
+
+        Args:
+            mask (int): bitmask of the nodes of the subgraph.
+
+        Returns:
+            tuple of int: bitmasks of the connected components, ordered by their lowest bit.
+        """
+        components = self._component_cache.get(mask)
+        if components is not None:
+            return components
+
+        components = []
+        remaining = mask
+        while remaining:
+            # Grow the component of the lowest remaining node one layer of neighbors at a time.
+            component = remaining & -remaining
+            frontier = component
+            while frontier:
+                lowest = frontier & -frontier
+                frontier ^= lowest
+                neighbors = self._adjacency[lowest.bit_length() - 1] & remaining & ~component
+                component |= neighbors
+                frontier |= neighbors
+            components.append(component)
+            remaining &= ~component
+        components = tuple(components)
+        self._component_cache[mask] = components
+        return components
+
     @property
     def edges(self):
-        return list(self._nx_graph.edges)
+        return list(self._edges)
 
     @property
     def nx_graph(self):
+        """ networkx.Graph: the graph, which is only built (and networkx imported) on first use.
+        """
+        if self._nx_graph is None:
+            import networkx as nx
+            self._nx_graph = nx.Graph()
+            self._nx_graph.add_nodes_from(self._variables)
+            self._nx_graph.add_edges_from(self._edges)
         return self._nx_graph
     
     @classmethod
@@ -329,23 +1452,51 @@ class DependenceGraph(object):
             [type]: [description]
         """
 
-        # Construct the dependence_graph.
-        dep_graph = nx.Graph()
-        dep_graph.add_nodes_from(variables)
-        if variable_dependencies:
-            dep_graph.add_edges_from(variable_dependencies)
-        return cls(dep_graph)
+        # Construct the dependence_graph without networkx, which is slow to import. Nodes and edges are
+        # deduplicated like networkx.Graph does, and the variables of the edges are nodes too.
+        nodes = dict.fromkeys(variables)
+        edges = dict()
+        for u, v in variable_dependencies or []:
+            nodes.update(dict.fromkeys([u, v]))
+            if (v, u) not in edges:
+                edges[(u, v)] = None
+        dep_graph = cls.__new__(cls)
+        dep_graph._nx_graph = None
+        dep_graph._build(list(nodes), list(edges))
+        return dep_graph
 
 class RandomVector(object):
-    def __init__(self, random_variables, variable_dependencies):
+    def __init__(self, random_variables, variable_dependencies, distributions=None):
         """
 
         Args:
             random_variables (list of instances of RandomVariable):
             variable_dependencies (list of tuples of RandomVariable): Tuples specify pairwise dependence between random variables
+            distributions (dict RandomVariable -> Distribution, optional): known structure of the distributions
+                of some variables, e.g. ZeroMean, Symmetric, Gaussian or IdenticallyDistributed. Defaults to None.
+
+        Raises:
+            Exception: a variable of distributions is not an element of the random vector, or annotations of
+                IdenticallyDistributed form a cycle.
         """
         self._random_variables = self.sort_variables(random_variables)
-        self._dependence_graph = DependenceGraph.from_lists(random_variables, variable_dependencies)
+        self._variable_index = {var : i for i, var in enumerate(self._random_variables)}
+        self._distributions = dict(distributions) if distributions else dict()
+        if not self.contains(self._distributions.keys()):
+            raise Exception("RandomVector received a distribution of a variable that is not one of its variables.")
+        for var in self._distributions:
+            # Follow the chain of identical distributions, whose moments are substituted recursively.
+            chain = {var}
+            distribution = self._distributions[var]
+            while isinstance(distribution, IdenticallyDistributed):
+                if distribution.variable in chain:
+                    raise Exception("RandomVector received IdenticallyDistributed annotations that form a cycle through " +
+                                    str(var) + ".")
+                chain.add(distribution.variable)
+                distribution = self._distributions.get(distribution.variable)
+        # Build the graph from the sorted variables so that bit i of the graph's bitmasks is
+        # element i of a multi-index.
+        self._dependence_graph = DependenceGraph.from_lists(self._random_variables, variable_dependencies)
     
     @property
     def variables(self):
@@ -355,12 +1506,95 @@ class RandomVector(object):
     def dependence_graph(self):
         return self._dependence_graph
 
+    @property
+    def distributions(self):
+        return self._distributions
+
     def multi_idx(self, vpm):
-        return tuple(vpm[var] if var in vpm.keys() else 0 for var in self._random_variables)
+        multi_index = [0] * len(self._random_variables)
+        for var, power in vpm.items():
+            if var in self._variable_index:
+                multi_index[self._variable_index[var]] = power
+        return tuple(multi_index)
+
+    def support_mask(self, multi_index):
+        """ Bitmask of the variables with a positive power in multi_index.
+        """
+        mask = 0
+        for i, power in enumerate(multi_index):
+            if power > 0:
+                mask |= 1 << i
+        return mask
+
+    @staticmethod
+    def restrict(multi_index, mask):
+        """ Zero out the elements of multi_index that are not in mask.
+        """
+        return tuple(power if mask >> i & 1 else 0 for i, power in enumerate(multi_index))
+
+    def contains(self, variables):
+        """ Check if all of the input variables are elements of this random vector.
+        """
+        return all(var in self._variable_index for var in variables)
 
     def vpm(self, multi_index):
         return {self._random_variables[i] : power for i, power in enumerate(multi_index) if power>0}
 
+    def rank(self, multi_index):
+        """ Graded lexicographic rank of a multi-index: multi-indices are ordered by total degree, then in
+            descending lexicographic order, e.g. 1, x, y, x**2, x*y, y**2, ... for the variables [x, y].
+
+        Args:
+            multi_index (tuple of int): multi-index relative to this random vector.
+
+        Returns:
+            int: rank of multi_index.
+        """
+        n = len(self._random_variables)
+        remaining = sum(multi_index)
+        # Number of multi-indices of lower degree.
+        rank = math.comb(remaining + n - 1, n) if remaining else 0
+        for i in range(n - 1):
+            # Number of multi-indices of the same degree whose element i is larger and prior elements are equal.
+            rank += math.comb(remaining - multi_index[i] + n - i - 2, n - i - 1)
+            remaining -= multi_index[i]
+        return rank
+
+    def unrank(self, rank):
+        """ Inverse of rank.
+
+        Returns:
+            tuple of int: multi-index with the given rank.
+        """
+        n = len(self._random_variables)
+        degree = 0
+        while math.comb(degree + n, n) <= rank:
+            degree += 1
+        rank -= math.comb(degree + n - 1, n) if degree else 0
+        multi_index = []
+        remaining = degree
+        for i in range(n - 1):
+            # Element i is the largest power whose block of multi-indices contains rank.
+            power = remaining
+            while True:
+                block = math.comb(remaining - power + n - i - 2, n - i - 2)
+                if rank < block:
+                    break
+                rank -= block
+                power -= 1
+            multi_index.append(power)
+            remaining -= power
+        if n:
+            multi_index.append(remaining)
+        return tuple(multi_index)
+
+    def n_multi_indices(self, max_degree):
+        """ Number of multi-indices of total degree at most max_degree, i.e. the length of a moment vector
+            indexed by rank that contains every moment up to max_degree.
+        """
+        n = len(self._random_variables)
+        return math.comb(max_degree + n, n)
+
     @staticmethod
     def sort_variables(variables):
         """ Sort variables by lexographical order.
@@ -369,13 +1603,23 @@ class RandomVector(object):
 
 class Moment(sp.Symbol):
     def __new__(cls, vpm):
-        string_rep = Moment.generate_string_rep(vpm)
-        return super(Moment, cls).__new__(cls, string_rep)
+        vpm = {var : power for var, power in vpm.items() if power>0}
+        moment = super(Moment, cls).__new__(cls, Moment.generate_string_rep(vpm))
+        # Symbols are cached by name, so this may be an existing instance with an equal vpm.
+        moment._vpm = vpm
+        return moment
 
     def __init__(self, vpm):
-        string_rep = Moment.generate_string_rep(vpm)
-        sp.Symbol.__init__(string_rep)
-        self._vpm = {var : power for var, power in vpm.items() if power>0}
+        # Everything is set up by __new__.
+        pass
+
+    def __getnewargs__(self):
+        return (self._vpm,)
+
+    def __getstate__(self):
+        state = super(Moment, self).__getstate__()
+        state["_vpm"] = self._vpm
+        return state
 
     def same_vpm(self, input):
         """ Check if an input vpm or instance of Moment is the same.
@@ -414,11 +1658,12 @@ class Moment(sp.Symbol):
         """ Generate the multi index w.r.t. a given random vector.
 
         Args:
-            random_vector ([type]): [description]
+            random_vector (RandomVector): random vector that contains the variables of this moment.
 
         Returns:
-            [type]: [description]
+            tuple of int: multi-index of this moment.
         """
+        return random_vector.multi_idx(self._vpm)
 
     @staticmethod
     def generate_string_rep(variable_power_map):
@@ -440,4 +1685,102 @@ class Moment(sp.Symbol):
             assert power > 0
             string_rep += str(var) + "Pow" + str(power) + "_"
         string_rep = string_rep.strip("_") # Remove the underscore at the end.
-        return string_rep
\ No newline at end of file
+        return string_rep
+
+class MomentRegistry(object):
+    def __init__(self, random_vector, moments=None):
+        """ Interns instances of Moment keyed by their multi-index relative to a random vector, so
+            that finding or creating the moment for a given variable power map is O(1).
+
+        Args:
+            random_vector (RandomVector): random vector the multi-indices are taken relative to.
+            moments (list of Moment, optional): moments to register initially. Defaults to None.
+        """
+        self._random_vector = random_vector
+        self._moments = dict() # Multi-index -> Moment, kept in insertion order.
+        if moments:
+            for moment in moments:
+                self.add(moment)
+
+    @property
+    def random_vector(self):
+        return self._random_vector
+
+    @property
+    def moments(self):
+        """
+        Returns:
+            list of Moment: registered moments in the order they were registered.
+        """
+        return list(self._moments.values())
+
+    def __len__(self):
+        return len(self._moments)
+
+    def __iter__(self):
+        return iter(list(self._moments.values()))
+
+    def __contains__(self, moment):
+        vpm = moment.vpm if isinstance(moment, Moment) else moment
+        return self._random_vector.contains(vpm.keys()) and self.key(vpm) in self._moments
+
+    def key(self, vpm):
+        """ Canonical key of a variable power map.
+
+        Args:
+            vpm (dict RandomVariable -> int): variable power map.
+
+        Raises:
+            Exception: a variable of vpm is not an element of the random vector.
+
+        Returns:
+            tuple of int: multi-index of vpm relative to the random vector.
+        """
+        if not self._random_vector.contains(vpm.keys()):
+            raise Exception("MomentRegistry.key received a variable that is not in its random vector.")
+        return self._random_vector.multi_idx(vpm)
+
+    def get(self, vpm, default=None):
+        """ Find the registered moment for a variable power map.
+        """
+        return self._moments.get(self.key(vpm), default)
+
+    def add(self, moment):
+        """ Register an instance of Moment.
+
+        Raises:
+            Exception: a different instance of Moment is registered with the same key.
+        """
+        key = self.key(moment.vpm)
+        existing = self._moments.setdefault(key, moment)
+        if existing is not moment and existing != moment:
+            raise Exception("MomentRegistry.add found a conflicting moment for " + str(moment) + ".")
+
+    def intern_multi_idx(self, multi_index):
+        """ Same as intern, but with a multi-index relative to the registry's random vector.
+        """
+        moment = self._moments.get(multi_index)
+        if moment is not None:
+            return moment, False
+        moment = Moment(self._random_vector.vpm(multi_index))
+        self._moments[multi_index] = moment
+        return moment, True
+
+    def intern(self, vpm):
+        """ Find the registered moment for a variable power map. If one doesn't exist,
+            create and register a new one.
+
+        Args:
+            vpm (dict RandomVariable -> int): variable power map.
+
+        Returns:
+            Moment: the registered moment.
+            bool: True if the moment was created by this call.
+        """
+        key = self.key(vpm)
+        moment = self._moments.get(key)
+        if moment is not None:
+            return moment, False
+        moment = Moment(vpm)
+        self._moments[key] = moment
+        return moment, True
@@ -0,0 +1,162 @@
+""" Instrumentation of derivations. Time and call counts are recorded per phase, along with the cost of
+expanding each state moment in tree_ring and each expression in generate_moment_expressions:
+
+    with collect_stats() as stats:
+        msds = tree_ring(initial_moment_state, pds)
+    print(stats.report())
+
+Phases nest, e.g. "moment_lookup" is part of "moment_expression". Nothing is recorded, and the overhead is
+negligible, when no stats are being collected.
+"""
+import contextlib
+import functools
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+PhaseStats = namedtuple("PhaseStats", ["calls", "seconds"])
+ExpansionStats = namedtuple("ExpansionStats", ["seconds", "terms", "new_state_moments", "new_disturbance_moments"])
+
+_local = threading.local()
+_null_phase = contextlib.nullcontext()
+
+class DerivationStats(object):
+    def __init__(self):
+        """ Statistics of the derivations run while collecting. See collect_stats.
+        """
+        self._phases = OrderedDict() # Phase name -> [calls, seconds].
+        self._moments = OrderedDict() # Moment -> ExpansionStats.
+        self._expressions = OrderedDict() # Name -> ExpansionStats.
+        self._open = set() # Phases that are running.
+
+    def add(self, phase, seconds, calls=1):
+        record = self._phases.setdefault(phase, [0, 0.0])
+        record[0] += calls
+        record[1] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time a phase. A phase that is entered while it is already running (e.g. a printer that delegates
+            to another printer) is only recorded once.
+        """
+        if name in self._open:
+            yield
+            return
+        self._open.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._open.discard(name)
+            self.add(name, time.perf_counter() - start)
+
+    def record_moment(self, moment, stats):
+        """ Record the expansion of a state moment by tree_ring.
+
+        Args:
+            moment (Moment):
+            stats (ExpansionStats):
+        """
+        self._moments[moment] = stats
+
+    def record_expression(self, name, stats):
+        """ Record the derivation of a named expression by generate_moment_expressions.
+
+        Args:
+            name (str):
+            stats (ExpansionStats): every new moment counts as a new state moment.
+        """
+        self._expressions[name] = stats
+
+    @property
+    def phases(self):
+        """ dict str -> PhaseStats: calls and total time of each phase, in the order they first ran.
+        """
+        return OrderedDict((name, PhaseStats(*record)) for name, record in self._phases.items())
+
+    @property
+    def moments(self):
+        """ dict Moment -> ExpansionStats: expansions of state moments, in the order they were expanded.
+        """
+        return self._moments
+
+    @property
+    def expressions(self):
+        """ dict str -> ExpansionStats: derivations of named expressions, in the order they were derived.
+        """
+        return self._expressions
+
+    def most_expensive_moments(self, n=10, key="seconds"):
+        """ The n state moment expansions with the largest key, e.g. "seconds" or "terms".
+
+        Returns:
+            list of tuples (Moment, ExpansionStats):
+        """
+        return sorted(self._moments.items(), key=lambda item: getattr(item[1], key), reverse=True)[:n]
+
+    def report(self, n=10):
+        """ Human readable summary of the phases and the n most expensive state moment expansions.
+
+        Returns:
+            str:
+        """
+        lines = ["%-24s %10s %12s" % ("phase", "calls", "seconds")]
+        for name, stats in self.phases.items():
+            lines.append("%-24s %10d %12.4f" % (name, stats.calls, stats.seconds))
+        for title, items in [("expression", list(self._expressions.items())),
+                             ("state moment", self.most_expensive_moments(n))]:
+            if not items:
+                continue
+            lines.append("")
+            lines.append("%-40s %12s %8s %10s %14s" % (title, "seconds", "terms", "new_state", "new_disturbance"))
+            for key, stats in items:
+                lines.append("%-40s %12.4f %8d %10d %14d" % (key, stats.seconds, stats.terms, stats.new_state_moments,
+                                                            stats.new_disturbance_moments))
+        return "\n".join(lines)
+
+def active_stats():
+    """ The innermost DerivationStats being collected in this thread, or None.
+    """
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+@contextlib.contextmanager
+def collect_stats(stats=None):
+    """ Collect statistics of the derivations run inside the context.
+
+    Args:
+        stats (DerivationStats, optional): accumulate into existing stats. Defaults to new stats.
+
+    Yields:
+        DerivationStats:
+    """
+    stats = stats if stats is not None else DerivationStats()
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    _local.stack.append(stats)
+    try:
+        yield stats
+    finally:
+        _local.stack.pop()
+
+def phase(name):
+    """ Context manager that times a phase if stats are being collected.
+    """
+    stats = active_stats()
+    return stats.phase(name) if stats is not None else _null_phase
+
+def profiled(name):
+    """ Decorator that times every call of a function as a phase.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count_terms(expression):
+    """ Number of terms of an expanded SymPy expression.
+    """
+    return len(expression.args) if expression.is_Add else (0 if expression == 0 else 1)
@@ -0,0 +1,16 @@
+""" Evaluation of derived moment expressions and moment state dynamics with NumPy only. This subpackage never
+imports SymPy or networkx, so that short-lived workers start quickly. Derivations are exported as artifacts:
+
+    moment_expressions.export_artifact("constraints.json")
+    msds.export_artifact("dynamics.json")
+
+and loaded by the workers:
+
+    from algebraic_moments.runtime import load_artifact
+    evaluator = load_artifact("constraints.json")
+    evaluator.evaluate_ranked(moment_vector, deterministic)
+    propagator = load_artifact("dynamics.json")
+    propagator.propagate_horizon(initial_moment_state, control_inputs, disturbance_moments)
+    propagator.compile().horizon(initial_moment_state, control_inputs, disturbance_moments) # Generated C code.
+"""
+from algebraic_moments.runtime.artifacts import MomentEvaluator, MomentPropagator, load_artifact, save_artifact
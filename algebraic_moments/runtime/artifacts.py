@@ -0,0 +1,248 @@
+""" Artifacts of derivations and their NumPy evaluators. An artifact is a JSON document with the generated
+Python (and optionally C) source of a derivation and the names and order of its inputs and outputs.
+"""
+import json
+import math
+import os
+import tempfile
+import numpy as np
+from algebraic_moments.native import build_shared_library, horizon_arrays, NativePropagator
+
+ARTIFACT_FORMAT = "algebraic_moments.artifact"
+ARTIFACT_VERSION = 3
+
+def compile_function(source, name, filename):
+    """ Execute generated Python source and return the function it defines.
+
+    Args:
+        source (str): generated source, which may use the math and numpy modules.
+        name (str): name of the function.
+        filename (str): name of the source in tracebacks, e.g. "<evaluate_ranked>".
+    """
+    namespace = {"math" : math, "numpy" : np}
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace[name]
+
+def evaluate_ranked(evaluate, size, n_outputs, moment_vector, deterministic, out=None):
+    """ Call a function generated by MomentExpressions.ranked_python_source.
+
+    Args:
+        evaluate (function): evaluate(moment_vector, deterministic, out).
+        size (int): number of rows of moment_vector the function reads.
+        n_outputs (int): number of expressions.
+        moment_vector (array of shape (R,) or (R, N)): moments indexed by rank, with R at least size.
+        deterministic (array of shape (n_deterministic,) or (n_deterministic, N)):
+        out (array of shape (n_outputs,) or (n_outputs, N), optional): output buffer.
+
+    Returns:
+        array of shape (n_outputs,) or (n_outputs, N):
+    """
+    moment_vector = np.asarray(moment_vector, dtype=np.float64)
+    deterministic = np.asarray(deterministic, dtype=np.float64)
+    if moment_vector.shape[0] < size:
+        raise Exception("moment_vector should have at least " + str(size) + " rows.")
+    shape = (n_outputs,) + np.broadcast_shapes(moment_vector.shape[1:], deterministic.shape[1:])
+    if out is None:
+        out = np.empty(shape)
+    if out.shape != shape:
+        raise Exception("out should have shape " + str(shape) + ".")
+    if len(shape) == 1:
+        # Arithmetic on Python floats is much cheaper than on NumPy scalars.
+        out[:] = evaluate(moment_vector.tolist(), deterministic.tolist(), [0.0] * shape[0])
+    else:
+        evaluate(moment_vector, deterministic, out)
+    return out
+
+def propagate_horizon(propagate, n_state, n_control, n_disturbance, initial_moment_state, control_inputs,
+                      disturbance_moments, out=None):
+    """ Call a function generated by MomentStateDynamicalSystem.horizon_python_source. The arguments after
+        n_disturbance are those of MomentStateDynamicalSystem.propagate_horizon.
+
+    Args:
+        propagate (function): propagate_horizon(initial_moment_state, control_inputs, disturbance_moments,
+            trajectory).
+        n_state (int): number of state moments.
+        n_control (int): number of control variables.
+        n_disturbance (int): number of disturbance moments.
+
+    Returns:
+        array of shape (T, n_state) or (T, n_state, N): the trajectory.
+    """
+    arrays, out = horizon_arrays(initial_moment_state, control_inputs, disturbance_moments, n_state, n_control,
+                                 n_disturbance, out)
+    initial, controls, disturbances, trajectory = arrays
+    if trajectory.shape[2] == 1:
+        # Arithmetic on Python floats is much cheaper than on arrays of one element.
+        steps = trajectory[:, :, 0].tolist()
+        propagate(initial[0, :, 0].tolist(), controls[:, :, 0].tolist(), disturbances[:, :, 0].tolist(), steps)
+        trajectory[:, :, 0] = steps
+    else:
+        propagate(initial[0], controls, disturbances, trajectory)
+    return out
+
+class MomentEvaluator(object):
+    def __init__(self, artifact):
+        """ Evaluator of the moment expressions of an artifact exported by MomentExpressions.export_artifact.
+
+        Args:
+            artifact (dict): artifact of kind "moment_expressions".
+        """
+        self._names = list(artifact["names"])
+        self._moments = list(artifact["moments"])
+        self._moment_ranks = list(artifact["moment_ranks"])
+        self._deterministic_variables = list(artifact["deterministic_variables"])
+        self._size = max(self._moment_ranks, default=-1) + 1
+        self._evaluate = compile_function(artifact["python_source"], "evaluate", "<evaluate_ranked>")
+
+    @property
+    def names(self):
+        """ list of str: names of the expressions, in the order of the outputs.
+        """
+        return self._names
+
+    @property
+    def moments(self):
+        """ list of str: names of the required input moments.
+        """
+        return self._moments
+
+    @property
+    def moment_ranks(self):
+        """ list of int: rank of each required input moment, see MomentExpressions.moment_ranks.
+        """
+        return self._moment_ranks
+
+    @property
+    def deterministic_variables(self):
+        return self._deterministic_variables
+
+    def moment_vector_size(self):
+        return self._size
+
+    def evaluate_ranked(self, moment_vector, deterministic, out=None):
+        """ Evaluate every expression from flat arrays, see MomentExpressions.evaluate_ranked.
+        """
+        return evaluate_ranked(self._evaluate, self._size, len(self._names), moment_vector, deterministic, out)
+
+    def evaluate(self, input_moments, input_deterministic):
+        """ Evaluate every expression from inputs keyed by name, like MomentExpressions.evaluate_batch.
+
+        Args:
+            input_moments (dict str -> float or array): value of each required input moment.
+            input_deterministic (dict str -> float or array): value of each deterministic variable.
+
+        Returns:
+            dict str -> float or array: value of each expression, broadcast to the shape of the inputs.
+        """
+        moments = np.broadcast_arrays(*[np.asarray(input_moments[name], dtype=np.float64) for name in self._moments])
+        deterministic = [np.asarray(input_deterministic[name], dtype=np.float64) for name in self._deterministic_variables]
+        shape = np.broadcast_shapes(*[value.shape for value in moments + deterministic])
+        moment_vector = np.zeros((self._size,) + shape)
+        for rank, value in zip(self._moment_ranks, moments):
+            moment_vector[rank] = value
+        # Evaluate a flat batch of every input.
+        n = int(np.prod(shape))
+        deterministic = np.array([np.broadcast_to(value, shape).ravel() for value in deterministic]).reshape(-1, n)
+        outputs = self.evaluate_ranked(moment_vector.reshape(self._size, n), deterministic)
+        return {name : output.reshape(shape) for name, output in zip(self._names, outputs)}
+
+class MomentPropagator(object):
+    def __init__(self, artifact):
+        """ Propagator of the moment state dynamics of an artifact exported by
+            MomentStateDynamicalSystem.export_artifact.
+
+        Args:
+            artifact (dict): artifact of kind "moment_state_dynamics".
+        """
+        self._moment_state = list(artifact["moment_state"])
+        self._disturbance_moments = list(artifact["disturbance_moments"])
+        self._control_variables = list(artifact["control_variables"])
+        self._c_source = artifact.get("c_source")
+        self._horizon = compile_function(artifact["python_source"], "propagate_horizon", "<propagate_horizon>")
+
+    @property
+    def moment_state(self):
+        """ list of str: names of the state moments, in the order of the rows of moment states.
+        """
+        return self._moment_state
+
+    @property
+    def disturbance_moments(self):
+        return self._disturbance_moments
+
+    @property
+    def control_variables(self):
+        return self._control_variables
+
+    def propagate_horizon(self, initial_moment_state, control_inputs, disturbance_moments, out=None):
+        """ Propagate moment states over a horizon, see MomentStateDynamicalSystem.propagate_horizon.
+        """
+        return propagate_horizon(self._horizon, len(self._moment_state), len(self._control_variables),
+                                 len(self._disturbance_moments), initial_moment_state, control_inputs,
+                                 disturbance_moments, out)
+
+    def compile(self, build_directory=None, compiler=None):
+        """ Build the C source of the artifact, see MomentStateDynamicalSystem.compile.
+
+        Raises:
+            Exception: the artifact has no C source, or the compilation failed.
+
+        Returns:
+            NativePropagator:
+        """
+        if self._c_source is None:
+            raise Exception("The artifact was exported without C source.")
+        library_path = build_shared_library(self._c_source, build_directory, compiler)
+        return NativePropagator(library_path, len(self._moment_state), len(self._disturbance_moments),
+                                len(self._control_variables))
+
+_evaluators = {"moment_expressions" : MomentEvaluator, "moment_state_dynamics" : MomentPropagator}
+
+def make_artifact(kind, **fields):
+    """ Artifact of a derivation.
+
+    Args:
+        kind (str): "moment_expressions" or "moment_state_dynamics".
+        fields: contents of the artifact, see MomentEvaluator and MomentPropagator.
+
+    Returns:
+        dict:
+    """
+    if kind not in _evaluators:
+        raise Exception("Unknown artifact kind " + str(kind) + ".")
+    return dict(format=ARTIFACT_FORMAT, version=ARTIFACT_VERSION, kind=kind, **fields)
+
+def save_artifact(path, artifact):
+    """ Write an artifact to a JSON file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    # Write to a temporary file and rename it, so that workers never load a partial artifact.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(artifact, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def load_artifact(artifact):
+    """ Load an artifact.
+
+    Args:
+        artifact (str or dict): path of a JSON file written by save_artifact, or the artifact itself.
+
+    Raises:
+        Exception: artifact isn't an artifact of a supported version.
+
+    Returns:
+        MomentEvaluator or MomentPropagator: evaluator of the kind of the artifact.
+    """
+    if isinstance(artifact, str):
+        with open(artifact) as f:
+            artifact = json.load(f)
+    if artifact.get("format") != ARTIFACT_FORMAT or artifact.get("version") != ARTIFACT_VERSION:
+        raise Exception("Unsupported artifact, expected version " + str(ARTIFACT_VERSION) + " of " + ARTIFACT_FORMAT + ".")
+    if artifact.get("kind") not in _evaluators:
+        raise Exception("Unknown artifact kind " + str(artifact.get("kind")) + ".")
+    return _evaluators[artifact["kind"]](artifact)
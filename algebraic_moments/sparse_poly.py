@@ -0,0 +1,276 @@
+""" Sparse multivariate polynomials used to expand expressions without building intermediate SymPy expressions.
+
+A polynomial is a dict that maps a monomial, a tuple of exponents over the generators of its ring, to a nonzero
+Python number (int, Fraction or float). The generators of a ring are random variables followed by coefficient
+generators, which are the deterministic symbols of the expressions and any subexpression that is not a
+polynomial but doesn't depend on the random variables (e.g. sqrt(c)).
+"""
+import operator
+from fractions import Fraction
+from functools import cmp_to_key
+import sympy as sp
+
+_canonical_order = cmp_to_key(sp.Basic.compare)
+
+def to_number(expr):
+    """ Convert a SymPy rational or float to a Python number, or return None for other expressions.
+    """
+    if expr.is_Integer:
+        return int(expr)
+    elif expr.is_Rational:
+        return Fraction(int(expr.p), int(expr.q))
+    elif expr.is_Float:
+        return float(expr)
+    else:
+        return None
+
+def to_sympy_number(number):
+    if isinstance(number, Fraction):
+        return sp.Rational(number.numerator, number.denominator)
+    else:
+        return sp.sympify(number)
+
+def product(coeff, factors):
+    """ Construct the SymPy product coeff * prod(factors) without Mul's simplification pass, which
+        queries assumptions of every argument and dominates the cost of assembling large expressions.
+
+    Args:
+        coeff (SymPy expression): coefficient of the product.
+        factors (list of SymPy expressions): powers of distinct symbols or other atoms with no numerical
+            coefficient, whose bases don't appear in coeff.
+
+    Returns:
+        SymPy expression: the same canonical expression as sympy.Mul(coeff, *factors).
+    """
+    if not factors:
+        return coeff
+    number, coeff_factors = coeff.as_coeff_mul()
+    return _sorted_product(number, sorted(list(coeff_factors) + list(factors), key=_canonical_order))
+
+def _sorted_product(number, args):
+    """ Construct number * prod(args) where args are in canonical order.
+    """
+    if number == 0:
+        return sp.S.Zero
+    if number != 1:
+        args = [number] + list(args)
+    if not args:
+        return number
+    if len(args) == 1:
+        return args[0]
+    return sp.Mul._from_args(args)
+
+class PolynomialRing(object):
+    def __init__(self, random_variables, coefficient_generators):
+        """
+
+        Args:
+            random_variables (list of RandomVariable): random variables, in the order of the multi-indices.
+            coefficient_generators (list of SymPy expressions): generators of the coefficients.
+        """
+        self._random_variables = tuple(random_variables)
+        self._coefficient_generators = tuple(coefficient_generators)
+        self._gens = self._random_variables + self._coefficient_generators
+        self._index = {gen : i for i, gen in enumerate(self._gens)}
+        self._n_random = len(self._random_variables)
+        self._one = (0,) * len(self._gens)
+        # Powers of distinct symbols can be multiplied with product, but generators like sqrt(c) and c
+        # combine into a single power and need Mul.
+        self._symbolic_coefficients = all(gen.is_Symbol for gen in self._coefficient_generators)
+        self._monomial_factors = dict() # Exponents of the coefficient generators -> factors in canonical order.
+
+    @classmethod
+    def from_expressions(cls, random_variables, expressions):
+        """ Construct the ring of a collection of expressions.
+
+        Args:
+            random_variables (list of RandomVariable):
+            expressions (list of SymPy expressions): expressions that should be elements of the ring.
+
+        Raises:
+            sympy.PolynomialError: an expression is not a polynomial in random_variables.
+
+        Returns:
+            PolynomialRing:
+        """
+        random_variables = list(random_variables)
+        random = set(random_variables)
+        generators = dict() # Ordered set of coefficient generators.
+        stack = [sp.sympify(expr) for expr in expressions]
+        while stack:
+            expr = stack.pop()
+            if expr in random or to_number(expr) is not None:
+                continue
+            if expr.is_Add or expr.is_Mul:
+                stack.extend(expr.args)
+            elif expr.is_Pow and expr.exp.is_Integer and expr.exp >= 0:
+                stack.append(expr.base)
+            elif expr.free_symbols & random:
+                raise sp.PolynomialError(str(expr) + " is not a polynomial in the random variables.")
+            else:
+                generators[expr] = None
+        return cls(random_variables, sorted(generators, key=sp.default_sort_key))
+
+    @property
+    def random_variables(self):
+        return self._random_variables
+
+    @property
+    def coefficient_generators(self):
+        return self._coefficient_generators
+
+    def constant(self, number):
+        return SparsePolynomial(self, {self._one : number} if number else dict())
+
+    def generator(self, gen):
+        monomial = [0] * len(self._gens)
+        monomial[self._index[gen]] = 1
+        return SparsePolynomial(self, {tuple(monomial) : 1})
+
+    def from_expr(self, expr):
+        """ Convert a SymPy expression to an element of this ring.
+
+        Raises:
+            sympy.PolynomialError: expr is not an element of this ring.
+        """
+        expr = sp.sympify(expr)
+        if expr in self._index:
+            return self.generator(expr)
+        number = to_number(expr)
+        if number is not None:
+            return self.constant(number)
+        if expr.is_Add:
+            result = self.constant(0)
+            for arg in expr.args:
+                result.iadd(self.from_expr(arg))
+            return result
+        elif expr.is_Mul:
+            result = self.constant(1)
+            for arg in expr.args:
+                result = result * self.from_expr(arg)
+            return result
+        elif expr.is_Pow and expr.exp.is_Integer and expr.exp >= 0:
+            return self.from_expr(expr.base)**int(expr.exp)
+        else:
+            raise sp.PolynomialError(str(expr) + " is not an element of the polynomial ring.")
+
+    def coefficient_expr(self, coefficient_terms):
+        """ Convert the coefficient of a random monomial to a SymPy expression.
+
+        Args:
+            coefficient_terms (dict tuple -> number): maps exponents of the coefficient generators to numbers.
+        """
+        terms = []
+        for monomial, number in coefficient_terms.items():
+            factors = self._monomial_factors.get(monomial)
+            if factors is None:
+                factors = [gen**power for gen, power in zip(self._coefficient_generators, monomial) if power]
+                factors = sorted(factors, key=_canonical_order)
+                self._monomial_factors[monomial] = factors
+            if self._symbolic_coefficients:
+                terms.append(_sorted_product(to_sympy_number(number), factors))
+            else:
+                terms.append(sp.Mul(to_sympy_number(number), *factors))
+        return sp.Add(*terms)
+
+class SparsePolynomial(object):
+    __slots__ = ("_ring", "_terms")
+
+    def __init__(self, ring, terms):
+        """
+
+        Args:
+            ring (PolynomialRing):
+            terms (dict tuple -> number): maps monomials to nonzero coefficients.
+        """
+        self._ring = ring
+        self._terms = terms
+
+    @property
+    def ring(self):
+        return self._ring
+
+    @property
+    def terms(self):
+        return self._terms
+
+    def __len__(self):
+        return len(self._terms)
+
+    def _coerce(self, other):
+        if isinstance(other, SparsePolynomial):
+            if other._ring is not self._ring:
+                raise Exception("Can't combine elements of different instances of PolynomialRing.")
+            return other
+        return self._ring.from_expr(other)
+
+    def iadd(self, other):
+        """ Add other to this polynomial in place.
+        """
+        terms = self._terms
+        for monomial, coeff in self._coerce(other)._terms.items():
+            coeff = terms.get(monomial, 0) + coeff
+            if coeff:
+                terms[monomial] = coeff
+            else:
+                terms.pop(monomial, None)
+        return self
+
+    def __add__(self, other):
+        return SparsePolynomial(self._ring, dict(self._terms)).iadd(other)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return SparsePolynomial(self._ring, {monomial : -coeff for monomial, coeff in self._terms.items()})
+
+    def __sub__(self, other):
+        return self + (-self._coerce(other))
+
+    def __mul__(self, other):
+        other = self._coerce(other)
+        terms = dict()
+        add = operator.add
+        for monomial, coeff in self._terms.items():
+            for other_monomial, other_coeff in other._terms.items():
+                product = tuple(map(add, monomial, other_monomial))
+                terms[product] = terms.get(product, 0) + coeff * other_coeff
+        return SparsePolynomial(self._ring, {monomial : coeff for monomial, coeff in terms.items() if coeff})
+
+    __rmul__ = __mul__
+
+    def __pow__(self, power):
+        if not isinstance(power, int) or power < 0:
+            raise Exception("SparsePolynomial only supports nonnegative integer powers.")
+        # Square and multiply.
+        result = self._ring.constant(1)
+        base = self
+        while power:
+            if power & 1:
+                result = result * base
+            power >>= 1
+            if power:
+                base = base * base
+        return result
+
+    def random_terms(self):
+        """ Group the terms by their monomial in the random variables.
+
+        Returns:
+            dict tuple -> dict tuple -> number: maps multi-indices of the random variables to the coefficient, as
+                a map from exponents of the coefficient generators to numbers.
+        """
+        n = self._ring._n_random
+        grouped = dict()
+        for monomial, coeff in self._terms.items():
+            grouped.setdefault(monomial[:n], dict())[monomial[n:]] = coeff
+        return grouped
+
+    def as_expr(self):
+        """ Convert this polynomial to a SymPy expression.
+        """
+        terms = []
+        for multi_index, coefficient_terms in self.random_terms().items():
+            factors = [var**power for var, power in zip(self._ring.random_variables, multi_index) if power]
+            terms.append(product(self._ring.coefficient_expr(coefficient_terms), factors))
+        return sp.Add(*terms)
@@ -0,0 +1,107 @@
+import algebraic_moments.objects as ao
+import algebraic_moments.cache as ac
+from algebraic_moments.cache import DerivationCache
+from algebraic_moments.moment_expressions import generate_moment_expressions, generate_multi_index_moment_expressions
+from algebraic_moments.tree_ring import tree_ring
+from algebraic_moments.test.test_tree_ring import treering_system
+import os
+import sympy as sp
+
+def test_cache_key(tmp_path):
+    cache = DerivationCache(str(tmp_path))
+    x = ao.RandomVariable("x")
+    y = ao.RandomVariable("y")
+    z = ao.RandomVariable("z")
+    c = ao.DeterministicVariable("c")
+    vector = ao.RandomVector([x, y, z], [(x, y), (y, z)])
+    # The key doesn't depend on the order of variables or dependence edges.
+    key = cache.key("generate_moment_expressions", {"a" : c * x, "b" : y**2}, vector, [c])
+    assert key == cache.key("generate_moment_expressions", {"a" : c * x, "b" : y**2},
+                            ao.RandomVector([z, y, x], [(z, y), (y, x)]), [c])
+    assert cache.key("a", ao.Moment({x : 1, y : 2})) == cache.key("a", ao.Moment({y : 2, x : 1}))
+    # The order of the expressions is the order of the outputs, so it is part of the key.
+    assert key != cache.key("generate_moment_expressions", {"b" : y**2, "a" : c * x}, vector, [c])
+    assert key != cache.key("generate_moment_expressions", {"a" : c * x, "b" : y**3}, vector, [c])
+    assert key != cache.key("generate_moment_expressions", {"a" : c * x, "b" : y**2},
+                            ao.RandomVector([x, y, z], [(x, y)]), [c])
+    assert key != cache.key("tree_ring", {"a" : c * x, "b" : y**2}, vector, [c])
+    # Distribution annotations are part of the key.
+    annotated = ao.RandomVector([x, y, z], [(x, y), (y, z)], {x : ao.Gaussian(0, 1)})
+    assert key != cache.key("generate_moment_expressions", {"a" : c * x, "b" : y**2}, annotated, [c])
+    assert cache.key("a", annotated) != cache.key("a", ao.RandomVector([x, y, z], [(x, y), (y, z)], {x : ao.Gaussian(0, 2)}))
+    assert cache.key("a", ao.RandomVector([x, y, z], [], {x : ao.Gaussian(0, 1), y : ao.ZeroMean()})) == \
+        cache.key("a", ao.RandomVector([x, y, z], [], {y : ao.ZeroMean(), x : ao.Gaussian(0, 1)}))
+
+def test_moment_expressions_cache(tmp_path):
+    cache = DerivationCache(str(tmp_path))
+    x = ao.RandomVariable("x")
+    y = ao.RandomVariable("y")
+    c = ao.DeterministicVariable("c")
+    vector = ao.RandomVector([x, y], [(x, y)])
+    expressions = {"first" : c * x * y + y, "second" : (c * x * y + y)**2}
+    derived = generate_moment_expressions(expressions, vector, [c], cache=cache)
+    assert len(cache.entries()) == 1
+    loaded = generate_moment_expressions(expressions, vector, [c], cache=cache)
+    assert loaded is not derived
+    assert loaded.moment_expressions == derived.moment_expressions
+    assert [m.vpm for m in loaded.moments] == [m.vpm for m in derived.moments]
+
+    # Reordered expressions are derived again, so the outputs come in the order of the call.
+    reordered = generate_moment_expressions({"second" : expressions["second"], "first" : expressions["first"]},
+                                            vector, [c], cache=cache)
+    assert list(reordered.moment_expressions) == ["second", "first"]
+    assert len(cache.entries()) == 2
+
+def test_multi_index_cache(tmp_path):
+    cache = DerivationCache(str(tmp_path))
+    x = ao.RandomVariable("x")
+    y = ao.RandomVariable("y")
+    vector = ao.RandomVector([x, y], [(x, y)])
+    a, b = x + y, x * y
+    generate_multi_index_moment_expressions({"g1" : a, "g2" : b}, vector, [], multi_indices=[(1, 2)], cache=cache)
+    # Reordering the polynomials changes the meaning of the multi-index (1, 2).
+    loaded = generate_multi_index_moment_expressions({"g2" : b, "g1" : a}, vector, [], multi_indices=[(1, 2)], cache=cache)
+    expected = generate_multi_index_moment_expressions({"g2" : b, "g1" : a}, vector, [], multi_indices=[(1, 2)])
+    assert len(cache.entries()) == 2
+    assert list(loaded.moment_expressions) == ["g2Pow1_g1Pow2"]
+    assert sp.expand(loaded.moment_expressions["g2Pow1_g1Pow2"] - expected.moment_expressions["g2Pow1_g1Pow2"]) == 0
+
+def test_tree_ring_cache(tmp_path):
+    cache = DerivationCache(str(tmp_path))
+    pds, initial_moment_state = treering_system()
+    derived = tree_ring(initial_moment_state, pds, cache=cache)
+    loaded = tree_ring(initial_moment_state, pds, cache=cache)
+    assert loaded is not derived
+    assert loaded.moment_state == derived.moment_state
+    assert loaded.disturbance_moments == derived.disturbance_moments
+    for m in derived.moment_state:
+        assert sp.expand(loaded.moment_state_dynamics[m] - derived.moment_state_dynamics[m]) == 0
+    assert set(loaded.discovery_graph.edges) == set(derived.discovery_graph.edges)
+
+    # The reduced flag is part of the key.
+    tree_ring(initial_moment_state, pds, reduced=False, cache=cache)
+    assert len(cache.entries()) == 2
+
+def test_cache_eviction(tmp_path):
+    cache = DerivationCache(str(tmp_path), max_size_bytes=None)
+    for i in range(4):
+        cache.put(str(i), list(range(1000)))
+        os.utime(os.path.join(str(tmp_path), str(i) + ".pkl"), (i, i))
+    cache.get("0") # "1" is now the least recently used entry.
+    size = cache.entries()[0][1]
+    cache.evict(3 * size)
+    assert sorted(key for key, _, _ in cache.entries()) == ["0", "2", "3"]
+    cache.invalidate("2")
+    assert "2" not in cache and cache.get("2") is None
+    cache.invalidate()
+    assert cache.entries() == []
+
+def test_cache_format(tmp_path, monkeypatch):
+    cache = DerivationCache(str(tmp_path))
+    key = cache.key("a", [1, 2])
+    monkeypatch.setattr(ac, "CACHE_FORMAT", ac.CACHE_FORMAT + 1)
+    assert cache.key("a", [1, 2]) != key
+    # An entry that refers to a class that no longer exists is a miss.
+    with open(os.path.join(str(tmp_path), key + ".pkl"), "wb") as f:
+        f.write(b"calgebraic_moments.objects\nRemovedClass\n.")
+    assert key in cache and cache.get(key) is None
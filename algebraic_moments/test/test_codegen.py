@@ -0,0 +1,96 @@
+from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable
+from algebraic_moments.moment_expressions import generate_moment_expressions
+from algebraic_moments.codegen import count_flops, common_subexpressions, horner_form, prepare_expressions
+import contextlib
+import io
+import sympy as sp
+
+def printed_python(moment_expressions, **kwargs):
+    code = io.StringIO()
+    with contextlib.redirect_stdout(code):
+        moment_expressions.print_python(**kwargs)
+    return code.getvalue()
+
+def test_count_flops():
+    x, y, z = sp.symbols("x y z")
+    assert count_flops([x + y + z]) == 2
+    assert count_flops([x**3 * y - z]) == 4
+    assert count_flops([x**-2]) == 2
+
+def test_cse():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    s = DeterministicVariable("s")
+    vector = RandomVector([x, y], [(x, y)])
+    g = (c * x - s * y)**2
+    moment_expressions = generate_moment_expressions({"first" : g, "second" : g**2}, vector, [c, s])
+
+    temporaries, reduced = common_subexpressions(moment_expressions.moment_expressions)
+    assert temporaries
+    assert count_flops([expr for _, expr in temporaries] + list(reduced.values())) < \
+           count_flops(list(moment_expressions.moment_expressions.values()))
+
+    # The code printed with and without CSE computes the same values.
+    input_moments = {str(m) : 0.1 * (i + 1) for i, m in enumerate(moment_expressions.moments)}
+    inputs = {"input_moments" : input_moments, "input_deterministic" : {"c" : 0.3, "s" : -0.7}}
+    plain = dict(inputs)
+    exec(printed_python(moment_expressions), plain)
+    reduced = dict(inputs)
+    exec(printed_python(moment_expressions, cse=True), reduced)
+    for name in ["first", "second"]:
+        assert abs(plain[name] - reduced[name]) < 1e-12
+
+def test_temporary_names():
+    x = RandomVariable("x")
+    c = DeterministicVariable("c")
+    cse0 = DeterministicVariable("cse0")
+    c_pow2 = DeterministicVariable("c_pow2")
+    g = (c * x + cse0)**2 + c_pow2
+    moment_expressions = generate_moment_expressions({"first" : g, "second" : g**2}, RandomVector([x], []),
+                                                     [c, cse0, c_pow2])
+    temporaries, _, _ = prepare_expressions(moment_expressions.moment_expressions, cse=True, horner=[c])
+    names = [str(temp) for temp, _ in temporaries]
+    assert len(set(names)) == len(names) and "cse0" not in names and "c_pow2" not in names
+
+    # The temporaries don't overwrite the variables they are named like.
+    input_moments = {str(m) : 0.1 * (i + 1) for i, m in enumerate(moment_expressions.moments)}
+    inputs = {"input_moments" : input_moments, "input_deterministic" : {"c" : 0.3, "cse0" : -0.7, "c_pow2" : 0.2}}
+    plain = dict(inputs)
+    exec(printed_python(moment_expressions), plain)
+    for kwargs in [{"cse" : True}, {"horner" : True, "cse" : True}]:
+        reduced = dict(inputs)
+        exec(printed_python(moment_expressions, **kwargs), reduced)
+        for name in ["first", "second"]:
+            assert abs(plain[name] - reduced[name]) < 1e-12
+
+def test_horner():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    s = DeterministicVariable("s")
+    vector = RandomVector([x, y], [(x, y)])
+    g = (c * x - s * y + c * s)**2
+    moment_expressions = generate_moment_expressions({"first" : g, "second" : g**2}, vector, [c, s])
+    expressions = moment_expressions.moment_expressions
+
+    forms = horner_form(expressions, [c, s])
+    assert count_flops(list(forms.values())) < count_flops(list(expressions.values()))
+    for name in expressions:
+        assert sp.expand(forms[name] - expressions[name]) == 0
+    # Expressions that aren't polynomials in the variables are left alone.
+    assert horner_form({"r" : 1 / (c + 1)}, [c])["r"] == 1 / (c + 1)
+    _, _, report = prepare_expressions(expressions, cse=True, horner=[c, s])
+    assert report.startswith("Horner: ") and "CSE: " in report
+
+    input_moments = {str(m) : 0.1 * (i + 1) for i, m in enumerate(moment_expressions.moments)}
+    inputs = {"input_moments" : input_moments, "input_deterministic" : {"c" : 0.3, "s" : -0.7}}
+    plain = dict(inputs)
+    exec(printed_python(moment_expressions), plain)
+    for kwargs in [{"horner" : True}, {"horner" : True, "cse" : True}]:
+        nested = dict(inputs)
+        code = printed_python(moment_expressions, **kwargs)
+        assert "Horner: " in code and "**" not in code.split("# Moment expressions.")[1]
+        exec(code, nested)
+        for name in ["first", "second"]:
+            assert abs(plain[name] - nested[name]) < 1e-12
@@ -0,0 +1,90 @@
+from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable
+from algebraic_moments.derivatives import sparse_jacobian
+from algebraic_moments.generate_inequality import generate_concentration_inequality
+from algebraic_moments.tree_ring import tree_ring
+from algebraic_moments.test.test_tree_ring import treering_system
+import contextlib
+import io
+import shutil
+import subprocess
+import pytest
+import sympy as sp
+
+def printed(print_function, **kwargs):
+    code = io.StringIO()
+    with contextlib.redirect_stdout(code):
+        print_function(**kwargs)
+    return code.getvalue()
+
+def test_sparse_jacobian():
+    x, y, z = sp.symbols("x y z")
+    jacobian = sparse_jacobian({"f" : x * y, "g" : z**2 + x, "h" : y - y}, [x, y, z])
+    assert jacobian.shape == (3, 3)
+    assert jacobian.pattern() == ([0, 0, 1, 1], [0, 1, 0, 2])
+    assert jacobian.csr_pattern() == ([0, 2, 4, 4], [0, 1, 0, 2])
+    assert jacobian.named_entries()[("g", z)] == 2 * z
+    assert jacobian.as_matrix() == sp.Matrix([x * y, z**2 + x, 0]).jacobian([x, y, z])
+
+def test_msds_jacobians():
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    jacobians = msds.jacobians()
+    for name, variables in [("moment_state", msds.moment_state), ("control_inputs", msds.control_variables)]:
+        dense = sp.Matrix([msds.moment_state_dynamics[m] for m in msds.moment_state]).jacobian(variables)
+        assert jacobians[name].as_matrix() == dense
+        assert jacobians[name].nnz < dense.shape[0] * dense.shape[1]
+
+    # The printed entries, sharing common subexpressions with the dynamics, match the symbolic Jacobians.
+    inputs = {m : 0.1 * (i + 1) for i, m in enumerate(msds.moment_state + msds.disturbance_moments + msds.control_variables)}
+    namespace = {"prev_moment_state" : {str(m) : inputs[m] for m in msds.moment_state},
+                 "disturbance_moments" : {str(m) : inputs[m] for m in msds.disturbance_moments},
+                 "control_inputs" : {str(var) : inputs[var] for var in msds.control_variables}}
+    exec(printed(msds.print_python, cse=True, jacobians=True), namespace)
+    for name, jacobian in jacobians.items():
+        printed_entries = namespace["jacobian_" + name]
+        assert len(printed_entries) == jacobian.nnz
+        for (m, var), expr in jacobian.named_entries().items():
+            assert abs(printed_entries[(str(m), str(var))] - float(expr.subs(inputs))) < 1e-12
+
+def test_msds_cpp_jacobians(tmp_path):
+    if shutil.which("c++") is None:
+        pytest.skip("No C++ compiler available.")
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    source = tmp_path / "moments.cpp"
+    source.write_text(printed(msds.print_cpp, cse=True, jacobians=True))
+    subprocess.run(["c++", "-c", str(source), "-o", str(tmp_path / "moments.o")], check=True)
+
+@pytest.mark.parametrize("inequality_type", ["cantelli", "vp", "gauss"])
+def test_inequality_gradients(inequality_type):
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    s = DeterministicVariable("s")
+    vector = RandomVector([x, y], [(x, y)])
+    inequality = generate_concentration_inequality(c * x - s * y**2 + 1, vector, [c, s], inequality_type)
+    moments = inequality.moment_expressions.moments
+    inputs = {"input_moments" : {str(m) : 0.3 + 0.1 * i for i, m in enumerate(moments)},
+              "input_deterministic" : {"c" : 0.7, "s" : 0.2}}
+
+    def evaluate(inputs, **kwargs):
+        namespace = {key : dict(value) for key, value in inputs.items()}
+        exec(printed(inequality.print_python, **kwargs), namespace)
+        return namespace
+
+    # Compare the printed gradients against central differences.
+    namespace = evaluate(inputs, cse=True, gradients=True)
+    nested = evaluate(inputs, gradients=True, horner=True)
+    h = 1e-6
+    for output in ["probability_bound", "necessary_condition"]:
+        gradient = namespace[output + "_gradient"]
+        assert gradient
+        assert all(abs(nested[output + "_gradient"][name] - value) < 1e-12 for name, value in gradient.items())
+        for group in ["input_moments", "input_deterministic"]:
+            for name in inputs[group]:
+                plus = {key : dict(value) for key, value in inputs.items()}
+                plus[group][name] += h
+                minus = {key : dict(value) for key, value in inputs.items()}
+                minus[group][name] -= h
+                difference = (evaluate(plus)[output] - evaluate(minus)[output]) / (2 * h)
+                assert abs(gradient.get(name, 0.0) - difference) < 1e-5 * max(1.0, abs(difference))
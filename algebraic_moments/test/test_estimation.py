@@ -0,0 +1,90 @@
+from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable, Moment
+from algebraic_moments.moment_expressions import generate_moment_expressions
+from algebraic_moments.estimation import estimate_moments, input_moments, moment_vector, \
+    StreamingMomentEstimator
+import numpy as np
+
+def naive_moments(variables, moments, samples, weights=None):
+    weights = np.ones(samples.shape[0]) if weights is None else weights
+    values = []
+    for moment in moments:
+        monomial = np.ones(samples.shape[0])
+        for var, power in moment.vpm.items():
+            monomial *= samples[:, variables.index(var)]**power
+        values.append(np.sum(weights * monomial) / np.sum(weights))
+    return np.array(values)
+
+def test_estimate_moments():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    z = RandomVariable("z")
+    vector = RandomVector([x, y, z], [(x, y)])
+    moments = [Moment(vector.vpm(vector.unrank(rank))) for rank in range(1, vector.n_multi_indices(4))]
+    rng = np.random.default_rng(0)
+    samples = rng.normal(size=(1000, 3))
+    weights = rng.uniform(size=1000)
+
+    expected = naive_moments(vector.variables, moments, samples)
+    assert np.allclose(estimate_moments(vector, moments, samples, chunk_size=300), expected)
+    assert np.allclose(estimate_moments(vector, moments, samples, weights=weights),
+                       naive_moments(vector.variables, moments, samples, weights))
+
+    # Chunks from an iterator, with columns in a different order.
+    columns = [z, x, y]
+    reordered = samples[:, [2, 0, 1]]
+    chunks = (reordered[i:i + 128] for i in range(0, 1000, 128))
+    assert np.allclose(estimate_moments(vector, moments, chunks, variables=columns), expected)
+    weighted_chunks = ((samples[i:i + 128], weights[i:i + 128]) for i in range(0, 1000, 128))
+    assert np.allclose(estimate_moments(vector, moments, weighted_chunks),
+                       naive_moments(vector.variables, moments, samples, weights))
+
+def test_estimates_feed_evaluators():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [(x, y)])
+    moment_expressions = generate_moment_expressions({"g" : (c * x - y)**2}, vector, [c])
+    moments = moment_expressions.moments
+    samples = np.random.default_rng(1).normal(size=(500, 2))
+    values = estimate_moments(vector, moments, samples)
+
+    expected = np.mean((0.5 * samples[:, 0] - samples[:, 1])**2)
+    assert np.isclose(moment_expressions.evaluate_batch(input_moments(moments, values), {"c" : 0.5})["g"], expected)
+    assert np.isclose(moment_expressions.evaluate_ranked(moment_vector(vector, moments, values), [0.5])[0], expected)
+
+def test_streaming_estimator():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    vector = RandomVector([x, y], [(x, y)])
+    moments = [Moment(vector.vpm(vector.unrank(rank))) for rank in range(1, vector.n_multi_indices(3))]
+    samples = np.random.default_rng(2).normal(size=(400, 2))
+
+    # Without forgetting, single samples and mini-batches give the batch estimates.
+    estimator = StreamingMomentEstimator(vector, moments)
+    for sample in samples[:100]:
+        estimator.update(sample)
+    for i in range(100, 400, 60):
+        estimator.update(samples[i:i + 60])
+    assert np.allclose(estimator.snapshot(), estimate_moments(vector, moments, samples))
+
+    # Exponential forgetting weights the i-th sample by forgetting**(400 - 1 - i), however it is batched.
+    forgetting = 0.99
+    expected = naive_moments(vector.variables, moments, samples, forgetting**np.arange(399, -1, -1))
+    estimator = StreamingMomentEstimator(vector, moments, forgetting=forgetting)
+    for i in range(0, 400, 30):
+        estimator.update(samples[i:i + 30])
+    assert np.allclose(estimator.snapshot(), expected)
+
+    # A sliding window over the last 5 updates of 20 samples.
+    estimator = StreamingMomentEstimator(vector, moments, window=5)
+    for i in range(0, 400, 20):
+        estimator.update(samples[i:i + 20])
+        start = max(0, i + 20 - 100)
+        assert np.allclose(estimator.snapshot(), estimate_moments(vector, moments, samples[start:i + 20]))
+
+    estimator.reset()
+    try:
+        estimator.snapshot()
+        assert False
+    except Exception as e:
+        assert "no samples" in str(e)
@@ -1,5 +1,11 @@
-from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable
-from algebraic_moments.moment_expressions import generate_moment_expressions
+from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable, Moment, ZeroMean, \
+    Symmetric, Gaussian, IdenticallyDistributed
+from algebraic_moments.moment_expressions import generate_moment_expressions, generate_multi_index_moment_expressions
+import contextlib
+import io
+import numpy as np
+import pytest
+import sympy as sp
 
 def test_moment_expressions():
     x = RandomVariable("x")
@@ -11,4 +17,196 @@ def test_moment_expressions():
     moment_expressions = generate_moment_expressions(expressions, vector, deterministic_variables)
     moment_expressions.print_matlab()
 
+def test_evaluate_batch():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [(x, y)])
+    expressions = {"g1" : c * x * y + y**2, "g2" : 2 + 0 * c}
+    moment_expressions = generate_moment_expressions(expressions, vector, [c])
+
+    c_values = np.linspace(-1.0, 1.0, 5)
+    outputs = moment_expressions.evaluate_batch({"xPow1_yPow1" : 3.0, "yPow2" : np.arange(5.0)}, {"c" : c_values})
+    assert np.allclose(outputs["g1"], 3.0 * c_values + np.arange(5.0))
+    assert np.allclose(outputs["g2"], np.full(5, 2.0))
+
+    # Multi-index keys are relative to the random vector.
+    outputs = moment_expressions.evaluate_batch({(1, 1) : 3.0, (0, 2) : 1.0}, {"c" : c_values}, multi_idx_keys=True)
+    assert np.allclose(outputs["g1"], 3.0 * c_values + 1.0)
+
+def test_evaluate_ranked():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [(x, y)])
+    moment_expressions = generate_moment_expressions({"g1" : (c * x * y + y**2)**2, "g2" : c * x + 1}, vector, [c])
+    size = moment_expressions.moment_vector_size()
+    assert size == vector.n_multi_indices(4)
+
+    # A batch of moment vectors indexed by rank is a plain 2-D array.
+    rng = np.random.default_rng(0)
+    moment_vectors = rng.normal(size=(size, 6))
+    c_values = rng.normal(size=6)
+    input_moments = {str(m) : moment_vectors[rank] for m, rank in zip(moment_expressions.moments, moment_expressions.moment_ranks())}
+    expected = moment_expressions.evaluate_batch(input_moments, {"c" : c_values})
+    outputs = moment_expressions.evaluate_ranked(moment_vectors, c_values[None, :])
+    assert np.allclose(outputs, [expected["g1"], expected["g2"]])
+    assert np.allclose(moment_expressions.evaluate_ranked(moment_vectors[:, 0], [c_values[0]]), outputs[:, 0])
+
+    # The printed code with rank keys runs on flat arrays.
+    namespace = {"input_moments" : moment_vectors[:, 0], "input_deterministic" : [c_values[0]]}
+    code = io.StringIO()
+    with contextlib.redirect_stdout(code):
+        moment_expressions.print_python(rank_keys=True)
+    exec(code.getvalue(), namespace)
+    assert np.isclose(namespace["g1"], outputs[0, 0])
+
+    # Coefficients that aren't polynomials evaluate on batches too.
+    moment_expressions = generate_moment_expressions({"g" : sp.sqrt(c) * x * y + sp.cos(c) * y**2}, vector, [c])
+    moment_vectors = rng.normal(size=(moment_expressions.moment_vector_size(), 6))
+    c_values = rng.uniform(0.1, 1, size=6)
+    outputs = moment_expressions.evaluate_ranked(moment_vectors, c_values[None, :])
+    for k in range(6):
+        values = {m : moment_vectors[rank, k] for m, rank in zip(moment_expressions.moments, moment_expressions.moment_ranks())}
+        values[c] = c_values[k]
+        assert np.isclose(outputs[0, k], float(moment_expressions.moment_expressions["g"].subs(values)))
+        assert np.isclose(moment_expressions.evaluate_ranked(moment_vectors[:, k], [c_values[k]])[0], outputs[0, k])
+
+def test_distributions():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    z = RandomVariable("z")
+    w1 = RandomVariable("w1")
+    w2 = RandomVariable("w2")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y, z, w1, w2], [(x, z)], {x : Symmetric(), y : Gaussian(0, 2), w1 : ZeroMean(),
+                                                        w2 : IdenticallyDistributed(w1)})
+    expressions = {"g1" : (c * x + y)**4, "g2" : (w1 + w2)**2, "g3" : (x + z)**3}
+    moment_expressions = generate_moment_expressions(expressions, vector, [c])
+    result = moment_expressions.moment_expressions
+    xPow2, xPow4, w1Pow2 = Moment({x : 2}), Moment({x : 4}), Moment({w1 : 2})
+    assert sp.expand(result["g1"] - (c**4 * xPow4 + 12 * c**2 * xPow2 + 12)) == 0
+    assert sp.expand(result["g2"] - 2 * w1Pow2) == 0
+    # x is dependent on z, so the moments of x with z aren't simplified.
+    assert result["g3"].has(Moment({x : 1, z : 2}))
+    assert Moment({y : 2}) not in moment_expressions.moments and Moment({w2 : 2}) not in moment_expressions.moments
+
+    # The odd moments of a symmetric distribution with a nonzero mean are expressions of the lower ones.
+    vector = RandomVector([x], [], {x : Symmetric()})
+    result = generate_moment_expressions({"g" : x**3 + x, "h" : x**5}, vector, []).moment_expressions
+    xPow1, xPow3, xPow5 = Moment({x : 1}), Moment({x : 3}), Moment({x : 5})
+    assert sp.expand(result["g"] - (3 * xPow1 * xPow2 - 2 * xPow1**3 + xPow1)) == 0
+    assert not result["h"].has(xPow3) and not result["h"].has(xPow5)
+    # Check E[x**5] on a symmetric distribution with mean 1: the values -1, 1 and 3 with probabilities 1/4, 1/2, 1/4.
+    values = {m : sum(p * v**k for p, v in [(0.25, -1), (0.5, 1), (0.25, 3)]) for m, k in
+              [(xPow1, 1), (xPow2, 2), (Moment({x : 4}), 4)]}
+    assert abs(float(result["h"].subs(values)) - (0.25 * (-1) + 0.5 + 0.25 * 3**5)) < 1e-9
+
+    # The higher moments of a Gaussian with unknown parameters are expressions of its first two moments.
+    vector = RandomVector([z], [], {z : Gaussian()})
+    result = generate_moment_expressions({"g" : z**3}, vector, []).moment_expressions["g"]
+    zPow1, zPow2 = Moment({z : 1}), Moment({z : 2})
+    assert sp.expand(result - (3 * zPow1 * zPow2 - 2 * zPow1**3)) == 0
+
+    # With a known variance, E[z**2] is an expression of the unknown mean.
+    vector = RandomVector([z], [], {z : Gaussian(variance=3)})
+    result = generate_moment_expressions({"g" : z**2}, vector, [])
+    assert sp.expand(result.moment_expressions["g"] - (3 + zPow1**2)) == 0
+    assert result.moments == [zPow1]
+
+    # Identical distributions can't form a cycle.
+    with pytest.raises(Exception):
+        RandomVector([x, y, z], [], {x : IdenticallyDistributed(y), y : IdenticallyDistributed(z),
+                                     z : IdenticallyDistributed(x)})
+    with pytest.raises(Exception):
+        RandomVector([x], [], {x : IdenticallyDistributed(x)})
+    RandomVector([x, y, z], [], {x : IdenticallyDistributed(y), y : IdenticallyDistributed(z), z : Gaussian()})
+
+def test_multi_index_moment_expressions():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [(x, y)])
+    polynomials = {"g1" : c * x * y + y**2, "g2" : x - c}
+    moment_expressions = generate_multi_index_moment_expressions(polynomials, vector, [c], max_order=3)
+    g1, g2 = polynomials.values()
+    names = ["g1Pow1", "g2Pow1", "g1Pow2", "g1Pow1_g2Pow1", "g2Pow2", "g1Pow3", "g1Pow2_g2Pow1", "g1Pow1_g2Pow2", "g2Pow3"]
+    products = [g1, g2, g1**2, g1 * g2, g2**2, g1**3, g1**2 * g2, g1 * g2**2, g2**3]
+    expected = generate_moment_expressions(dict(zip(names, products)), vector, [c])
+    assert list(moment_expressions.moment_expressions) == names
+    for name in names:
+        assert sp.expand(moment_expressions.moment_expressions[name] - expected.moment_expressions[name]) == 0
+    assert set(moment_expressions.moments) == set(expected.moments)
+
+    # Lower order products that aren't requested are expanded, but not derived.
+    moment_expressions = generate_multi_index_moment_expressions(polynomials, vector, [c], multi_indices=[(1, 2)])
+    assert list(moment_expressions.moment_expressions) == ["g1Pow1_g2Pow2"]
+    assert sp.expand(moment_expressions.moment_expressions["g1Pow1_g2Pow2"] - expected.moment_expressions["g1Pow1_g2Pow2"]) == 0
+
+    # E[g^0] = 1 has no name.
+    with pytest.raises(Exception):
+        generate_multi_index_moment_expressions(polynomials, vector, [c], multi_indices=[(0, 0), (1, 0)])
+
+def test_parallel_derivation():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    z = RandomVariable("z")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y, z], [(x, y)], {z : ZeroMean()})
+    expressions = {"g" + str(k) : (c * x + y**k + z)**(k % 3 + 1) for k in range(6)}
+    serial = generate_moment_expressions(expressions, vector, [c])
+    parallel = generate_moment_expressions(expressions, vector, [c], processes=3)
+    assert parallel.moments == serial.moments
+    assert parallel.introduced_moments == serial.introduced_moments
+    for name in expressions:
+        assert sp.srepr(parallel.moment_expressions[name]) == sp.srepr(serial.moment_expressions[name])
+
+    # Moments that are already required aren't new.
+    added = {name : expressions[name] for name in ["g0", "g1", "g3"]}
+    moment_expressions = generate_moment_expressions({"g2" : expressions["g2"]}, vector, [c])
+    expected = generate_moment_expressions({"g2" : expressions["g2"]}, vector, [c])
+    assert moment_expressions.add_expressions(added, processes=2) == expected.add_expressions(added)
+    assert moment_expressions.moments == expected.moments
+
+def test_add_expressions():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [(x, y)])
+    expressions = {"g1" : c * x * y + y**2, "g2" : (c * x + y)**2, "g3" : x**3 + c}
+    full = generate_moment_expressions(expressions, vector, [c])
+
+    moment_expressions = generate_moment_expressions({"g1" : expressions["g1"]}, vector, [c])
+    moment_vector = np.arange(1.0, vector.n_multi_indices(3) + 1)
+    assert np.allclose(moment_expressions.evaluate_ranked(moment_vector, [2.0]), full.evaluate_ranked(moment_vector, [2.0])[:1])
+    g1 = moment_expressions.moment_expressions["g1"]
+
+    # Only the moments that g1 doesn't require are new, and g1 isn't derived again.
+    new_moments = moment_expressions.add_expressions({"g2" : expressions["g2"]})
+    assert new_moments == [Moment({x : 2})]
+    assert moment_expressions.moment_expressions["g1"] is g1
+
+    # Lazy expressions are derived on first access, and the compiled evaluators are rebuilt.
+    assert moment_expressions.add_expressions({"g3" : expressions["g3"]}, lazy=True) == []
+    assert moment_expressions.pending == ["g3"]
+    assert np.allclose(moment_expressions.evaluate_ranked(moment_vector, [2.0]), full.evaluate_ranked(moment_vector, [2.0]))
+    assert moment_expressions.pending == []
+    assert moment_expressions.introduced_moments["g3"] == [Moment({x : 3})]
+    assert list(moment_expressions.moment_expressions) == ["g1", "g2", "g3"]
+    assert set(moment_expressions.moments) == set(full.moments)
+    for name in expressions:
+        assert sp.expand(moment_expressions.moment_expressions[name] - full.moment_expressions[name]) == 0
+
+    # Expressions can be derived out of order, and keep the order they were added in.
+    lazy = generate_moment_expressions(expressions, vector, [c], lazy=True)
+    assert sp.expand(lazy.expression("g3") - full.moment_expressions["g3"]) == 0
+    assert lazy.pending == ["g1", "g2"]
+    assert list(lazy.moment_expressions) == ["g1", "g2", "g3"]
+
+    try:
+        lazy.add_expressions({"g1" : x})
+        assert False
+    except Exception as e:
+        assert "g1" in str(e)
+
 test_moment_expressions()
\ No newline at end of file
@@ -1,4 +1,8 @@
-from algebraic_moments.objects import RandomVariable, RandomVector, Moment
+from algebraic_moments.objects import RandomVariable, RandomVector, Moment, MomentRegistry, DependenceGraph, \
+    DeterministicVariable, ConcentrationInequality, ConcentrationInequalityType
+from algebraic_moments.generate_inequality import generate_concentration_inequality
+import itertools
+import numpy as np
 
 def test_RandomVariable():
     w = RandomVariable("w")
@@ -27,4 +31,95 @@ def test_Moment():
 
     # m1 should not equal another moment with a different vpm.
     m3 = Moment({w : 2, x : 3})
-    assert m3.same_vpm(m1) == False
\ No newline at end of file
+    assert m3.same_vpm(m1) == False
+
+def test_MomentRegistry():
+    w = RandomVariable("w")
+    x = RandomVariable("x")
+    rv = RandomVector([w, x], [(w, x)])
+    m1 = Moment({w : 1, x : 3})
+    registry = MomentRegistry(rv, [m1])
+
+    # Interning an equivalent vpm returns the registered instance.
+    moment, is_new = registry.intern({x : 3, w : 1})
+    assert moment is m1 and not is_new
+    assert registry.key(m1.vpm) == (1, 3) == m1.multi_idx(rv)
+
+    # Interning a new vpm registers a new moment, preserving insertion order.
+    moment, is_new = registry.intern({x : 2})
+    assert is_new and str(moment) == "xPow2"
+    assert registry.moments == [m1, moment]
+    assert {x : 2} in registry and Moment({w : 2}) not in registry
+
+def test_DependenceGraph():
+    variables = [RandomVariable(name) for name in ["a", "b", "c", "d", "e", "f"]]
+    a, b, c, d, e, f = variables
+    graph = DependenceGraph.from_lists(variables, [(a, b), (b, c), (d, e), (a, f)])
+
+    # The bitmask factorization should match networkx on every induced subgraph.
+    for n in range(len(variables) + 1):
+        for subset in itertools.combinations(variables, n):
+            components = {frozenset(comp) for comp in graph.subgraph_components(list(subset))}
+            nx_components = {frozenset(comp) for comp in graph.nx_subgraph_components(list(subset))}
+            assert components == nx_components
+    assert graph.mask_components(graph.support_mask([a, c, f])) == (graph.support_mask([a, f]), graph.support_mask([c]))
+
+def test_moment_ranks():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    z = RandomVariable("z")
+    random_vector = RandomVector([z, x, y], [])
+    # Graded lexicographic order: by degree, then descending lexicographic order.
+    multi_indices = [m for m in itertools.product(range(5), repeat=3) if sum(m) <= 4]
+    multi_indices.sort(key=lambda m: (sum(m), tuple(-power for power in m)))
+    assert len(multi_indices) == random_vector.n_multi_indices(4)
+    for rank, multi_index in enumerate(multi_indices):
+        assert random_vector.rank(multi_index) == rank
+        assert random_vector.unrank(rank) == multi_index
+
+def test_evaluate_bounds():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [(x, y)])
+    inequality = generate_concentration_inequality(c - x * y, vector, [c], "cantelli")
+    moments = inequality.moment_expressions.moments
+    rng = np.random.default_rng(0)
+    input_moments = {str(m) : rng.uniform(0.0, 0.5, size=200) for m in moments}
+    input_deterministic = {"c" : np.linspace(-2.0, 2.0, 200)}
+    evaluation = inequality.evaluate_bounds(input_moments, input_deterministic)
+    assert evaluation.probability_bounds.shape == (3, 200)
+
+    # Compare against each type separately, evaluated one point at a time.
+    for j in range(200):
+        point = {key : value[j] for key, value in input_moments.items()}
+        point_moments = inequality.moment_expressions.evaluate_batch(point, {"c" : input_deterministic["c"][j]})
+        best = 1.0
+        for i, inequality_type in enumerate(evaluation.types):
+            bound_expr, condition_expr = ConcentrationInequality.type_expressions(inequality_type)
+            values = {"first_moment" : float(point_moments["first_moment"]),
+                      "variance" : float(point_moments["second_moment"] - point_moments["first_moment"]**2)}
+            if values["variance"] < 0:
+                # Inconsistent moments.
+                assert not evaluation.valid[i, j]
+                continue
+            condition = float(condition_expr.subs(values))
+            assert np.isclose(evaluation.necessary_conditions[i, j], condition)
+            assert evaluation.valid[i, j] == (condition <= 0)
+            if condition <= 0:
+                bound = float(bound_expr.subs(values))
+                assert np.isclose(evaluation.probability_bounds[i, j], bound)
+                best = min(best, bound)
+        assert np.isclose(evaluation.best_bound[j], best)
+        if evaluation.best_type[j] >= 0:
+            assert np.isclose(evaluation.probability_bounds[evaluation.best_type[j], j], evaluation.best_bound[j])
+    assert np.any(evaluation.best_type == -1) and np.any(evaluation.best_type >= 0)
+
+    # Flat inputs give the same result.
+    moment_vector = np.zeros((inequality.moment_expressions.moment_vector_size(), 200))
+    for m, rank in zip(moments, inequality.moment_expressions.moment_ranks()):
+        moment_vector[rank] = input_moments[str(m)]
+    ranked = inequality.evaluate_bounds_ranked(moment_vector, input_deterministic["c"][None, :],
+                                               types=[ConcentrationInequalityType.GAUSS])
+    assert np.array_equal(ranked.valid[0], evaluation.valid[2])
+    assert np.allclose(ranked.probability_bounds[0][ranked.valid[0]], evaluation.probability_bounds[2][evaluation.valid[2]])
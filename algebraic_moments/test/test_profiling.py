@@ -0,0 +1,42 @@
+from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable
+from algebraic_moments.moment_expressions import generate_moment_expressions
+from algebraic_moments.profiling import collect_stats, active_stats
+from algebraic_moments.tree_ring import tree_ring
+from algebraic_moments.test.test_tree_ring import treering_system
+import contextlib
+import io
+
+def test_collect_stats():
+    pds, initial_moment_state = treering_system()
+    assert active_stats() is None
+    with collect_stats() as stats:
+        msds = tree_ring(initial_moment_state, pds)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # print_matlab delegates to print_octave, which should only be counted once.
+            msds.print_matlab()
+    assert active_stats() is None
+
+    phases = stats.phases
+    for name in ["dynamics_expansion", "polynomial_expansion", "factorization", "moment_lookup", "classification"]:
+        assert phases[name].calls > 0
+    assert phases["moment_expression"].calls == len(msds.moment_state)
+    assert phases["printing"].calls == 1
+
+    # Every state moment is expanded once, and each expansion accounts for the moments it discovered.
+    assert list(stats.moments) == msds.moment_state
+    assert sum(s.new_state_moments for s in stats.moments.values()) == len(msds.moment_state) - len(initial_moment_state)
+    assert sum(s.new_disturbance_moments for s in stats.moments.values()) == len(msds.disturbance_moments)
+    for m, s in stats.moments.items():
+        assert s.terms == len(msds.moment_state_dynamics[m].args)
+    assert "state moment" in stats.report()
+
+def test_collect_expression_stats():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    vector = RandomVector([x, y], [])
+    with collect_stats() as stats:
+        generate_moment_expressions({"first" : c * x + y, "second" : (c * x + y)**2}, vector, [c])
+    assert list(stats.expressions) == ["first", "second"]
+    assert stats.expressions["first"].terms == 2 and stats.expressions["first"].new_state_moments == 2
+    assert stats.expressions["second"].terms == 3
@@ -0,0 +1,86 @@
+import algebraic_moments.objects as ao
+from algebraic_moments.moment_expressions import generate_moment_expressions
+from algebraic_moments.runtime import load_artifact
+from algebraic_moments.tree_ring import tree_ring
+from algebraic_moments.test.test_tree_ring import treering_system
+import numpy as np
+import shutil
+import subprocess
+import sys
+import pytest
+import sympy as sp
+
+def test_moment_expressions_artifact(tmp_path):
+    x = ao.RandomVariable("x")
+    y = ao.RandomVariable("y")
+    c = ao.DeterministicVariable("c")
+    vector = ao.RandomVector([x, y], [(x, y)])
+    moment_expressions = generate_moment_expressions({"g1" : (c * x * y + y**2)**2, "g2" : c * x + 1}, vector, [c])
+    path = str(tmp_path / "expressions.json")
+    moment_expressions.export_artifact(path)
+    evaluator = load_artifact(path)
+    assert evaluator.names == ["g1", "g2"]
+
+    rng = np.random.default_rng(0)
+    moment_vector = rng.normal(size=(moment_expressions.moment_vector_size(), 6))
+    deterministic = rng.normal(size=(1, 6))
+    expected = moment_expressions.evaluate_ranked(moment_vector, deterministic)
+    assert np.allclose(evaluator.evaluate_ranked(moment_vector, deterministic), expected)
+    assert np.allclose(evaluator.evaluate_ranked(moment_vector[:, 0], deterministic[:, 0]), expected[:, 0])
+
+    input_moments = {str(m) : moment_vector[rank] for m, rank in zip(moment_expressions.moments, moment_expressions.moment_ranks())}
+    outputs = evaluator.evaluate(input_moments, {"c" : deterministic[0]})
+    assert np.allclose(outputs["g1"], expected[0]) and np.allclose(outputs["g2"], expected[1])
+
+    # Coefficients that aren't polynomials evaluate on batches too.
+    moment_expressions = generate_moment_expressions({"g" : sp.sqrt(c) * x * y + sp.cos(c) * y**2}, vector, [c])
+    moment_expressions.export_artifact(path)
+    evaluator = load_artifact(path)
+    moment_vector = rng.normal(size=(moment_expressions.moment_vector_size(), 6))
+    deterministic = rng.uniform(0.1, 1, size=(1, 6))
+    expected = moment_expressions.evaluate_ranked(moment_vector, deterministic)
+    assert np.allclose(evaluator.evaluate_ranked(moment_vector, deterministic), expected)
+    input_moments = {str(m) : moment_vector[rank] for m, rank in zip(moment_expressions.moments, moment_expressions.moment_ranks())}
+    assert np.allclose(evaluator.evaluate(input_moments, {"c" : deterministic[0]})["g"], expected[0])
+
+def test_moment_state_dynamics_artifact(tmp_path):
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    path = str(tmp_path / "dynamics.json")
+    msds.export_artifact(path)
+
+    rng = np.random.default_rng(0)
+    horizon, n = 5, 4
+    initial = rng.uniform(-1, 1, size=(len(msds.moment_state), n))
+    controls = rng.uniform(0, 0.1, size=(horizon, len(msds.control_variables), n))
+    disturbances = rng.uniform(-1, 1, size=len(msds.disturbance_moments))
+    expected = msds.propagate_horizon(initial, controls, disturbances)
+    np.save(str(tmp_path / "inputs.npy"), np.concatenate([initial.ravel(), controls.ravel(), disturbances]))
+
+    # Loading and propagating in a fresh interpreter imports neither SymPy nor networkx.
+    script = "\n".join([
+        "import sys",
+        "import numpy as np",
+        "from algebraic_moments.runtime import load_artifact",
+        "propagator = load_artifact(sys.argv[1])",
+        "inputs = np.load(sys.argv[2])",
+        "shapes = [(%d, %d), (%d, %d, %d), (%d,)]" % ((len(msds.moment_state), n, horizon, len(msds.control_variables), n,
+                                                      len(msds.disturbance_moments))),
+        "arrays = np.split(inputs, np.cumsum([np.prod(shape) for shape in shapes])[:-1])",
+        "initial, controls, disturbances = [array.reshape(shape) for array, shape in zip(arrays, shapes)]",
+        "np.save(sys.argv[3], propagator.propagate_horizon(initial, controls, disturbances))",
+        "assert 'sympy' not in sys.modules and 'networkx' not in sys.modules",
+    ])
+    subprocess.run([sys.executable, "-c", script, path, str(tmp_path / "inputs.npy"), str(tmp_path / "trajectory.npy")],
+                   check=True)
+    assert np.allclose(np.load(str(tmp_path / "trajectory.npy")), expected)
+
+    if shutil.which("cc") is None:
+        pytest.skip("No C compiler available.")
+    propagate = load_artifact(path).compile(build_directory=str(tmp_path))
+    assert np.allclose(propagate.horizon(initial, controls, disturbances), expected)
+
+def test_artifact_version():
+    artifact = {"format" : "algebraic_moments.artifact", "version" : 0, "kind" : "moment_expressions"}
+    with pytest.raises(Exception):
+        load_artifact(artifact)
@@ -0,0 +1,34 @@
+from algebraic_moments.objects import RandomVariable, RandomVector, DeterministicVariable, MomentRegistry
+from algebraic_moments.moment_expressions import moment_expression
+from algebraic_moments.sparse_poly import PolynomialRing
+import sympy as sp
+
+def test_SparsePolynomial():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    c = DeterministicVariable("c")
+    expr = sp.Rational(1, 3) * (c * x - y)**2 + sp.sqrt(c) * x + sp.Rational(1, 2)
+    ring = PolynomialRing.from_expressions([x, y], [expr])
+    assert set(ring.coefficient_generators) == {c, sp.sqrt(c)}
+
+    poly = ring.from_expr(expr)
+    assert sp.expand(poly.as_expr() - expr) == 0
+    assert sp.expand((poly**3 - poly * poly * 2 + 1).as_expr() - (expr**3 - 2 * expr**2 + 1)) == 0
+
+def test_moment_expression_matches_sympy():
+    x = RandomVariable("x")
+    y = RandomVariable("y")
+    z = RandomVariable("z")
+    vector = RandomVector([x, y, z], [(x, y)])
+    c = DeterministicVariable("c")
+    s = DeterministicVariable("s")
+    g = (c * x - s * y)**2 + z * (x - c) - 1
+
+    for n in range(1, 5):
+        # The reference path expands with sympy.Poly.
+        reference, reference_moments = moment_expression(sp.poly(g**n, *vector.variables), vector, MomentRegistry(vector))
+        expression, new_moments = moment_expression(g**n, vector, MomentRegistry(vector))
+        assert new_moments == reference_moments
+        assert sp.expand(expression - reference) == 0
+        # Terms are assembled without Mul's simplification pass, but should still be canonical.
+        assert all(term == sp.Mul(*term.args) for term in expression.args if term.is_Mul)
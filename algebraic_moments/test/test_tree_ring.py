@@ -0,0 +1,264 @@
+import algebraic_moments.objects as ao
+from algebraic_moments.tree_ring import tree_ring
+import numpy as np
+import sympy as sp
+import shutil
+import pytest
+
+def treering_system(distributions=None):
+    x = ao.StateVariable("x")
+    y = ao.StateVariable("y")
+    v = ao.StateVariable("v")
+    c = ao.StateVariable("c")
+    s = ao.StateVariable("s")
+    state_dependencies = [(x, y), (x, v), (x, c), (x, s), (y, v), (y, c), (y, s)]
+
+    cw = ao.RandomVariable("cw")
+    sw = ao.RandomVariable("sw")
+    wv = ao.RandomVariable("wv")
+    disturbance_vector = ao.RandomVector([cw, sw, wv], [(cw, sw)],
+                                         distributions({"cw" : cw, "sw" : sw, "wv" : wv}) if distributions else None)
+
+    dt = ao.DeterministicVariable("dt")
+    state_dynamics = {
+        x : x + dt * v * c,
+        y : y + dt * v * s,
+        v : v + wv,
+        c : c * cw - s * sw,
+        s : s * cw + c * sw
+    }
+    pds = ao.PolyDynamicalSystem(state_dynamics, [dt], disturbance_vector, state_dependencies)
+    initial_moment_state = [ao.Moment({x : 1}), ao.Moment({y : 1}), ao.Moment({x : 2}), ao.Moment({x : 1, y : 1})]
+    return pds, initial_moment_state
+
+def test_tree_ring_closure():
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    state = set(msds.moment_state)
+    disturbance = set(msds.disturbance_moments)
+    assert set(initial_moment_state).issubset(state)
+    for m in msds.moment_state:
+        assert msds.moment_state_dynamics[m].free_symbols.issubset(state | disturbance | set(pds.control_variables))
+
+def test_tree_ring_worklist():
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state + [ao.Moment({ao.StateVariable("x") : 1})], pds)
+    assert len(set(msds.moment_state)) == len(msds.moment_state)
+    assert len(set(msds.disturbance_moments)) == len(msds.disturbance_moments)
+
+    # Every state moment is discovered exactly once, starting from the initial moment state.
+    graph = msds.discovery_graph
+    assert set(graph.nodes) == set(msds.moment_state)
+    assert all(graph.in_degree(m) == (0 if m in initial_moment_state else 1) for m in graph.nodes)
+
+    # Expanding by degree finds the same closure.
+    by_degree = tree_ring(initial_moment_state, pds, order="degree")
+    assert set(by_degree.moment_state) == set(msds.moment_state)
+    for m in msds.moment_state:
+        assert sp.expand(by_degree.moment_state_dynamics[m] - msds.moment_state_dynamics[m]) == 0
+
+def test_tree_ring_parallel():
+    for reduced in [True, False]:
+        pds, initial_moment_state = treering_system()
+        serial = tree_ring(initial_moment_state, pds, reduced=reduced)
+        parallel = tree_ring(initial_moment_state, pds, reduced=reduced, processes=2)
+        # Merging each frontier in order gives the same system as the serial fifo order.
+        assert parallel.moment_state == serial.moment_state
+        assert parallel.disturbance_moments == serial.disturbance_moments
+        assert list(parallel.discovery_graph.edges) == list(serial.discovery_graph.edges)
+        for m in serial.moment_state:
+            assert sp.srepr(parallel.moment_state_dynamics[m]) == sp.srepr(serial.moment_state_dynamics[m])
+
+    with pytest.raises(Exception):
+        tree_ring(initial_moment_state, pds, order="degree", processes=2)
+
+def test_monomial_dynamics():
+    pds, _ = treering_system()
+    x, y = ao.StateVariable("x"), ao.StateVariable("y")
+    for vpm in [{x : 1}, {x : 2, y : 1}, {x : 1, y : 1}, {x : 2, y : 1}]:
+        expected = pds.dynamics[x]**vpm[x] * pds.dynamics[y]**vpm.get(y, 0)
+        assert sp.expand(pds.monomial_dynamics(vpm).as_expr() - expected) == 0
+    info = pds.product_cache_info()
+    # {x : 2, y : 1} is built from {x : 1, y : 1} and {x : 1}, so only four products are ever expanded.
+    assert info.misses == 4 and info.hits == 4 and info.currsize == 4
+
+def test_compile(tmp_path):
+    if shutil.which("cc") is None:
+        pytest.skip("No C compiler available.")
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    propagate = msds.compile(build_directory=str(tmp_path))
+
+    n = 7
+    rng = np.random.default_rng(0)
+    prev = rng.normal(size=(len(msds.moment_state), n))
+    disturbance = rng.normal(size=len(msds.disturbance_moments))
+    controls = rng.normal(size=(len(msds.control_variables), n))
+    out = propagate(prev, disturbance, controls)
+
+    func = sp.lambdify(msds.moment_state + msds.disturbance_moments + msds.control_variables,
+                       [msds.moment_state_dynamics[m] for m in msds.moment_state])
+    for k in range(n):
+        expected = func(*prev[:, k], *disturbance, *controls[:, k])
+        assert np.allclose(out[:, k], expected)
+
+    # Dynamics in Horner form in the controls give the same result.
+    nested = msds.compile(build_directory=str(tmp_path / "horner"), horner=True)
+    assert np.allclose(nested(prev, disturbance, controls), out)
+
+    # Propagating in place gives the same result.
+    assert np.allclose(propagate(prev, disturbance, controls, out=prev), out)
+
+    # The horizon function matches the Python backend, for a batch and for a single trajectory.
+    horizon = 5
+    initial = rng.uniform(-1, 1, size=(len(msds.moment_state), n))
+    controls = rng.uniform(0, 0.1, size=(horizon, len(msds.control_variables), n))
+    disturbances = rng.uniform(-1, 1, size=(horizon, len(msds.disturbance_moments)))
+    assert np.allclose(propagate.horizon(initial, controls, disturbances),
+                       msds.propagate_horizon(initial, controls, disturbances))
+    out = np.zeros((horizon, len(msds.moment_state)))
+    assert propagate.horizon(initial[:, 0], controls[:, :, 0], disturbances[0], out=out) is out
+    assert np.allclose(out, msds.propagate_horizon(initial[:, 0], controls[:, :, 0], disturbances[0]))
+
+def stepwise_trajectory(msds, initial, controls, disturbances):
+    """ Reference trajectory of a single moment state, propagated one step at a time with lambdify.
+    """
+    func = sp.lambdify(msds.moment_state + msds.disturbance_moments + msds.control_variables,
+                       [msds.moment_state_dynamics[m] for m in msds.moment_state])
+    state = initial
+    trajectory = []
+    for t in range(len(controls)):
+        state = np.array(func(*state, *disturbances[t], *controls[t]), dtype=float)
+        trajectory.append(state)
+    return np.array(trajectory)
+
+def test_propagate_horizon():
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds)
+    horizon, n = 6, 3
+    rng = np.random.default_rng(1)
+    initial = rng.uniform(-1, 1, size=(len(msds.moment_state), n))
+    controls = rng.uniform(0, 0.1, size=(horizon, len(msds.control_variables), n))
+    disturbances = rng.uniform(-1, 1, size=(horizon, len(msds.disturbance_moments)))
+
+    # A batch of trajectories with time-varying disturbance moments.
+    trajectory = msds.propagate_horizon(initial, controls, disturbances)
+    assert trajectory.shape == (horizon, len(msds.moment_state), n)
+    for k in range(n):
+        expected = stepwise_trajectory(msds, initial[:, k], controls[:, :, k], disturbances)
+        assert np.allclose(trajectory[:, :, k], expected)
+
+    # A single trajectory with constant disturbance moments, written into a preallocated buffer.
+    out = np.zeros((horizon, len(msds.moment_state)))
+    result = msds.propagate_horizon(initial[:, 0], controls[:, :, 0], disturbances[0], out=out)
+    assert result is out
+    assert np.allclose(out, stepwise_trajectory(msds, initial[:, 0], controls[:, :, 0], [disturbances[0]] * horizon))
+
+    # The generated function takes its arguments in the same order.
+    trajectory = np.zeros((horizon, len(msds.moment_state), n))
+    msds.compile_python()(initial, controls, disturbances[:, :, None], trajectory)
+    assert np.allclose(trajectory, msds.propagate_horizon(initial, controls, disturbances))
+
+def test_propagate_horizon_transcendental():
+    # Coefficients that aren't polynomials in the control inputs propagate batches too.
+    x = ao.StateVariable("x")
+    w = ao.RandomVariable("w")
+    dt = ao.DeterministicVariable("dt")
+    pds = ao.PolyDynamicalSystem({x : sp.cos(dt) * x + sp.sqrt(dt) * w}, [dt], ao.RandomVector([w], []), [])
+    msds = tree_ring([ao.Moment({x : 1}), ao.Moment({x : 2})], pds)
+    horizon, n = 4, 3
+    rng = np.random.default_rng(2)
+    initial = rng.uniform(-1, 1, size=(len(msds.moment_state), n))
+    controls = rng.uniform(0.1, 1, size=(horizon, 1, n))
+    disturbances = rng.uniform(0, 1, size=len(msds.disturbance_moments))
+    trajectory = msds.propagate_horizon(initial, controls, disturbances)
+    for k in range(n):
+        assert np.allclose(trajectory[:, :, k], msds.propagate_horizon(initial[:, k], controls[:, :, k], disturbances))
+    first, wPow1 = msds.moment_state.index(ao.Moment({x : 1})), msds.disturbance_moments.index(ao.Moment({w : 1}))
+    assert np.allclose(trajectory[0, first], np.cos(controls[0, 0]) * initial[first] +
+                       np.sqrt(controls[0, 0]) * disturbances[wPow1])
+
+def test_tree_ring_distributions():
+    # A zero mean Gaussian speed disturbance, with known variance.
+    pds, initial_moment_state = treering_system()
+    annotated_pds, _ = treering_system(lambda variables : {variables["wv"] : ao.Gaussian(0, 0.01)})
+    msds = tree_ring(initial_moment_state, pds)
+    annotated = tree_ring(initial_moment_state, annotated_pds)
+    assert not any(ao.RandomVariable("wv") in m.vpm for m in annotated.disturbance_moments)
+    assert len(annotated.disturbance_moments) < len(msds.disturbance_moments)
+    assert len(annotated.moment_state) <= len(msds.moment_state)
+
+    # Both systems propagate the initial moment state alike, from a deterministic initial state.
+    rng = np.random.default_rng(0)
+    state = {var : rng.uniform(-1, 1) for var in pds.state_variables}
+    def initial(msds):
+        return [np.prod([state[var]**power for var, power in m.vpm.items()]) for m in msds.moment_state]
+    joint = dict()
+    def disturbance(msds):
+        values = []
+        for m in msds.disturbance_moments:
+            wv_power = sum(power for var, power in m.vpm.items() if str(var) == "wv")
+            rest = tuple(sorted((str(var), power) for var, power in m.vpm.items() if str(var) != "wv"))
+            value = joint.setdefault(rest, rng.uniform(0.5, 1)) if rest else 1.0
+            # Raw moments of a zero mean Gaussian with variance 0.01.
+            value *= 0.0 if wv_power % 2 else float(sp.factorial2(wv_power - 1)) * 0.01**(wv_power // 2)
+            values.append(value)
+        return values
+    controls = np.full((4, 1), 0.1)
+    trajectory = msds.propagate_horizon(initial(msds), controls, disturbance(msds))
+    annotated_trajectory = annotated.propagate_horizon(initial(annotated), controls, disturbance(annotated))
+    for m in initial_moment_state:
+        assert np.allclose(trajectory[:, msds.moment_state.index(m)],
+                           annotated_trajectory[:, annotated.moment_state.index(m)])
+
+    # Terms with vanishing moments are dropped before their state moments are discovered.
+    x = ao.StateVariable("x")
+    w = ao.RandomVariable("w")
+    for distributions, n_state in [(None, 2), ({w : ao.ZeroMean()}, 1)]:
+        pds = ao.PolyDynamicalSystem({x : x + w}, [], ao.RandomVector([w], [], distributions), [])
+        assert len(tree_ring([ao.Moment({x : 2})], pds).moment_state) == n_state
+
+def test_linear_operator():
+    pds, initial_moment_state = treering_system()
+    msds = tree_ring(initial_moment_state, pds, reduced=False)
+    operator = msds.compile_linear_operator()
+    n_state = len(msds.moment_state)
+    assert operator.shape == (n_state, n_state) and operator.nnz < n_state**2
+
+    rng = np.random.default_rng(0)
+    n = 6
+    prev = rng.uniform(-1, 1, size=(n_state, n))
+    disturbance = rng.uniform(-1, 1, size=len(msds.disturbance_moments))
+    controls = rng.uniform(0, 0.1, size=(len(msds.control_variables), n))
+    expected = msds.propagate_horizon(prev, controls[None], disturbance)[0]
+
+    # Per scenario controls, shared controls and a single moment state.
+    assert np.allclose(operator.propagate(prev, disturbance, controls), expected)
+    shared = msds.propagate_horizon(prev, np.tile(controls[:, :1], (1, n))[None], disturbance)[0]
+    assert np.allclose(operator.propagate(prev, disturbance, controls[:, 0]), shared)
+    assert np.allclose(operator.propagate(prev[:, 0], disturbance, controls[:, 0]), expected[:, 0])
+    matrix, offset = operator.dense(disturbance, controls[:, 0])
+    assert np.allclose(matrix @ prev[:, 0] + offset, expected[:, 0])
+
+    # Composing 5 steps with constant inputs matches 5 propagation steps.
+    matrix, offset = operator.compose(5, disturbance, controls[:, 0])
+    trajectory = msds.propagate_horizon(prev[:, 0], np.tile(controls[:, 0], (5, 1)), disturbance)
+    assert np.allclose(matrix @ prev[:, 0] + offset, trajectory[-1])
+
+    # Coefficients that aren't polynomials in the control inputs fill batches too.
+    x, y = ao.StateVariable("x"), ao.StateVariable("y")
+    w = ao.RandomVariable("w")
+    dt = ao.DeterministicVariable("dt")
+    pds = ao.PolyDynamicalSystem({x : sp.cos(dt) * x + sp.sqrt(dt) * w}, [dt], ao.RandomVector([w], []), [])
+    msds = tree_ring([ao.Moment({x : 1}), ao.Moment({x : 2})], pds, reduced=False)
+    operator = msds.compile_linear_operator()
+    prev = rng.uniform(-1, 1, size=(len(msds.moment_state), n))
+    disturbance = rng.uniform(0, 1, size=len(msds.disturbance_moments))
+    controls = rng.uniform(0.1, 1, size=(1, n))
+    assert np.allclose(operator.propagate(prev, disturbance, controls),
+                       msds.propagate_horizon(prev, controls[None], disturbance)[0])
+
+    # Products of moments of independent states aren't linear.
+    pds = ao.PolyDynamicalSystem({x : x + y, y : y + w}, [], ao.RandomVector([w], []), [])
+    with pytest.raises(Exception):
+        tree_ring([ao.Moment({x : 2})], pds).linear_form()
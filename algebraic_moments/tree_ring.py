@@ -1,12 +1,16 @@
-import numpy as np
-import sympy as sp
-from algebraic_moments.moment_expressions import moment_expression
-from algebraic_moments.objects import MomentStateDynamicalSystem
-from copy import deepcopy
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from algebraic_moments.moment_expressions import moment_expression, dumps_expressions
+from algebraic_moments.objects import MomentStateDynamicalSystem, MomentRegistry
+from algebraic_moments.cache import cached
+from algebraic_moments.profiling import ExpansionStats, active_stats, count_terms, phase
+import time
+from collections import deque
+import heapq
 
 
 
-def tree_ring(initial_moment_state, poly_dynamical_system, reduced=True):
+def tree_ring(initial_moment_state, poly_dynamical_system, reduced=True, order="fifo", cache=None, processes=None):
     """ tree_ring is an algorithm for finding a moment state dynamical system to propagate the moments
     specified in "initial_moment_state".
 
@@ -14,46 +18,173 @@ def tree_ring(initial_moment_state, poly_dynamical_system, reduced=True):
         initial_moment_state (list of Moment): moment state we want to find the dynamics for.
         poly_dynamical_system (PolyDynamicalSystem): the polynomial dynamical system we are working with.
         reduced (bool, optional): Search for a reduced MSDS or un-reduced MSDS. Defaults to True.
+        order (str, optional): order in which discovered moments are expanded, "fifo" for the order of
+            discovery or "degree" for lowest total degree first. Defaults to "fifo".
+        cache (DerivationCache, optional): reuse the result of a previous call with the same inputs. Defaults to None.
+        processes (int, optional): expand each frontier of discovered moments in a pool of this many processes.
+            The expansions of a frontier are merged in the order of the frontier, so the result is the same as
+            with one process. Requires the "fifo" order. Defaults to None.
+
+    Raises:
+        Exception: processes is given with the "degree" order.
 
     Returns:
         MomentStateDynamicalSystem: resutling moment state dynamical system.
     """
+    if processes is not None and processes > 1 and order != "fifo":
+        raise Exception("Parallel expansion requires the fifo order.")
+    return cached(cache, "tree_ring", [initial_moment_state, poly_dynamical_system, reduced, order],
+                  lambda: _tree_ring(initial_moment_state, poly_dynamical_system, reduced, order, processes))
+
+def _tree_ring(initial_moment_state, poly_dynamical_system, reduced, order, processes=None):
+    # networkx is slow to import, so it is only loaded by the derivations that build a discovery graph.
+    import networkx as nx
     moment_state_dynamics = dict()
-    disturbance_moments = set()
+    disturbance_moments = []
+
+    # The registry doubles as the visited set: a moment is only queued when it is first registered.
+    moments = MomentRegistry(poly_dynamical_system.system_random_vector)
+    worklist = Worklist(order)
+
+    # The discovery graph has an edge from each moment to the state moments its expansion introduced.
+    discovery_graph = nx.DiGraph()
     for moment in initial_moment_state:
-        expand(moment, initial_moment_state, moment_state_dynamics, poly_dynamical_system, disturbance_moments, reduced=reduced)
-    return MomentStateDynamicalSystem(moment_state_dynamics, disturbance_moments, poly_dynamical_system.control_variables)
+        moment, is_new = moments.intern(moment.vpm)
+        if is_new:
+            discovery_graph.add_node(moment)
+            worklist.push(moment)
+
+    if processes is not None and processes > 1:
+        # Every moment of the worklist is expanded in a round, and the moments it discovers are expanded in the
+        # next one. Merging the expansions of a round in order gives the same result as popping them one at a time.
+        with ProcessPoolExecutor(processes, initializer=_initialize_worker,
+                                 initargs=(poly_dynamical_system, reduced)) as executor:
+            while worklist:
+                frontier = [worklist.pop() for _ in range(len(worklist))]
+                for moment, result in zip(frontier, executor.map(_expand_in_worker, frontier)):
+                    expression, expansion_moments, seconds = pickle.loads(result)
+                    new_moments = [m for m in expansion_moments if m not in moments]
+                    for m in new_moments:
+                        moments.add(m)
+                    new_state_moments = record_expansion(moment, expression, new_moments, seconds, moment_state_dynamics,
+                                                         poly_dynamical_system, disturbance_moments)
+                    for new_m in new_state_moments:
+                        discovery_graph.add_edge(moment, new_m)
+                        worklist.push(new_m)
+    while worklist:
+        moment = worklist.pop()
+        new_state_moments = expand(moment, moments, moment_state_dynamics, poly_dynamical_system,
+                                   disturbance_moments, reduced=reduced)
+        for new_m in new_state_moments:
+            discovery_graph.add_edge(moment, new_m)
+            worklist.push(new_m)
+    return MomentStateDynamicalSystem(moment_state_dynamics, disturbance_moments, poly_dynamical_system.control_variables,
+                                      discovery_graph=discovery_graph)
+
+class Worklist(object):
+    def __init__(self, order="fifo"):
+        """ Queue of moments that are waiting to be expanded.
 
-def expand(moment, moment_state, moment_state_dynamics, poly_dynamical_system, disturbance_moments, reduced=True):
+        Args:
+            order (str, optional): "fifo" or "degree". Defaults to "fifo".
+        """
+        if order not in ["fifo", "degree"]:
+            raise Exception("Invalid worklist order " + str(order) + ".")
+        self._order = order
+        self._queue = deque()
+        self._heap = []
+        self._count = 0 # Breaks ties between moments of equal degree by order of discovery.
+
+    def __len__(self):
+        return len(self._queue) + len(self._heap)
+
+    def push(self, moment):
+        if self._order == "fifo":
+            self._queue.append(moment)
+        else:
+            heapq.heappush(self._heap, (sum(moment.vpm.values()), self._count, moment))
+            self._count += 1
+
+    def pop(self):
+        if self._order == "fifo":
+            return self._queue.popleft()
+        else:
+            return heapq.heappop(self._heap)[-1]
+
+def expand(moment, moments, moment_state_dynamics, poly_dynamical_system, disturbance_moments, reduced=True):
     """ Expand a node in the search tree. TODO: decide on a better metaphor for the tree we are working with.
 
     Args:
         moment (Moment): the moment we are deriving the dyanmics for.
-        moment_state (list of Moment): current moment state.
+        moments (MomentRegistry): registry of the state and disturbance moments found so far.
         moment_state_dynamics (dict Moment-> SymPy expression): dictionary for the dynamics of the moment state.
         poly_dynamical_system (PolyDynamicalSystem): the polynomial dynamical system we are working with.
-        disturbance_moments (RandomVector): disturbance moments for the system.
+        disturbance_moments (list of Moment): disturbance moments for the system.
         reduced (bool, optional): Search for a reduced MSDS or un-reduced MSDS. Defaults to True.
+
+    Returns:
+        list of Moment: state moments that were discovered by this expansion and still need to be expanded.
     """
-    moment_dynamics = np.prod([poly_dynamical_system.dynamics[var]**power for var, power in moment.vpm.items()\
-                               if var in poly_dynamical_system.state_variables])
+    start = time.perf_counter()
+    expression, new_moments = _moment_dynamics(moment, moments, poly_dynamical_system, reduced)
+    return record_expansion(moment, expression, new_moments, time.perf_counter() - start, moment_state_dynamics,
+                            poly_dynamical_system, disturbance_moments)
+
+def _moment_dynamics(moment, moments, poly_dynamical_system, reduced):
+    moment_dynamics = poly_dynamical_system.monomial_dynamics(moment.vpm)
 
     # system_random_vector is a random vector composed of all state, control, and disturbance variables.
     system_random_vector = poly_dynamical_system.system_random_vector
     if reduced==True:
-        expression, new_moments = moment_expression(moment_dynamics, system_random_vector, moment_state)
+        return moment_expression(moment_dynamics, system_random_vector, moments)
     else:
-        expression, new_moments = moment_expression(moment_dynamics, system_random_vector, moment_state,\
-                                                    partial_reduction=set(poly_dynamical_system.disturbance_variables))
+        return moment_expression(moment_dynamics, system_random_vector, moments,\
+                                 partial_reduction=set(poly_dynamical_system.disturbance_variables))
+
+def record_expansion(moment, expression, new_moments, seconds, moment_state_dynamics, poly_dynamical_system,
+                     disturbance_moments):
+    """ Add the dynamics of a moment, and sort the moments its expansion discovered into state and disturbance
+        moments. See expand for the arguments.
+
+    Args:
+        expression (SymPy expression): dynamics of moment.
+        new_moments (list of Moment): moments that were first registered by the expansion.
+        seconds (float): time of the expansion.
 
+    Returns:
+        list of Moment: state moments that were discovered by the expansion and still need to be expanded.
+    """
     moment_state_dynamics[moment] = expression
     
-    # Update state moments and disturbance moments.
-    new_state_moments = [m for m in new_moments if set(m.variables).issubset(poly_dynamical_system.state_variables)]
-    new_disturbance_moments = {m for m in new_moments if m not in new_state_moments}
+    # Update state moments and disturbance moments. The registry only returns a moment as new once,
+    # so neither list can contain duplicates.
+    with phase("classification"):
+        new_state_moments = [m for m in new_moments if set(m.variables).issubset(poly_dynamical_system.state_variables)]
+        new_disturbance_moments = [m for m in new_moments if m not in new_state_moments]
+    disturbance_moments += new_disturbance_moments
 
-    moment_state += new_state_moments
-    disturbance_moments.update(new_disturbance_moments)
+    stats = active_stats()
+    if stats is not None:
+        stats.record_moment(moment, ExpansionStats(seconds, count_terms(expression), len(new_state_moments),
+                                                   len(new_disturbance_moments)))
+    return new_state_moments
 
-    for new_m in new_state_moments:
-        expand(new_m, moment_state, moment_state_dynamics, poly_dynamical_system, disturbance_moments)
\ No newline at end of file
+# System and reduction of the tree_ring call that a worker process expands moments for.
+_worker_system = None
+
+def _initialize_worker(poly_dynamical_system, reduced):
+    global _worker_system
+    _worker_system = (poly_dynamical_system, reduced)
+
+def _expand_in_worker(moment):
+    """ Expand a moment with a new registry of moments, in a worker process of tree_ring.
+
+    Returns:
+        bytes: the dynamics of moment, the moments they require in the order of their first use and the time
+            of the expansion, pickled with dumps_expressions.
+    """
+    start = time.perf_counter()
+    poly_dynamical_system, reduced = _worker_system
+    expression, moments = _moment_dynamics(moment, MomentRegistry(poly_dynamical_system.system_random_vector),
+                                           poly_dynamical_system, reduced)
+    return dumps_expressions((expression, moments, time.perf_counter() - start))